@@ -0,0 +1,154 @@
+"""Ranking parity between the sklearn and compact vectorizer modes.
+
+Fits both vectorizers on the same synthetic catalog, scores the query corpus against each, and compares the top
+semantic matches and the top ranked candidates. Also reports the fit's peak traced memory and the size of the
+scoring matrix per mode. Exits non-zero when the mean top-k overlap of the ranking drops below --min-overlap.
+benchmarks/run.py runs the same check on its catalog for compact-mode runs, or with --parity.
+
+    python benchmarks/parity.py --size 20000
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+BENCHMARK_DIR = Path(__file__).resolve().parent
+REPO_DIR = BENCHMARK_DIR.parent
+
+sys.path.insert(0, str(BENCHMARK_DIR))
+from synthetic import generate_catalog
+
+MODES = ("sklearn", "compact")
+DEFAULT_TOP_K = 10
+DEFAULT_MIN_OVERLAP = 0.9
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", type=int, default=20000, help="Catalog rows")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic catalog")
+    parser.add_argument("--queries", default=str(BENCHMARK_DIR / "queries.txt"), help="Query corpus, one query per line")
+    parser.add_argument("--top-k", type=int, default=DEFAULT_TOP_K, help="Matches compared per query")
+    parser.add_argument("--min-overlap", type=float, default=DEFAULT_MIN_OVERLAP,
+                        help="Lowest acceptable mean top-k overlap of the ranking")
+    parser.add_argument("--output", help="Write the JSON report here instead of stdout")
+    return parser.parse_args(argv)
+
+
+# Catalog the way ingest builds it: donor rows with the website tables joined in
+def build_catalog(server, size, seed):
+    tables = generate_catalog(size, seed=seed)
+    frame = pd.DataFrame(tables["charity_donor"])
+    website_map = server.build_website_map([
+        pd.DataFrame(tables[name], columns=["id", column]).rename(columns={column: "website"})
+        for name, column in server.WEBSITE_TABLE_COLUMNS.items()
+    ])
+    return server.CharityCatalog.from_frame(server.attach_websites(frame, website_map)).deduplicated()
+
+
+def fit(server, catalog, mode):
+    served_mode, server.VECTORIZER_MODE = server.VECTORIZER_MODE, mode
+    tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        snapshot = server.CatalogSnapshot.build(catalog, mode)
+    finally:
+        seconds = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        server.VECTORIZER_MODE = served_mode
+    snapshot.cf_scorer = server.CollaborativeScorer(None, catalog)
+
+    matrix = snapshot.text_matrix_t
+    stats = {
+        "fit_seconds": round(seconds, 3),
+        "fit_peak_traced_mb": round(peak / 2 ** 20, 1),
+        "features": matrix.shape[0],
+        "matrix_mb": round((matrix.data.nbytes + matrix.indices.nbytes + matrix.indptr.nbytes) / 2 ** 20, 2),
+        "matrix_dtype": str(matrix.dtype)
+    }
+    if mode == "compact":
+        vocabulary = snapshot.vectorizer.vocabulary
+        stats["vocabulary_mb"] = round((vocabulary.data.nbytes + vocabulary.offsets.nbytes) / 2 ** 20, 2)
+    return snapshot, stats
+
+
+# Top semantic matches and top ranked charity ids per query
+def rank(server, snapshot, queries, query_infos, top_k):
+    semantic_matches, focus_matches = server.score_queries(query_infos, snapshot)
+    results = []
+    for query, query_info, semantic, focus in zip(queries, query_infos, semantic_matches, focus_matches):
+        ranked = server.rank_charities(query, query_info, semantic, snapshot=snapshot, focus_matches=focus)
+        order = np.argsort(-ranked.relevance, kind="stable")[:top_k]
+        results.append({
+            "semantic": dict(semantic[:top_k]),
+            "ranked": [int(snapshot.catalog.charity_ids[ranked.rows[i]]) for i in order]
+        })
+    return results
+
+
+def overlap(a, b):
+    return len(set(a) & set(b)) / max(len(a), len(b)) if a or b else 1.0
+
+
+def summarize(values):
+    return {"mean": round(float(np.mean(values)), 4), "min": round(float(np.min(values)), 4)}
+
+
+# Fit both modes on the catalog and compare their rankings of the queries; needs the NLP model loaded
+def compare_modes(server, catalog, queries, top_k):
+    query_infos = server.preprocess_queries(queries)
+    report = {"modes": {}}
+    snapshots, results = {}, {}
+    for mode in MODES:
+        print(f"fitting {mode}", file=sys.stderr)
+        snapshots[mode], report["modes"][mode] = fit(server, catalog, mode)
+        results[mode] = rank(server, snapshots[mode], queries, query_infos, top_k)
+
+    vocabularies = [set(snapshots["sklearn"].vectorizer.get_feature_names_out()), set(snapshots["compact"].vectorizer.vocabulary)]
+    score_differences = [
+        abs(float(score) - float(compact["semantic"][charity_id]))
+        for reference, compact in zip(results["sklearn"], results["compact"])
+        for charity_id, score in reference["semantic"].items() if charity_id in compact["semantic"]
+    ]
+    report["parity"] = {
+        "vocabulary_jaccard": round(len(vocabularies[0] & vocabularies[1]) / len(vocabularies[0] | vocabularies[1]), 4),
+        "semantic_overlap": summarize([overlap(list(a["semantic"]), list(b["semantic"])) for a, b in zip(results["sklearn"], results["compact"])]),
+        "semantic_max_score_difference": round(max(score_differences, default=0.0), 6),
+        "ranked_overlap": summarize([overlap(a["ranked"], b["ranked"]) for a, b in zip(results["sklearn"], results["compact"])]),
+        "ranked_identical_queries": sum(a["ranked"] == b["ranked"] for a, b in zip(results["sklearn"], results["compact"]))
+    }
+    return report
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    sys.path.insert(0, str(REPO_DIR))
+    import server
+
+    with open(args.queries) as f:
+        queries = [line.strip() for line in f if line.strip()]
+
+    catalog = build_catalog(server, args.size, args.seed)
+    server.load_nlp_stage({})
+    report = {"config": {"size": args.size, "seed": args.seed, "queries": len(queries), "top_k": args.top_k}}
+    report.update(compare_modes(server, catalog, queries, args.top_k))
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        Path(args.output).write_text(output + "\n")
+    else:
+        print(output)
+    if report["parity"]["ranked_overlap"]["mean"] < args.min_overlap:
+        raise SystemExit(f"mean ranked overlap {report['parity']['ranked_overlap']['mean']} is below {args.min_overlap}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,356 @@
+"""Offline benchmark for the recommendation API.
+
+Generates a synthetic catalog, serves it to server.py through an in-memory stand-in for Supabase, then measures
+startup (seconds and RSS per loader stage), predict_charities latency per ranking stage, and the /predict and
+/predict/batch endpoints over an in-process HTTP client. Results are printed as JSON so runs on different commits
+can be compared with --baseline. The HTTP phase needs httpx, which is not a server dependency. Runs with
+VECTORIZER_MODE=compact (or --parity) also check its ranking against the sklearn vectorizer, see parity.py, and
+fail when the mean top-k overlap drops below --min-overlap.
+
+    python benchmarks/run.py --size 1000 --size 100000 --output bench.json
+    python benchmarks/run.py --size 100000 --env CATALOG_SHARDS=4 --baseline bench.json
+    python benchmarks/run.py --size 20000 --env VECTORIZER_MODE=compact
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+BENCHMARK_DIR = Path(__file__).resolve().parent
+REPO_DIR = BENCHMARK_DIR.parent
+
+sys.path.insert(0, str(BENCHMARK_DIR))
+from synthetic import StandInSupabase, generate_catalog, train_model_pickle
+from parity import DEFAULT_MIN_OVERLAP, DEFAULT_TOP_K, compare_modes
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", type=int, action="append", help="Catalog rows; repeat to run several sizes (default 1000)")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic catalog")
+    parser.add_argument("--queries", default=str(BENCHMARK_DIR / "queries.txt"), help="Query corpus, one query per line")
+    parser.add_argument("--repeat", type=int, default=3, help="Passes over the corpus through predict_charities")
+    parser.add_argument("--cache", choices=("cold", "warm"), default="cold",
+                        help="cold clears the query and result caches before every query, warm primes them first")
+    parser.add_argument("--top-n", type=int, default=8)
+    parser.add_argument("--http-requests", type=int, default=200, help="GET /predict requests to send, 0 to skip")
+    parser.add_argument("--concurrency", type=int, default=8, help="Requests in flight against the HTTP endpoint")
+    parser.add_argument("--batch-size", type=int, default=25, help="Queries per POST /predict/batch, 0 to skip")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds the stand-in Supabase adds per request")
+    parser.add_argument("--no-model", action="store_true", help="Serve no collaborative-filtering model")
+    parser.add_argument("--parity", action="store_true",
+                        help="Compare the compact and sklearn vectorizer rankings (always on with VECTORIZER_MODE=compact)")
+    parser.add_argument("--min-overlap", type=float, default=DEFAULT_MIN_OVERLAP,
+                        help="Lowest acceptable mean top-k overlap of the parity check")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE", help="Server setting to override")
+    parser.add_argument("--workdir", help="Directory for artifacts and the source snapshot; reuse it to measure a warm start")
+    parser.add_argument("--output", help="Write the JSON report here instead of stdout")
+    parser.add_argument("--baseline", help="Earlier JSON report to print deltas against")
+    args = parser.parse_args(argv)
+    args.size = args.size or [1000]
+    # The run changes into the work directory, so paths given on the command line are resolved first
+    for name in ("queries", "workdir", "output", "baseline"):
+        if getattr(args, name):
+            setattr(args, name, str(Path(getattr(args, name)).resolve()))
+    return args
+
+
+# Resident set size of this process in MiB, and the peak so far
+def rss_mb():
+    try:
+        with open("/proc/self/statm") as f:
+            current = int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except OSError:
+        current = None
+    # ru_maxrss is KiB on Linux
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return {"rss_mb": round(current, 1) if current is not None else None, "peak_rss_mb": round(peak, 1)}
+
+
+def summarize(seconds):
+    """Latency percentiles in milliseconds."""
+    if not seconds:
+        return {"count": 0}
+    ms = np.asarray(seconds) * 1000
+    return {
+        "count": len(ms),
+        "mean_ms": round(float(ms.mean()), 3),
+        "p50_ms": round(float(np.percentile(ms, 50)), 3),
+        "p95_ms": round(float(np.percentile(ms, 95)), 3),
+        "p99_ms": round(float(np.percentile(ms, 99)), 3),
+        "max_ms": round(float(ms.max()), 3)
+    }
+
+
+def git_revision():
+    def git(*command):
+        result = subprocess.run(["git", *command], cwd=REPO_DIR, capture_output=True, text=True)
+        return result.stdout.strip() if result.returncode == 0 else None
+    return {"commit": git("rev-parse", "HEAD"), "dirty": bool(git("status", "--porcelain", "--", "server.py"))}
+
+
+# Run the startup loader in this thread, recording time and memory after every stage
+def measure_startup(server):
+    loader = server.startup_loader
+    stages = {}
+    run_stage = loader._run_stage
+
+    def timed_stage(name, stage, context):
+        ok = run_stage(name, stage, context)
+        stages[name] = dict(loader.components[name], **rss_mb())
+        stages[name].pop("detail", None)
+        return ok
+
+    loader._run_stage = timed_stage
+    start = time.perf_counter()
+    loader.run()
+    return {"ready": loader.ready, "seconds": round(time.perf_counter() - start, 3), "stages": stages, **rss_mb()}
+
+
+# Replay the corpus through predict_charities, collecting wall time and the per-stage timings
+def replay_predict(server, queries, repeat, top_n, cache):
+    if cache == "warm":
+        for i, query in enumerate(queries):
+            server.predict_charities(query, top_n=top_n, seed=i)
+
+    latencies = []
+    stages = {}
+    candidates = []
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for i, query in enumerate(queries):
+            if cache == "cold":
+                server.query_cache.clear()
+                server.result_cache.clear()
+            timings = server.RequestTimings()
+            began = time.perf_counter()
+            server.predict_charities(query, top_n=top_n, seed=i, timings=timings)
+            latencies.append(time.perf_counter() - began)
+            for name, seconds in timings.stages.items():
+                stages.setdefault(name, []).append(seconds)
+            candidates.extend(timings.candidate_counts)
+    elapsed = time.perf_counter() - start
+
+    return {
+        "cache": cache,
+        "latency": summarize(latencies),
+        "throughput_qps": round(len(latencies) / elapsed, 2),
+        "stages": {name: summarize(seconds) for name, seconds in stages.items()},
+        "candidates_mean": round(float(np.mean(candidates)), 1) if candidates else None,
+        **rss_mb()
+    }
+
+
+# Send requests to the ASGI app in process, so the middleware, worker pool and serialization are all measured
+async def replay_http(server, queries, requests, concurrency, top_n, batch_size):
+    import httpx
+
+    transport = httpx.ASGITransport(app=server.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://benchmark", timeout=None) as client:
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def timed(send):
+            async with semaphore:
+                began = time.perf_counter()
+                response = await send()
+                return time.perf_counter() - began, response.status_code
+
+        async def replay(sends):
+            start = time.perf_counter()
+            samples = await asyncio.gather(*(timed(send) for send in sends))
+            elapsed = time.perf_counter() - start
+            statuses = {}
+            for _, status in samples:
+                statuses[str(status)] = statuses.get(str(status), 0) + 1
+            return [seconds for seconds, _ in samples], statuses, elapsed
+
+        report = {"concurrency": concurrency}
+        if requests:
+            server.query_cache.clear()
+            server.result_cache.clear()
+            sends = [
+                lambda i=i: client.get("/predict", params={"query": queries[i % len(queries)], "top_n": top_n, "seed": i})
+                for i in range(requests)
+            ]
+            seconds, statuses, elapsed = await replay(sends)
+            report["predict"] = {"latency": summarize(seconds), "throughput_rps": round(len(seconds) / elapsed, 2),
+                                 "statuses": statuses}
+
+        if batch_size:
+            server.query_cache.clear()
+            server.result_cache.clear()
+            batches = [queries[i:i + batch_size] for i in range(0, len(queries), batch_size)]
+            sends = [
+                lambda batch=batch: client.post("/predict/batch", json={"queries": [
+                    {"query": query, "top_n": top_n, "seed": i} for i, query in enumerate(batch)
+                ]})
+                for batch in batches
+            ]
+            seconds, statuses, elapsed = await replay(sends)
+            report["predict_batch"] = {"batch_size": batch_size, "latency": summarize(seconds),
+                                       "throughput_qps": round(len(queries) / elapsed, 2), "statuses": statuses}
+    return dict(report, **rss_mb())
+
+
+# One catalog size, benchmarked in this process
+def run_size(args, size):
+    workdir = Path(args.workdir or tempfile.mkdtemp(prefix="charity-bench-"))
+    workdir.mkdir(parents=True, exist_ok=True)
+    overrides = dict(setting.split("=", 1) for setting in args.env)
+
+    # Settings are read when server is imported; artifacts and the downloaded model land in the work directory
+    os.environ.update(overrides)
+    os.environ.setdefault("ARTIFACT_DIR", str(workdir / "artifacts"))
+    os.environ.setdefault("CATALOG_SNAPSHOT_PATH", str(workdir / "source-snapshot.parquet"))
+    os.environ.setdefault("CATALOG_REFRESH_INTERVAL", "0")
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    os.environ.setdefault("STARTUP_MAX_ATTEMPTS", "1")
+    os.chdir(workdir)
+    sys.path.insert(0, str(REPO_DIR))
+
+    print(f"[{size}] generating catalog", file=sys.stderr)
+    start = time.perf_counter()
+    tables = generate_catalog(size, seed=args.seed)
+    files = {}
+    if not args.no_model:
+        model = train_model_pickle([row["charityId"] for row in tables["charity_donor"]], seed=args.seed)
+        if model is not None:
+            files[("ml-pickle", "charity_model.pkl")] = model
+    generate_seconds = time.perf_counter() - start
+
+    with open(args.queries) as f:
+        queries = [line.strip() for line in f if line.strip()]
+
+    start = time.perf_counter()
+    import server
+    import_seconds = time.perf_counter() - start
+    server.supabase = StandInSupabase(tables, files, latency=args.latency)
+    del tables
+
+    print(f"[{size}] starting up", file=sys.stderr)
+    report = {
+        **git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": {
+            "size": size, "seed": args.seed, "queries": len(queries), "repeat": args.repeat, "cache": args.cache,
+            "top_n": args.top_n, "http_requests": args.http_requests, "concurrency": args.concurrency,
+            "batch_size": args.batch_size, "supabase_latency": args.latency, "model": bool(files), "env": overrides,
+            "predict_executor": server.PREDICT_EXECUTOR, "predict_workers": server.PREDICT_WORKERS,
+            "catalog_shards": server.CATALOG_SHARDS, "dense_retrieval": server.DENSE_RETRIEVAL,
+            "vectorizer_mode": server.VECTORIZER_MODE
+        },
+        "generate_seconds": round(generate_seconds, 3),
+        "import_seconds": round(import_seconds, 3)
+    }
+    report["startup"] = measure_startup(server)
+    report["startup"]["supabase_requests"] = server.supabase.requests
+    if not report["startup"]["ready"]:
+        return report
+
+    print(f"[{size}] replaying {len(queries)} queries x {args.repeat}", file=sys.stderr)
+    report["predict_charities"] = replay_predict(server, queries, args.repeat, args.top_n, args.cache)
+    if args.http_requests or args.batch_size:
+        print(f"[{size}] replaying over HTTP", file=sys.stderr)
+        report["http"] = asyncio.run(replay_http(server, queries, args.http_requests, args.concurrency,
+                                                 args.top_n, args.batch_size))
+    if args.parity or server.VECTORIZER_MODE == "compact":
+        print(f"[{size}] checking vectorizer parity", file=sys.stderr)
+        report["parity"] = compare_modes(server, server.catalog_snapshot.catalog, queries, DEFAULT_TOP_K)
+    server.predict_pool.shutdown()
+    server.shutdown_shard_pool()
+
+    if not args.workdir:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return report
+
+
+# Every size runs in its own interpreter so import, startup and memory figures do not carry over
+def run_sizes(args, argv):
+    reports = []
+    for size in args.size:
+        command = [sys.executable, str(Path(__file__).resolve())]
+        skip = False
+        for arg in argv:
+            if skip:
+                skip = False
+            elif arg in ("--size", "--output", "--baseline"):
+                skip = True
+            elif not arg.startswith(("--size=", "--output=", "--baseline=")):
+                command.append(arg)
+        result = subprocess.run(command + ["--size", str(size)], stdout=subprocess.PIPE, text=True)
+        if result.returncode != 0:
+            raise SystemExit(f"benchmark for size {size} failed with exit code {result.returncode}")
+        reports.extend(json.loads(result.stdout)["runs"])
+    return reports
+
+
+def flatten(report, prefix=""):
+    values = {}
+    for key, value in report.items():
+        path = f"{prefix}.{key}" if prefix else key
+        if isinstance(value, dict):
+            values.update(flatten(value, path))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            values[path] = value
+    return values
+
+
+# Print every timing, throughput and memory figure next to the same figure of an earlier report
+def compare(baseline, current):
+    compared = ("_ms", "seconds", "_qps", "_rps", "rss_mb")
+    baseline_runs = {run["config"]["size"]: run for run in baseline["runs"]}
+    for run in current["runs"]:
+        size = run["config"]["size"]
+        if size not in baseline_runs:
+            continue
+        before = flatten(baseline_runs[size])
+        after = flatten(run)
+        print(f"size {size}: {str(baseline_runs[size]['commit'])[:10]} -> {str(run['commit'])[:10]}", file=sys.stderr)
+        config = baseline_runs[size]["config"]
+        differing = sorted(key for key in set(config) | set(run["config"]) if config.get(key) != run["config"].get(key))
+        if differing:
+            print(f"  config differs: {', '.join(differing)}", file=sys.stderr)
+        for path, value in after.items():
+            if path.endswith(compared) and path in before:
+                change = f"{(value - before[path]) / before[path] * 100:+.1f}%" if before[path] else "n/a"
+                print(f"  {path:<55} {before[path]:>12} {value:>12} {change:>9}", file=sys.stderr)
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    args = parse_args(argv)
+    if len(args.size) > 1:
+        report = {"runs": run_sizes(args, argv)}
+    else:
+        report = {"runs": [run_size(args, args.size[0])]}
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        Path(args.output).write_text(output + "\n")
+    else:
+        print(output)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(json.load(f), report)
+    if not all(run["startup"]["ready"] for run in report["runs"]):
+        raise SystemExit(1)
+    for run in report["runs"]:
+        if "parity" in run and run["parity"]["parity"]["ranked_overlap"]["mean"] < args.min_overlap:
+            raise SystemExit(f"size {run['config']['size']}: mean ranked overlap "
+                             f"{run['parity']['parity']['ranked_overlap']['mean']} is below {args.min_overlap}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,310 @@
+# Synthetic charity catalog and an in-memory stand-in for the Supabase client used by server.py
+import bisect
+import io
+import pickle
+import random
+from datetime import datetime, timedelta
+
+# Focus areas roughly in order of how common they are; popularity follows a Zipf curve over this list
+FOCUS_AREAS = [
+    "Education", "Health", "Children", "Poverty", "Community Development", "Environment", "Hunger",
+    "Youth", "Animal Welfare", "Disaster Relief", "Mental Health", "Housing", "Homelessness",
+    "Women Empowerment", "Human Rights", "Medical Research", "Clean Water", "Arts and Culture",
+    "Veterans", "Refugees", "Climate", "Wildlife", "Elderly Care", "Disability", "Food Security",
+    "Military Families", "Job Training", "Literacy", "Ocean Conservation", "Cancer Research",
+    "Addiction Recovery", "Sports", "Faith", "Digital Inclusion", "Maternal Health", "Orphans",
+    "Immigration", "Racial Justice", "LGBTQ+ Rights", "Rural Development", "Microfinance",
+    "Forest Conservation", "Public Safety", "Domestic Violence", "Science Education", "Music",
+    "Sanitation", "Agriculture", "Heritage Preservation", "Armed Forces"
+]
+
+# Words each focus area pulls into a description, so TF-IDF and focus matching see related text
+AREA_VOCABULARY = {
+    "Education": "students schools teachers classrooms scholarships learning tutoring",
+    "Health": "clinics patients healthcare doctors nurses treatment wellness",
+    "Children": "kids children families childhood early development nutrition",
+    "Poverty": "low-income families poverty relief basic needs financial stability",
+    "Community Development": "neighborhoods local community centers volunteers infrastructure",
+    "Environment": "environmental protection recycling pollution green spaces sustainability",
+    "Hunger": "meals food banks pantries hungry families nutrition",
+    "Youth": "young people teens mentoring after-school programs leadership",
+    "Animal Welfare": "animals shelters dogs cats adoption rescue veterinary care",
+    "Disaster Relief": "emergency response disaster relief shelter supplies recovery",
+    "Mental Health": "counseling therapy mental health support crisis lines wellbeing",
+    "Housing": "affordable housing homes repairs tenants shelter",
+    "Homelessness": "homeless people shelters outreach transitional housing",
+    "Women Empowerment": "women girls leadership entrepreneurship equality",
+    "Human Rights": "rights advocacy justice freedom legal aid",
+    "Medical Research": "research scientists clinical trials cures disease",
+    "Clean Water": "clean water wells sanitation hygiene villages",
+    "Arts and Culture": "art artists theater museums culture creativity",
+    "Veterans": "veterans service members transition care benefits",
+    "Refugees": "refugees resettlement asylum displaced families integration",
+    "Climate": "climate change emissions renewable energy resilience",
+    "Wildlife": "wildlife habitats endangered species conservation",
+    "Elderly Care": "seniors elderly aging companionship home care",
+    "Disability": "disabilities accessibility inclusion assistive technology",
+    "Food Security": "food security farms gardens distribution",
+    "Military Families": "military families deployment spouses children support",
+    "Job Training": "job training employment skills careers apprenticeships",
+    "Literacy": "reading literacy books libraries adult education",
+    "Ocean Conservation": "oceans marine life coral reefs plastic cleanup",
+    "Cancer Research": "cancer research patients oncology survivors",
+    "Addiction Recovery": "addiction recovery treatment sobriety support groups",
+    "Sports": "sports teams athletes coaching fitness",
+    "Faith": "faith congregations ministry outreach",
+    "Digital Inclusion": "computers internet access digital skills coding",
+    "Maternal Health": "mothers pregnancy newborns maternal care midwives",
+    "Orphans": "orphans foster care adoption children homes",
+    "Immigration": "immigrants citizenship legal services integration",
+    "Racial Justice": "racial equity justice advocacy communities",
+    "LGBTQ+ Rights": "lgbtq equality support youth advocacy",
+    "Rural Development": "rural villages farmers infrastructure roads",
+    "Microfinance": "microloans small businesses entrepreneurs savings",
+    "Forest Conservation": "forests trees reforestation deforestation",
+    "Public Safety": "safety first responders prevention training",
+    "Domestic Violence": "survivors domestic violence safe shelter advocacy",
+    "Science Education": "science stem labs experiments students",
+    "Music": "music instruments lessons orchestras",
+    "Sanitation": "sanitation toilets hygiene waste",
+    "Agriculture": "agriculture farmers crops seeds irrigation",
+    "Heritage Preservation": "heritage history preservation monuments archives",
+    "Armed Forces": "armed forces soldiers troops service families"
+}
+
+SENTENCE_TEMPLATES = [
+    "We provide {a} and {b} for people in need.",
+    "Our mission is to support {a} through {b}.",
+    "Since our founding we have focused on {a}, {b} and lasting change.",
+    "Volunteers deliver {a} programs alongside {b} in our region.",
+    "Donations fund {a} as well as {b} for underserved communities.",
+    "We partner with local organizations on {a} and {b}."
+]
+
+NAME_PREFIXES = ["Hope", "Bright", "United", "Open", "Green", "Helping", "Global", "Community", "New", "First",
+                 "Harbor", "Unity", "Bridge", "Rising", "Blue", "Kind", "Star", "Future", "Heart", "Haven"]
+NAME_SUFFIXES = ["Foundation", "Trust", "Alliance", "Network", "Fund", "Society", "Project", "Initiative", "Collective", "Mission"]
+
+# Number of focus areas per charity and how likely each count is
+AREA_COUNT_WEIGHTS = {1: 0.3, 2: 0.35, 3: 0.2, 4: 0.1, 5: 0.05}
+
+
+# Rows of charity_donor, charity and charity_2 for a catalog of the given size
+def generate_catalog(size, seed=0, website_share=0.6, duplicate_share=0.01):
+    """Deterministic for a given size and seed; focus areas follow a Zipf curve and descriptions mix their vocabulary."""
+    rng = random.Random(seed)
+    area_weights = [1 / (rank + 1) for rank in range(len(FOCUS_AREAS))]
+    area_counts, count_weights = zip(*AREA_COUNT_WEIGHTS.items())
+    vocabulary = {area: words.split() for area, words in AREA_VOCABULARY.items()}
+    start = datetime(2023, 1, 1)
+
+    donors = []
+    for charity_id in range(1, size + 1):
+        areas = set()
+        target = rng.choices(area_counts, count_weights)[0]
+        while len(areas) < target:
+            areas.add(rng.choices(FOCUS_AREAS, area_weights)[0])
+        areas = sorted(areas, key=FOCUS_AREAS.index)
+
+        sentences = []
+        for _ in range(rng.randint(1, 8)):
+            words = vocabulary[rng.choice(areas)]
+            sentences.append(rng.choice(SENTENCE_TEMPLATES).format(
+                a=" ".join(rng.sample(words, min(2, len(words)))),
+                b=" ".join(rng.sample(words, min(2, len(words))))
+            ))
+
+        donors.append({
+            "charityId": charity_id,
+            "name": f"{rng.choice(NAME_PREFIXES)} {areas[0]} {rng.choice(NAME_SUFFIXES)}",
+            "description": " ".join(sentences),
+            "focusAreas": ", ".join(areas),
+            "updated_at": (start + timedelta(seconds=charity_id)).isoformat()
+        })
+
+    # A few charities appear twice, like rows re-imported into charity_donor
+    for _ in range(int(size * duplicate_share)):
+        donors.append(dict(rng.choice(donors)))
+    donors.sort(key=lambda row: row["charityId"])
+
+    # Website URLs are split across the two website tables, with some overlap and some blanks
+    charity, charity_2 = [], []
+    for charity_id in range(1, size + 1):
+        if rng.random() >= website_share:
+            continue
+        url = f"https://charity{charity_id}.example.org"
+        draw = rng.random()
+        if draw < 0.6:
+            charity.append({"id": charity_id, "website": url})
+        elif draw < 0.9:
+            charity_2.append({"id": charity_id, "websiteurl": url})
+        else:
+            charity.append({"id": charity_id, "website": ""})
+            charity_2.append({"id": charity_id, "websiteurl": url})
+
+    return {"charity_donor": donors, "charity": charity, "charity_2": charity_2}
+
+
+# Pickled surprise SVD trained on synthetic ratings, served as the model download; None without surprise
+def train_model_pickle(charity_ids, users=500, ratings_per_user=20, seed=0):
+    try:
+        import pandas as pd
+        from surprise import SVD, Dataset, Reader
+    except ImportError:
+        return None
+
+    rng = random.Random(seed)
+    ratings = [
+        (user_id, rng.choice(charity_ids), rng.randint(1, 5))
+        for user_id in range(1, users + 1)
+        for _ in range(ratings_per_user)
+    ]
+    frame = pd.DataFrame(ratings, columns=["user", "item", "rating"])
+    trainset = Dataset.load_from_df(frame, Reader(rating_scale=(1, 5))).build_full_trainset()
+    model = SVD(random_state=seed)
+    model.fit(trainset)
+    buffer = io.BytesIO()
+    pickle.dump(model, buffer)
+    return buffer.getvalue()
+
+
+# Stand-in for supabase.Client: the table queries and storage download server.py issues, answered from memory
+class StandInSupabase:
+    """Tables are lists of row dicts; files maps (bucket, name) to bytes."""
+
+    def __init__(self, tables, files=None, latency=0.0):
+        self.tables = {name: StandInTable(rows) for name, rows in tables.items()}
+        self.storage = StandInStorage(files or {})
+        # Seconds added to every request, to mimic the round trip to Supabase
+        self.latency = latency
+        self.requests = 0
+
+    def table(self, name):
+        if name not in self.tables:
+            raise KeyError(f"relation \"{name}\" does not exist")
+        return StandInQuery(self, self.tables[name])
+
+
+class StandInTable:
+    """Rows plus lazily built sort orders and id lookups, so paging a large table stays cheap."""
+
+    def __init__(self, rows):
+        self.rows = rows
+        self._orders = {}
+        self._positions = {}
+
+    def ordered(self, column):
+        """(sorted keys, rows) for a column, rows without a value left out."""
+        if column not in self._orders:
+            rows = sorted((row for row in self.rows if row.get(column) is not None), key=lambda row: row[column])
+            self._orders[column] = ([row[column] for row in rows], rows)
+        return self._orders[column]
+
+    def positions(self, column):
+        """value -> rows having it."""
+        if column not in self._positions:
+            index = {}
+            for row in self.rows:
+                index.setdefault(row.get(column), []).append(row)
+            self._positions[column] = index
+        return self._positions[column]
+
+
+class StandInQuery:
+    """The subset of the PostgREST query builder server.py uses: select, gt, gte, in_, order, range, limit."""
+
+    def __init__(self, client, table):
+        self.client = client
+        self.table = table
+        self.columns = None
+        self.greater = None
+        self.members = None
+        self.order_column = None
+        self.bounds = None
+
+    def select(self, columns="*"):
+        self.columns = None if columns.strip() == "*" else [column.strip() for column in columns.split(",")]
+        return self
+
+    def gt(self, column, value):
+        self.greater = (column, value, False)
+        return self
+
+    def gte(self, column, value):
+        self.greater = (column, value, True)
+        return self
+
+    def in_(self, column, values):
+        self.members = (column, set(values))
+        return self
+
+    def order(self, column, desc=False):
+        self.order_column = column
+        return self
+
+    def range(self, start, end):
+        self.bounds = (start, end + 1)
+        return self
+
+    def limit(self, count):
+        self.bounds = (0, count)
+        return self
+
+    def execute(self):
+        self.client.requests += 1
+        if self.client.latency:
+            import time
+            time.sleep(self.client.latency)
+
+        if self.columns is not None:
+            for column in self.columns:
+                if self.table.rows and column not in self.table.rows[0]:
+                    raise ValueError(f"column charity.{column} does not exist")
+
+        if self.members is not None:
+            column, values = self.members
+            positions = self.table.positions(column)
+            rows = [row for value in values for row in positions.get(value, [])]
+            if self.order_column is not None:
+                rows.sort(key=lambda row: row[self.order_column])
+        elif self.order_column is not None:
+            keys, rows = self.table.ordered(self.order_column)
+            if self.greater is not None and self.greater[0] == self.order_column:
+                column, value, inclusive = self.greater
+                rows = rows[(bisect.bisect_left if inclusive else bisect.bisect_right)(keys, value):]
+        else:
+            rows = self.table.rows
+
+        if self.greater is not None and (self.order_column != self.greater[0] or self.members is not None):
+            column, value, inclusive = self.greater
+            rows = [row for row in rows if row.get(column) is not None and (row[column] >= value if inclusive else row[column] > value)]
+
+        if self.bounds is not None:
+            rows = rows[self.bounds[0]:self.bounds[1]]
+        if self.columns is not None:
+            rows = [{column: row.get(column) for column in self.columns} for row in rows]
+        return StandInResponse(rows)
+
+
+class StandInResponse:
+    def __init__(self, data):
+        self.data = data
+
+
+class StandInStorage:
+    def __init__(self, files):
+        self.files = files
+
+    def from_(self, bucket):
+        return StandInBucket(self.files, bucket)
+
+
+class StandInBucket:
+    def __init__(self, files, bucket):
+        self.files = files
+        self.bucket = bucket
+
+    def download(self, name):
+        if (self.bucket, name) not in self.files:
+            raise FileNotFoundError(f"{self.bucket}/{name} not found")
+        return self.files[(self.bucket, name)]
@@ -1,34 +1,195 @@
-from fastapi import FastAPI, Query, HTTPException
+from fastapi import FastAPI, Query, HTTPException, Response, Header, Depends
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse
 import pandas as pd
 import pickle
 import spacy
+from spacy.tokens import Doc
 import re
 import math
 import time
-import random
+import secrets
 import Levenshtein
-from typing import List, Dict, Any, Optional
+from typing import List, Optional
 from pydantic import BaseModel, Field
 import numpy as np
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
+from sklearn.feature_extraction.text import TfidfVectorizer, ENGLISH_STOP_WORDS
+from sklearn.preprocessing import normalize
+from scipy.sparse import csr_matrix, vstack
 from supabase import create_client
 import os
+import sys
+import json
+import shutil
+import hashlib
+import array
+import itertools
+import asyncio
+import threading
+import multiprocessing
+import logging
+import gc
+import signal
+import socket
+import cProfile
+import pstats
+from contextlib import asynccontextmanager, contextmanager
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from multiprocessing import shared_memory
 from dotenv import load_dotenv
 from supabase import create_client
 from pathlib import Path
+from prometheus_client import Histogram, REGISTRY, generate_latest, CONTENT_TYPE_LATEST
+from prometheus_client.core import GaugeMetricFamily, CounterMetricFamily
+
+# pyarrow backs the local Parquet snapshot of the source rows; without it the snapshot is disabled
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
 
 # Load .env variables
 env_path = Path(__file__).resolve().parent / ".env.local"
 load_dotenv(dotenv_path=env_path)
 
+# Logging: LOG_LEVEL gates the output, LOG_FORMAT=json writes one JSON object per line for log shippers
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text").lower()
+
+# Log records as single-line JSON objects
+class JsonLogFormatter(logging.Formatter):
+    """Time, level, logger and message, plus the formatted exception when there is one."""
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "process": record.process,
+            "message": record.getMessage()
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+# The API's logger, with its own handler so uvicorn's logging setup does not change it
+def configure_logging():
+    api_logger = logging.getLogger("charity_api")
+    api_logger.setLevel(LOG_LEVEL)
+    if not api_logger.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(JsonLogFormatter() if LOG_FORMAT == "json" else
+                             logging.Formatter("%(asctime)s %(levelname)s [%(process)d] %(message)s"))
+        api_logger.addHandler(handler)
+    api_logger.propagate = False
+    return api_logger
+
+logger = configure_logging()
+
 # Get from environment
 SUPABASE_URL = os.getenv("NEXT_PUBLIC_SUPABASE_URL")
 SUPABASE_KEY = os.getenv("NEXT_PUBLIC_SUPABASE_ANON_KEY")
 
-# Initialize Supabase client
-supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
+# Supabase client, created on first use by the startup loader
+supabase = None
+
+def get_supabase():
+    global supabase
+    if supabase is None:
+        supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
+    return supabase
+
+# Worker pool settings for /predict
+# "thread" shares the loaded data with the event loop process, "process" forks workers that inherit it
+PREDICT_EXECUTOR = os.getenv("PREDICT_EXECUTOR", "thread").lower()
+PREDICT_WORKERS = int(os.getenv("PREDICT_WORKERS", str(min(8, os.cpu_count() or 1))))
+# Requests allowed to wait for a free worker before we start answering 429
+PREDICT_MAX_QUEUE = int(os.getenv("PREDICT_MAX_QUEUE", "32"))
+# Seconds a request may wait for its result before we answer 504
+PREDICT_TIMEOUT = float(os.getenv("PREDICT_TIMEOUT", "15"))
+# Limits for /predict/batch, which runs as one job on the pool
+MAX_BATCH_QUERIES = int(os.getenv("MAX_BATCH_QUERIES", "500"))
+PREDICT_BATCH_TIMEOUT = float(os.getenv("PREDICT_BATCH_TIMEOUT", "120"))
+
+# Prefork serving (python server.py --preload): the master loads every component once, then forks the workers
+SERVE_HOST = os.getenv("SERVE_HOST", "127.0.0.1")
+SERVE_PORT = int(os.getenv("SERVE_PORT", "5000"))
+SERVE_WORKERS = int(os.getenv("SERVE_WORKERS", str(os.cpu_count() or 1)))
+
+# Token expected in the X-Admin-Token header of the /admin endpoints; unset disables them
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+# Where /admin/profile writes its cProfile captures
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+PROFILE_MAX_REQUESTS = int(os.getenv("PROFILE_MAX_REQUESTS", "1000"))
+
+# Persisted search artifact (catalog, fitted vectorizer, TF-IDF matrix, focus-area index)
+ARTIFACT_DIR = os.getenv("ARTIFACT_DIR", "artifacts")
+# Number of artifact versions kept on disk
+ARTIFACT_KEEP = int(os.getenv("ARTIFACT_KEEP", "3"))
+# Bump whenever the artifact layout or anything baked into it changes
+ARTIFACT_VERSION = 3
+# "sklearn" fits TfidfVectorizer (float64 matrix, dict vocabulary); "compact" fits CompactTfidfVectorizer
+# (float32 matrix, memory-mapped sorted vocabulary as UTF-8 bytes and offsets, pruned n-gram counting)
+VECTORIZER_MODE = os.getenv("VECTORIZER_MODE", "sklearn").lower()
+# Source columns that feed the artifact, and so its content hash
+CATALOG_SOURCE_COLUMNS = ["charityId", "name", "description", "focusAreas", "website"]
+# Columns selected from charity_donor (the watermark column is added when the table has it)
+CATALOG_DONOR_COLUMNS = ["charityId", "name", "description", "focusAreas"]
+# Website column selected from each website table, in order of precedence
+WEBSITE_TABLE_COLUMNS = {"charity": "website", "charity_2": "websiteurl"}
+# Rows per Supabase range request when paging through the source tables
+CATALOG_PAGE_SIZE = int(os.getenv("CATALOG_PAGE_SIZE", "1000"))
+# charityIds per in_ filter when fetching the websites of changed rows, to stay under the URL length limit
+WEBSITE_ID_CHUNK_SIZE = int(os.getenv("WEBSITE_ID_CHUNK_SIZE", "200"))
+# Local Parquet copy of the last fetched source rows, served when Supabase cannot be reached ("" disables it)
+CATALOG_SNAPSHOT_PATH = os.getenv("CATALOG_SNAPSHOT_PATH", str(Path(ARTIFACT_DIR) / "source-snapshot.parquet"))
+
+# Split catalog scoring across this many worker processes (0 or 1 scores in the request's own worker)
+CATALOG_SHARDS = int(os.getenv("CATALOG_SHARDS", "0"))
+
+# Optional dense retrieval over averaged spaCy word vectors, blended into the semantic score
+DENSE_RETRIEVAL = os.getenv("DENSE_RETRIEVAL", "false").lower() in ("1", "true", "yes")
+# Embedding storage: "float32", or "int8" with a per-row scale for a quarter of the memory
+DENSE_QUANTIZATION = os.getenv("DENSE_QUANTIZATION", "float32").lower()
+# IVF lists (0 picks the square root of the catalog size) and lists probed per query
+DENSE_NLIST = int(os.getenv("DENSE_NLIST", "0"))
+DENSE_NPROBE = int(os.getenv("DENSE_NPROBE", "8"))
+# Share of the semantic score taken from the dense similarity, and the similarity below which dense hits are ignored
+DENSE_WEIGHT = float(os.getenv("DENSE_WEIGHT", "0.3"))
+DENSE_MIN_SIMILARITY = float(os.getenv("DENSE_MIN_SIMILARITY", "0.5"))
+
+# Ranking boosts from a charity's static features, folded into one factor per charity when the catalog is built
+# Charities with a website (indicates legitimacy)
+WEBSITE_BOOST = float(os.getenv("WEBSITE_BOOST", "1.08"))
+# [min length, boost] pairs for longer, more detailed descriptions; the first length a description exceeds applies
+DESCRIPTION_LENGTH_BOOSTS = json.loads(os.getenv("DESCRIPTION_LENGTH_BOOSTS", "[[300, 1.05], [150, 1.03]]"))
+# Charities with at least this many focus areas (more comprehensive)
+MULTI_FOCUS_MIN_AREAS = int(os.getenv("MULTI_FOCUS_MIN_AREAS", "3"))
+MULTI_FOCUS_BOOST = float(os.getenv("MULTI_FOCUS_BOOST", "1.04"))
+# Boosts for charities in a category when the query mentions it: a query containing any of query_terms
+# boosts the charities with any of focus_areas (case-insensitive) by boost
+DEFAULT_CATEGORY_BOOSTS = [{
+    "name": "veterans",
+    "query_terms": ["veteran", "veterans", "military", "service member", "armed forces"],
+    "focus_areas": ["veterans", "military", "armed forces"],
+    "boost": 1.25
+}]
+CATEGORY_BOOSTS = json.loads(os.getenv("CATEGORY_BOOSTS", "null")) or DEFAULT_CATEGORY_BOOSTS
+
+# Background catalog refresh: seconds between incremental syncs (0 disables the task)
+CATALOG_REFRESH_INTERVAL = float(os.getenv("CATALOG_REFRESH_INTERVAL", "300"))
+# Seconds between full refits of the vectorizer and indexes (0 disables them)
+CATALOG_FULL_REFIT_INTERVAL = float(os.getenv("CATALOG_FULL_REFIT_INTERVAL", "86400"))
+# Column compared against the last sync; without it only new charityIds are picked up
+CATALOG_WATERMARK_COLUMN = os.getenv("CATALOG_WATERMARK_COLUMN", "updated_at")
+
+# Failed startup stages are retried after STARTUP_RETRY_SECONDS, doubling up to STARTUP_RETRY_MAX_SECONDS
+STARTUP_RETRY_SECONDS = float(os.getenv("STARTUP_RETRY_SECONDS", "5"))
+STARTUP_RETRY_MAX_SECONDS = float(os.getenv("STARTUP_RETRY_MAX_SECONDS", "300"))
+# Attempts before startup gives up and /health/live fails so the replica is restarted (0 retries forever)
+STARTUP_MAX_ATTEMPTS = int(os.getenv("STARTUP_MAX_ATTEMPTS", "10"))
 
 # Define the response models
 class CharityMatch(BaseModel):
@@ -47,11 +208,43 @@ class Charity(BaseModel):
     match_details: CharityMatch
     website: Optional[str] = Field(None, description="Charity website URL")
 
+# Request and response models for batched predictions
+class BatchQuery(BaseModel):
+    query: str = Field(..., min_length=1, description="The cause or interest")
+    top_n: int = Field(8, ge=1, le=20, description="Number of results to return")
+    randomize: bool = Field(True, description="Whether to add randomization to results")
+    user_id: Optional[int] = Field(None, description="Personalize model scores for this user")
+    seed: Optional[int] = Field(None, ge=0, description="Seed for the randomization, to replay a previous result")
+
+class BatchPredictRequest(BaseModel):
+    queries: List[BatchQuery] = Field(..., min_length=1, max_length=MAX_BATCH_QUERIES)
+
+class BatchPredictResult(BaseModel):
+    query: str
+    seed: int = Field(..., description="Seed the randomization used, pass it back to replay this result")
+    recommendations: List[Charity]
+
+# Set in workers forked by PreforkMaster, which refreshes the catalog for them
+preforked_worker = False
+
+# Heavy initialization runs in the background once the server is up, see StartupLoader
+@asynccontextmanager
+async def lifespan(app):
+    startup_loader.start()
+    refresh_task = asyncio.create_task(catalog_refresher.run()) if CATALOG_REFRESH_INTERVAL > 0 and not preforked_worker else None
+    yield
+    if refresh_task is not None:
+        refresh_task.cancel()
+    predict_pool.shutdown()
+    shutdown_shard_pool()
+    close_catalog_shards()
+
 # Initialize FastAPI app
 app = FastAPI(
     title="Advanced Charity Recommendation API",
     description="Enhanced API for precise charity recommendations based on user interests",
-    version="2.0.0"
+    version="2.0.0",
+    lifespan=lifespan
 )
 
 # Configure CORS
@@ -63,215 +256,1749 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Load and preprocess data only once at startup
-print("Loading and preprocessing data...")
-# With this:
-print("Fetching data from Supabase...")
-try:
-    # Query all data from the charity_donor table
-    response = supabase.table("charity_donor").select("*").execute()
+# Latency of the prediction endpoints, including requests rejected or timed out by the worker pool
+OBSERVED_PATHS = {"/predict": "predict", "/predict/batch": "predict_batch"}
 
-    # Convert the response data to a DataFrame
-    df = pd.DataFrame(response.data)
-
-    # Also try to fetch data from the charity table which might have website URLs
+@app.middleware("http")
+async def observe_request_latency(request, call_next):
+    endpoint = OBSERVED_PATHS.get(request.url.path)
+    if endpoint is None:
+        return await call_next(request)
+    start = time.perf_counter()
+    status = 500
     try:
-        charity_response = supabase.table("charity").select("*").execute()
-        charity_df = pd.DataFrame(charity_response.data)
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        request_seconds.labels(endpoint, str(status)).observe(time.perf_counter() - start)
+
+# Precompiled matcher over the focus-area index, built once at startup
+class FocusAreaMatcher:
+    """Answers the exact, whole-word, fuzzy and partial lookups of match_focus_areas without scanning every area."""
+
+    NGRAM_SIZE = 3
+
+    def __init__(self, focus_area_index):
+        # Areas keep the index's insertion order so scores accumulate exactly as the full scan did
+        self.areas = list(focus_area_index.keys())
+        self.area_ids = {area: area_id for area_id, area in enumerate(self.areas)}
+        self.postings = [focus_area_index[area] for area in self.areas]
+
+        # Whole-word hits: word token -> areas containing that token
+        self.token_index = {}
+        # Partial hits: character n-gram -> areas containing that n-gram
+        self.ngram_index = {}
+        for area_id, area in enumerate(self.areas):
+            for token in set(re.findall(r'\w+', area)):
+                self.token_index.setdefault(token, []).append(area_id)
+            for gram in self._ngrams(area):
+                self.ngram_index.setdefault(gram, []).append(area_id)
+
+        # Bounded edit distance: BK-tree of [area_id, {distance: child}] nodes
+        self.bk_root = None
+        for area_id in range(len(self.areas)):
+            self._bk_insert(area_id)
+
+    def to_state(self):
+        """Plain-container state for persisting, independent of the module the class was loaded from."""
+        return dict(self.__dict__)
+
+    @classmethod
+    def from_state(cls, state):
+        matcher = cls.__new__(cls)
+        matcher.__dict__.update(state)
+        return matcher
+
+    def with_index(self, focus_area_index):
+        """Matcher for an updated index; the lookup structures are shared unless new areas appeared."""
+        new_areas = [area for area in focus_area_index if area not in self.area_ids]
+        if new_areas:
+            # Known areas keep their order, areas no longer used by any charity keep empty postings
+            return FocusAreaMatcher({area: focus_area_index.get(area, []) for area in self.areas + new_areas})
+        matcher = FocusAreaMatcher.from_state(self.to_state())
+        matcher.postings = [focus_area_index.get(area, []) for area in self.areas]
+        return matcher
+
+    def _ngrams(self, text):
+        return {text[i:i + self.NGRAM_SIZE] for i in range(len(text) - self.NGRAM_SIZE + 1)}
+
+    def _bk_insert(self, area_id):
+        if self.bk_root is None:
+            self.bk_root = [area_id, {}]
+            return
+        area = self.areas[area_id]
+        node = self.bk_root
+        while True:
+            distance = Levenshtein.distance(area, self.areas[node[0]])
+            child = node[1].get(distance)
+            if child is None:
+                node[1][distance] = [area_id, {}]
+                return
+            node = child
+
+    def substring_matches(self, term):
+        """Area ids whose text contains term (term must be at least NGRAM_SIZE long)."""
+        grams = self._ngrams(term)
+        if not grams:
+            return []
+        postings = sorted((self.ngram_index.get(gram, ()) for gram in grams), key=len)
+        candidates = set(postings[0])
+        for posting in postings[1:]:
+            if not candidates:
+                break
+            candidates.intersection_update(posting)
+        return sorted(area_id for area_id in candidates if term in self.areas[area_id])
+
+    def word_matches(self, term, substring_hits):
+        """Area ids where term appears as a whole word, i.e. re.search(r'\\bterm\\b', area) succeeds."""
+        if re.fullmatch(r'\w+', term):
+            return sorted(self.token_index.get(term, ()))
+        pattern = re.compile(r'\b' + re.escape(term) + r'\b')
+        return [area_id for area_id in substring_hits if pattern.search(self.areas[area_id])]
+
+    def fuzzy_matches(self, term, max_distance):
+        """(area_id, distance) pairs within max_distance edits of term, excluding the term itself."""
+        if self.bk_root is None:
+            return []
+        results = []
+        stack = [self.bk_root]
+        while stack:
+            area_id, children = stack.pop()
+            distance = Levenshtein.distance(term, self.areas[area_id])
+            if distance <= max_distance and self.areas[area_id] != term:
+                results.append((area_id, distance))
+            # Triangle inequality: only subtrees within max_distance of this node's distance can match
+            for edge, child in children.items():
+                if distance - max_distance <= edge <= distance + max_distance:
+                    stack.append(child)
+        results.sort()
+        return results
+
+    def match(self, term):
+        """(area_id, score factor) pairs for term using the same weights as the original scan."""
+        hits = []
 
-        # If we have charity data, merge it with our main dataframe
-        if not charity_df.empty and 'id' in charity_df.columns:
-            # Rename id to charityId for consistency
-            charity_df = charity_df.rename(columns={'id': 'charityId'})
+        # Exact match lookup (highest weight)
+        area_id = self.area_ids.get(term)
+        if area_id is not None:
+            hits.append((area_id, 1.0))
 
-            # Merge the dataframes, keeping all rows from df
-            if 'charityId' in df.columns:
-                df = pd.merge(df, charity_df[['charityId', 'website']], on='charityId', how='left')
-    except Exception as e:
-        print(f"Error fetching charity data: {e}")
+        # Word boundary match (medium weight)
+        substring_hits = self.substring_matches(term)
+        word_hits = self.word_matches(term, substring_hits)
+        hits.extend((area_id, 0.8) for area_id in word_hits)
+
+        # Fuzzy matching, only for terms of sufficient length to avoid false matches
+        if len(term) >= 4:
+            max_distance = min(3, len(term) // 3)  # Adaptive threshold based on term length
+            for area_id, distance in self.fuzzy_matches(term, max_distance):
+                similarity = 1.0 - (distance / (len(term) + 1))
+                hits.append((area_id, 0.7 * similarity))
+
+        # Partial match lookup (lowest weight), substring hits that are not whole words
+        if len(term) >= 5:
+            word_hit_set = set(word_hits)
+            hits.extend((area_id, 0.4) for area_id in substring_hits if area_id not in word_hit_set)
+
+        return hits
+
+# Collaborative-filtering scores for the whole catalog, extracted from the pickled model at load time
+class CollaborativeScorer:
+    """Serves best_model.predict(user_id, charity_id).est for every charity as a NumPy vector."""
+
+    def __init__(self, model, catalog, default_user_id=1, user_cache_size=256):
+        self.model = model
+        self.charity_ids = catalog.charity_ids
+        self.row_of = catalog.row_of
+        self.default_user_id = default_user_id
+        self.user_cache_size = user_cache_size
+        self._user_cache = OrderedDict()
+        self._lock = threading.Lock()
+
+        # Matrix-factorization models (SVD, NMF) expose their factors and biases, so a user's
+        # scores for every charity reduce to one matrix-vector product
+        self.is_factor_model = model is not None and all(
+            hasattr(model, attr) for attr in ("trainset", "pu", "qi", "bu", "bi", "biased")
+        ) and not hasattr(model, "yj")
+
+        if self.is_factor_model:
+            trainset = model.trainset
+            self.global_mean = trainset.global_mean
+            self.lower_bound, self.higher_bound = trainset.rating_scale
+
+            # Inner item id for each catalog row, -1 when the model never saw that charity
+            item_rows = np.array([self._inner_id(trainset.to_inner_iid, cid) for cid in self.charity_ids], dtype=np.int64)
+            self.known_items = item_rows >= 0
+            safe_rows = np.where(self.known_items, item_rows, 0)
+            self.item_factors = np.asarray(model.qi)[safe_rows] if len(item_rows) else np.zeros((0, 0))
+            self.item_biases = np.where(self.known_items, np.asarray(model.bi)[safe_rows], 0.0) if len(item_rows) else np.zeros(0)
+
+        # The anonymous default user is scored once up front; other models are scored lazily, row by row
+        self.default_scores = self._compute_scores(default_user_id) if self.is_factor_model or model is None else None
+
+    @staticmethod
+    def _inner_id(to_inner, raw_id):
+        try:
+            return to_inner(raw_id)
+        except ValueError:
+            return -1
+
+    def _compute_scores(self, user_id):
+        if self.model is None:
+            return np.full(len(self.charity_ids), 0.5)
+
+        # Mirrors the model's estimate(): biases for whatever is known, factors only when both are known
+        model = self.model
+        user_row = self._inner_id(model.trainset.to_inner_uid, user_id)
+        known_user = user_row >= 0
+        if model.biased:
+            scores = np.full(len(self.charity_ids), self.global_mean)
+            if known_user:
+                scores += model.bu[user_row]
+            scores += self.item_biases
+            if known_user:
+                scores += np.where(self.known_items, self.item_factors @ np.asarray(model.pu[user_row]), 0.0)
+        else:
+            # Unknown user or item is a PredictionImpossible, which predict() answers with the global mean
+            scores = np.full(len(self.charity_ids), self.global_mean)
+            if known_user:
+                scores = np.where(self.known_items, self.item_factors @ np.asarray(model.pu[user_row]), scores)
+
+        # predict() clips estimates into the rating scale
+        return np.clip(scores, self.lower_bound, self.higher_bound)
+
+    def scores_for(self, user_id=None):
+        """Model score per catalog row for user_id (the default user when None)."""
+        if self.default_scores is None:
+            return self.scores_for_rows(np.arange(len(self.charity_ids)), user_id)
+        if user_id is None or user_id == self.default_user_id:
+            return self.default_scores
+
+        with self._lock:
+            scores = self._user_cache.get(user_id)
+            if scores is not None:
+                self._user_cache.move_to_end(user_id)
+                return scores
+
+        scores = self._compute_scores(user_id)
+        with self._lock:
+            self._user_cache[user_id] = scores
+            if len(self._user_cache) > self.user_cache_size:
+                self._user_cache.popitem(last=False)
+        return scores
+
+    def scores_for_rows(self, rows, user_id=None):
+        """Model scores for the given catalog rows, gathered from the per-user score vector."""
+        if self.default_scores is None:
+            return self._predict_rows(rows, user_id)
+        return self.scores_for(user_id)[rows]
+
+    def _predict_rows(self, rows, user_id):
+        # Models without a closed form here are asked per charity, and each user's answers are cached by row
+        user_id = self.default_user_id if user_id is None else user_id
+        with self._lock:
+            predicted = self._user_cache.get(user_id)
+            if predicted is None:
+                predicted = self._user_cache[user_id] = {}
+                if len(self._user_cache) > self.user_cache_size:
+                    self._user_cache.popitem(last=False)
+            else:
+                self._user_cache.move_to_end(user_id)
+
+        scores = np.full(len(rows), 0.5)
+        for i, row in enumerate(rows.tolist()):
+            score = predicted.get(row)
+            if score is None:
+                charity_id = self.charity_ids[row]
+                try:
+                    score = predicted[row] = self.model.predict(user_id, charity_id).est
+                except Exception as model_error:
+                    logger.warning("Model prediction error for charity %s: %s", charity_id, model_error)
+                    continue
+            scores[i] = score
+        return scores
+
+# Column-oriented charity catalog used by the scoring path
+class CharityCatalog:
+    """Charity data held as NumPy arrays and one list per text field, indexed by row."""
+
+    def __init__(self, charity_ids, names, descriptions, focus_areas, websites):
+        self.charity_ids = np.asarray(charity_ids, dtype=np.int64)
+        self.names = names
+        # Descriptions are kept once, already cleaned of missing values
+        self.descriptions = descriptions
+        # Tuples of interned strings, so repeated focus areas share one object
+        self.focus_areas = focus_areas
+        self.websites = websites
+
+        # Static per-charity features used by the ranking boosts
+        self.description_lengths = np.fromiter((len(d) for d in descriptions), dtype=np.int32, count=len(descriptions))
+        self.focus_counts = np.fromiter((len(f) for f in focus_areas), dtype=np.int32, count=len(focus_areas))
+        self.has_website = np.fromiter((bool(w) for w in websites), dtype=bool, count=len(websites))
+        # Product of the static boosts, and one column per CATEGORY_BOOSTS entry flagging the charities it boosts
+        self.static_boosts = static_boost_factors(self.description_lengths, self.focus_counts, self.has_website)
+        self.category_flags = category_boost_flags(focus_areas)
+
+        # charityId -> row; the last row wins for duplicated ids
+        self.row_of = {int(charity_id): row for row, charity_id in enumerate(self.charity_ids)}
+
+    @classmethod
+    def from_frame(cls, frame):
+        """Build the catalog from the merged Supabase DataFrame."""
+        descriptions = frame['description'].fillna('').astype(str).tolist()
+        focus_areas = [
+            tuple(sys.intern(area.strip()) for area in text.split(',') if area.strip())
+            for text in frame['focusAreas'].fillna('').astype(str)
+        ]
+        websites = [
+            website if isinstance(website, str) and website else None
+            for website in (frame['website'] if 'website' in frame.columns else [None] * len(frame))
+        ]
+        return cls(frame['charityId'].to_numpy(), frame['name'].tolist(), descriptions, focus_areas, websites)
+
+    @classmethod
+    def concat(cls, *catalogs):
+        """Rows of every catalog, in the order given."""
+        return cls(
+            np.concatenate([catalog.charity_ids for catalog in catalogs]),
+            [name for catalog in catalogs for name in catalog.names],
+            [description for catalog in catalogs for description in catalog.descriptions],
+            [areas for catalog in catalogs for areas in catalog.focus_areas],
+            [website for catalog in catalogs for website in catalog.websites]
+        )
+
+    def deduplicated(self):
+        """Catalog with one row per charityId, the last one, which is the row row_of already resolves to."""
+        if len(self.row_of) == len(self):
+            return self
+        return self.take(sorted(self.row_of.values()))
+
+    def take(self, rows):
+        """Catalog holding only the given rows, in order."""
+        return CharityCatalog(
+            self.charity_ids[rows],
+            [self.names[row] for row in rows],
+            [self.descriptions[row] for row in rows],
+            [self.focus_areas[row] for row in rows],
+            [self.websites[row] for row in rows]
+        )
+
+    def __len__(self):
+        return len(self.charity_ids)
+
+    def unique_ids(self):
+        """Distinct charityIds in first-seen order."""
+        return list(self.row_of.keys())
+
+    def combined_text(self, row):
+        """Description plus focus areas, the text the TF-IDF matrix is built from."""
+        return self.descriptions[row] + ' ' + ', '.join(self.focus_areas[row])
+
+    def build_focus_area_index(self):
+        """Lowercased focus area -> [(charityId, row), ...]."""
+        focus_area_index = {}
+        for row, areas in enumerate(self.focus_areas):
+            charity_id = self.charity_ids[row]
+            for area in areas:
+                focus_area_index.setdefault(sys.intern(area.lower()), []).append((charity_id, row))
+        return focus_area_index
+
+    def save(self, path):
+        """Write the catalog into an artifact directory; ids go to .npy so they can be memory-mapped."""
+        np.save(path / "charity_ids.npy", self.charity_ids)
+        with open(path / "catalog_text.pkl", "wb") as f:
+            pickle.dump((self.names, self.descriptions, self.focus_areas, self.websites), f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load(cls, path):
+        charity_ids = np.load(path / "charity_ids.npy", mmap_mode="r")
+        with open(path / "catalog_text.pkl", "rb") as f:
+            names, descriptions, focus_areas, websites = pickle.load(f)
+        return cls(charity_ids, names, descriptions, focus_areas, websites)
+
+    def recommendation(self, row, relevance_score, match_details):
+        """Response dict for one charity row."""
+        return {
+            "charityId": int(self.charity_ids[row]),
+            "name": self.names[row],
+            "description": self.descriptions[row],
+            "focus_areas": list(self.focus_areas[row]),
+            "relevance_score": float(relevance_score),
+            "match_details": match_details,
+            "website": self.websites[row]
+        }
 
-    # Also try to fetch data from the charity_2 table which might have website URLs
+# Website, description-length and focus-count boosts multiplied into one factor per charity
+def static_boost_factors(description_lengths, focus_counts, has_website):
+    website_boosts = np.where(has_website, WEBSITE_BOOST, 1.0)
+    description_boosts = np.select(
+        [description_lengths > min_length for min_length, _ in DESCRIPTION_LENGTH_BOOSTS],
+        [boost for _, boost in DESCRIPTION_LENGTH_BOOSTS],
+        1.0
+    )
+    focus_boosts = np.where(focus_counts >= MULTI_FOCUS_MIN_AREAS, MULTI_FOCUS_BOOST, 1.0)
+    return website_boosts * description_boosts * focus_boosts
+
+# Which charities each category boost applies to, from their focus areas
+def category_boost_flags(focus_areas):
+    flags = np.zeros((len(focus_areas), len(CATEGORY_BOOSTS)), dtype=bool)
+    for column, category in enumerate(CATEGORY_BOOSTS):
+        category_areas = {area.lower() for area in category["focus_areas"]}
+        flags[:, column] = [any(area.lower() in category_areas for area in areas) for areas in focus_areas]
+    return flags
+
+# Category boosts whose query terms appear in the query, as indexes into CATEGORY_BOOSTS
+def query_boost_categories(user_input):
+    # The normalized text the result cache is keyed on, so every input sharing an entry gets the same boosts
+    text = normalize_query(user_input)
+    return [i for i, category in enumerate(CATEGORY_BOOSTS) if any(term in text for term in category["query_terms"])]
+
+# Initialize the TF-IDF vectorizer configuration
+def create_tfidf_vectorizer():
+    return TfidfVectorizer(
+        min_df=1,  # Changed from 2 to 1 to include more rare terms
+        max_df=0.9,  # Reduced from 0.95 to 0.9 to filter out more common terms
+        max_features=8000,  # Increased from 5000 to 8000 for better coverage
+        strip_accents='unicode',
+        analyzer='word',
+        token_pattern=r'\w{2,}',  # Changed to require at least 2 characters
+        ngram_range=(1, 3),  # Increased back to (1, 3) for better phrase matching
+        stop_words='english',
+        use_idf=True,  # Explicitly enable IDF weighting
+        smooth_idf=True,  # Apply smoothing to IDF weights
+        sublinear_tf=True  # Apply sublinear tf scaling (log scaling)
+    )
+
+# Sorted n-grams packed into one UTF-8 byte buffer, looked up by binary search
+class NgramVocabulary:
+    """The position of an n-gram is its feature column; one byte per character instead of a fixed-width array."""
+
+    def __init__(self, data, offsets):
+        # n-gram i is data[offsets[i]:offsets[i + 1]]
+        self.data = data
+        self.offsets = offsets
+        # The binary search indexes memoryviews, which is much cheaper than slicing (memory-mapped) arrays
+        self._data = memoryview(data)
+        self._offsets = memoryview(offsets)
+
+    def __reduce__(self):
+        return (NgramVocabulary, (np.asarray(self.data), np.asarray(self.offsets)))
+
+    @classmethod
+    def from_sorted(cls, texts):
+        """Pack n-grams already sorted by code point, which is also the byte order of their UTF-8 encoding."""
+        encoded = [text.encode() for text in texts]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(text) for text in encoded])
+        return cls(np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, column):
+        return self._bytes(column).decode()
+
+    def __iter__(self):
+        return (self[column] for column in range(len(self)))
+
+    def _bytes(self, column):
+        return self._data[self._offsets[column]:self._offsets[column + 1]].tobytes()
+
+    def index(self, text):
+        """Column of an n-gram, -1 when it is not in the vocabulary."""
+        key = text.encode()
+        low, high = 0, len(self)
+        while low < high:
+            middle = (low + high) // 2
+            if self._bytes(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low if low < len(self) and self._bytes(low) == key else -1
+
+    def columns(self, texts):
+        """Column of every n-gram in texts, -1 for the ones not in the vocabulary."""
+        found = {}
+        return np.array([found[text] if text in found else found.setdefault(text, self.index(text)) for text in texts],
+                        dtype=np.int64)
+
+    def save(self, path):
+        np.save(Path(path) / "vocabulary_data.npy", self.data)
+        np.save(Path(path) / "vocabulary_offsets.npy", self.offsets)
+
+    @classmethod
+    def load(cls, path):
+        return cls(np.load(Path(path) / "vocabulary_data.npy", mmap_mode="r"),
+                   np.load(Path(path) / "vocabulary_offsets.npy", mmap_mode="r"))
+
+# TF-IDF with the analyzer and weighting of create_tfidf_vectorizer, for VECTORIZER_MODE=compact
+class CompactTfidfVectorizer:
+    """NgramVocabulary as the vocabulary and float32 output; the fit counts n-grams as integer keys, level by level."""
+
+    # Documents whose windows are counted together, which bounds the transient key arrays of the fit
+    CHUNK_DOCS = 10000
+
+    def __init__(self, vocabulary=None, idf=None):
+        template = create_tfidf_vectorizer()
+        self.params = template.get_params()
+        self._preprocess = template.build_preprocessor()
+        self._tokenize = template.build_tokenizer()
+        self._stop_words = template.get_stop_words() or frozenset()
+        # NgramVocabulary; the position of an n-gram is its feature column
+        self.vocabulary = vocabulary
+        self.idf = idf
+
+    def __reduce__(self):
+        # The analyzer closures do not pickle; they are rebuilt from the settings
+        return (CompactTfidfVectorizer, (self.vocabulary, self.idf))
+
+    def tokens(self, text):
+        """Words of a document, stop words removed, as sklearn's word analyzer produces them."""
+        return [token for token in self._tokenize(self._preprocess(text)) if token not in self._stop_words]
+
+    def ngrams(self, tokens):
+        min_n, max_n = self.params["ngram_range"]
+        return [" ".join(tokens[i:i + n]) for n in range(min_n, max_n + 1) for i in range(len(tokens) - n + 1)]
+
+    def fit_transform(self, documents):
+        """Fit on the documents and return their (documents x features) float32 matrix."""
+        # Every document as word ids, 4 bytes per word instead of the n-gram strings sklearn counts
+        word_ids = {}
+        ids = array.array("i")
+        lengths = array.array("i")
+        for document in documents:
+            tokens = self.tokens(document)
+            ids.extend(word_ids.setdefault(token, len(word_ids)) for token in tokens)
+            lengths.append(len(tokens))
+        tokens = np.frombuffer(ids, dtype=np.int32)
+        lengths = np.frombuffer(lengths, dtype=np.int32)
+        words = np.empty(len(word_ids), dtype=object)
+        words[list(word_ids.values())] = list(word_ids.keys())
+        del word_ids
+
+        doc_count = len(lengths)
+        doc_of = np.repeat(np.arange(doc_count, dtype=np.int32), lengths)
+        offsets = np.concatenate([[0], np.cumsum(lengths, dtype=np.int64)])
+        chunks = [(offsets[start], offsets[min(start + self.CHUNK_DOCS, doc_count)])
+                  for start in range(0, doc_count, self.CHUNK_DOCS)]
+
+        min_n, max_n = self.params["ngram_range"]
+        max_df, min_df, max_features = self.params["max_df"], self.params["min_df"], self.params["max_features"]
+        max_doc_count = max_df if isinstance(max_df, int) else max_df * doc_count
+        min_doc_count = min_df if isinstance(min_df, int) else min_df * doc_count
+
+        # Per n: sorted keys with their term and document frequencies, and the keys kept for extension to n + 1.
+        # An n-gram occurs at most as often as either (n - 1)-gram inside it, so once max_features candidates
+        # reach a count, the longer n-grams of rarer (n - 1)-grams can never be selected and are not counted.
+        levels = []
+        threshold = 1
+        for n in range(1, max_n + 1):
+            keys, tfs, dfs = self._count_windows(tokens, doc_of, chunks, levels, len(words), n)
+            levels.append({"keys": keys, "tf": tfs, "df": dfs})
+            candidates = np.concatenate([
+                level["tf"][(level["df"] >= min_doc_count) & (level["df"] <= max_doc_count)]
+                for m, level in enumerate(levels, start=1) if m >= min_n
+            ] or [np.zeros(0, dtype=np.int64)])
+            if max_features is not None and candidates.size > max_features:
+                threshold = max(threshold, int(np.partition(candidates, -max_features)[-max_features]))
+            levels[-1]["kept"] = keys[tfs >= threshold]
+
+        # Top max_features n-grams by term frequency, ties broken alphabetically
+        selected = []
+        for n, level in enumerate(levels, start=1):
+            if n < min_n:
+                continue
+            mask = (level["df"] >= min_doc_count) & (level["df"] <= max_doc_count) & (level["tf"] >= threshold)
+            for index, text in zip(np.flatnonzero(mask), self._key_texts(levels, n, level["keys"][mask], words)):
+                selected.append((-int(level["tf"][index]), text, n, int(level["keys"][index]), int(level["df"][index])))
+        selected.sort()
+        if max_features is not None:
+            selected = selected[:max_features]
+
+        selected.sort(key=lambda item: item[1])
+        self.vocabulary = NgramVocabulary.from_sorted([text for _, text, _, _, _ in selected])
+        columns = {(n, key): column for column, (_, _, n, key, _) in enumerate(selected)}
+        dfs = np.array([df for _, _, _, _, df in selected], dtype=np.int64)
+        self.idf = self._idf(dfs, doc_count)
+
+        # Count matrix of the catalog from the same windows, restricted to the selected n-grams, one chunk at a time
+        selected_keys = {}
+        for n in range(min_n, max_n + 1):
+            level_keys = np.array(sorted(key for (m, key) in columns if m == n), dtype=np.int64)
+            selected_keys[n] = (level_keys, np.array([columns[(n, key)] for key in level_keys], dtype=np.int32))
+        blocks = []
+        for (start, end), first_doc in zip(chunks, range(0, doc_count, self.CHUNK_DOCS)):
+            rows, cols = [], []
+            for n, (level_keys, level_cols) in selected_keys.items():
+                if not level_keys.size:
+                    continue
+                keys = self._window_keys(tokens[start:end], doc_of[start:end], levels, len(words), n)
+                position = np.minimum(np.searchsorted(level_keys, keys), level_keys.size - 1)
+                hit = (keys >= 0) & (level_keys[position] == keys)
+                rows.append(doc_of[start:end][:keys.size][hit] - first_doc)
+                cols.append(level_cols[position[hit]])
+            blocks.append(self._counts(np.concatenate(rows or [np.zeros(0, dtype=np.int32)]),
+                                       np.concatenate(cols or [np.zeros(0, dtype=np.int32)]),
+                                       min(self.CHUNK_DOCS, doc_count - first_doc)))
+        counts = vstack(blocks, format="csr") if blocks else self._counts(np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int32), 0)
+        return self._weight(counts)
+
+    def transform(self, documents):
+        """(documents x features) float32 matrix of fitted TF-IDF weights."""
+        rows, grams = [], []
+        doc_count = 0
+        for document in documents:
+            document_grams = self.ngrams(self.tokens(document))
+            rows.extend([doc_count] * len(document_grams))
+            grams.extend(document_grams)
+            doc_count += 1
+
+        columns = self.vocabulary.columns(grams)
+        hit = columns >= 0
+        return self._weight(self._counts(np.array(rows, dtype=np.int32)[hit], columns[hit].astype(np.int32), doc_count))
+
+    def _window_keys(self, tokens, doc_of, levels, word_count, n):
+        """Key of the n-gram starting at every position of the chunk, -1 where it crosses a document or was pruned."""
+        keys = tokens.astype(np.int64)
+        for m in range(2, n + 1):
+            # Rank of each (m - 1)-gram among the kept ones; an m-gram needs both of its (m - 1)-grams kept
+            kept = levels[m - 2]["kept"]
+            position = np.minimum(np.searchsorted(kept, keys), max(kept.size - 1, 0))
+            ranks = np.where((keys >= 0) & (kept[position] == keys), position, -1) if kept.size else np.full(keys.size, -1)
+            same_doc = doc_of[:keys.size - 1] == doc_of[m - 1:m - 1 + keys.size - 1]
+            valid = (ranks[:-1] >= 0) & (ranks[1:] >= 0) & same_doc
+            keys = np.where(valid, ranks[:-1] * word_count + tokens[m - 1:m - 1 + keys.size - 1], -1)
+        return keys
+
+    def _count_windows(self, tokens, doc_of, chunks, levels, word_count, n):
+        """Sorted keys of the n-grams that survived pruning, with term and document frequencies."""
+        keys, tfs, dfs = np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        for start, end in chunks:
+            chunk_keys = self._window_keys(tokens[start:end], doc_of[start:end], levels, word_count, n)
+            chunk_docs = doc_of[start:end][:chunk_keys.size][chunk_keys >= 0]
+            chunk_keys = chunk_keys[chunk_keys >= 0]
+            if not chunk_keys.size:
+                continue
+            order = np.lexsort((chunk_docs, chunk_keys))
+            chunk_keys, chunk_docs = chunk_keys[order], chunk_docs[order]
+            unique, starts, counts = np.unique(chunk_keys, return_index=True, return_counts=True)
+            # Documents are whole within a chunk, so a key's documents are counted once per chunk
+            first = np.ones(chunk_keys.size, dtype=np.int64)
+            first[1:] = (chunk_keys[1:] != chunk_keys[:-1]) | (chunk_docs[1:] != chunk_docs[:-1])
+
+            merged, inverse = np.unique(np.concatenate([keys, unique]), return_inverse=True)
+            tfs = np.bincount(inverse, weights=np.concatenate([tfs, counts]), minlength=merged.size).astype(np.int64)
+            dfs = np.bincount(inverse, weights=np.concatenate([dfs, np.add.reduceat(first, starts)]),
+                              minlength=merged.size).astype(np.int64)
+            keys = merged
+        return keys, tfs, dfs
+
+    def _key_texts(self, levels, n, keys, words):
+        """N-gram strings for keys of level n."""
+        if n == 1:
+            return [words[key] for key in keys]
+        prefixes = self._key_texts(levels, n - 1, levels[n - 2]["kept"][keys // len(words)], words)
+        return [f"{prefix} {words[key % len(words)]}" for prefix, key in zip(prefixes, keys)]
+
+    def _idf(self, dfs, doc_count):
+        if not self.params["use_idf"]:
+            return None
+        smooth = int(self.params["smooth_idf"])
+        return (np.log((doc_count + smooth) / (dfs + smooth)) + 1).astype(np.float32)
+
+    def _counts(self, rows, cols, doc_count):
+        """float32 CSR matrix counting each (row, column) pair."""
+        matrix = csr_matrix((np.ones(rows.size, dtype=np.float32), (rows, cols)),
+                            shape=(doc_count, len(self.vocabulary)), dtype=np.float32)
+        matrix.sum_duplicates()
+        return matrix
+
+    def _weight(self, matrix):
+        """Count matrix as sublinear TF-IDF rows, l2-normalized like TfidfTransformer."""
+        if self.params["sublinear_tf"]:
+            np.log(matrix.data, out=matrix.data)
+            matrix.data += 1
+        if self.idf is not None:
+            matrix.data *= self.idf[matrix.indices]
+        if self.params["norm"]:
+            matrix = normalize(matrix, norm=self.params["norm"], copy=False)
+        return matrix
+
+    def save(self, path):
+        self.vocabulary.save(path)
+        if self.idf is not None:
+            np.save(Path(path) / "idf.npy", self.idf)
+
+    @classmethod
+    def load(cls, path):
+        """Memory-map the vocabulary and weights of a saved artifact."""
+        idf_path = Path(path) / "idf.npy"
+        return cls(NgramVocabulary.load(path),
+                   np.load(idf_path, mmap_mode="r") if idf_path.exists() else None)
+
+# Content hash of everything the search artifact is built from, fed one page of source rows at a time
+def new_source_digest():
+    digest = hashlib.sha256()
+    digest.update(f"artifact-v{ARTIFACT_VERSION}".encode())
+    # Vectorizer settings are part of the key so a config change forces a refit
+    digest.update(repr(sorted(create_tfidf_vectorizer().get_params().items())).encode())
+    digest.update(VECTORIZER_MODE.encode())
+    return digest
+
+def update_source_digest(digest, frame):
+    columns = [column for column in CATALOG_SOURCE_COLUMNS if column in frame.columns]
+    # One JSON line per row, so the hash does not depend on where the pages split
+    lines = frame[columns].to_json(orient="records", lines=True, default_handler=str)
+    digest.update(lines.rstrip("\n").encode() + b"\n")
+
+# Text embeddings from the spaCy model's word vectors
+class WordVectorEmbedder:
+    """Embeds text as the normalized mean vector of its non-stop words."""
+
+    def __init__(self, vectors, model_name):
+        self.vectors = vectors
+        self.table = np.asarray(vectors.data, dtype=np.float32)
+        self.model_name = model_name
+
+    @classmethod
+    def from_nlp(cls, nlp):
+        """Embedder for the loaded pipeline, or None when it ships without word vectors."""
+        if nlp.vocab.vectors.shape[0] == 0 or nlp.vocab.vectors.shape[1] == 0:
+            return None
+        meta = nlp.meta
+        return cls(nlp.vocab.vectors, f"{meta.get('lang', '')}_{meta.get('name', '')}-{meta.get('version', '')}")
+
+    @property
+    def dim(self):
+        return self.table.shape[1]
+
+    def embed(self, texts):
+        """(len(texts), dim) float32 matrix of unit vectors; all zeros for text without known words."""
+        doc_index, rows = [], []
+        # word -> row in the vectors table (-1 without a vector), only for this call so query words are not kept
+        found = {}
+        for i, text in enumerate(texts):
+            for word in re.findall(r'[a-z]+', text.lower()):
+                if word in ENGLISH_STOP_WORDS:
+                    continue
+                row = found.get(word)
+                if row is None:
+                    row = found[word] = self.vectors.find(key=word)
+                if row >= 0:
+                    doc_index.append(i)
+                    rows.append(row)
+        counts = csr_matrix((np.ones(len(rows), dtype=np.float32), (doc_index, rows)),
+                            shape=(len(texts), self.table.shape[0]))
+        return normalize(np.asarray(counts @ self.table, dtype=np.float32), norm='l2')
+
+# Inverted-file index over charity embeddings for approximate nearest-neighbour search
+class DenseIndex:
+    """IVF index: embeddings grouped by their nearest k-means centroid, only the closest groups are scanned."""
+
+    KMEANS_ITERATIONS = 10
+    KMEANS_SAMPLE = 50000
+
+    def __init__(self, embeddings, scales, centroids, assignments):
+        # float32 unit vectors, or int8 with the per-row scale in scales
+        self.embeddings = embeddings
+        self.scales = scales
+        self.centroids = centroids
+        self.assignments = assignments
+        # Rows ordered by list, and each list's slice of that order
+        self.list_rows = np.argsort(assignments, kind='stable').astype(np.int64)
+        self.list_offsets = np.searchsorted(assignments[self.list_rows], np.arange(len(centroids) + 1))
+
+    def __len__(self):
+        return len(self.assignments)
+
+    @staticmethod
+    def quantize(embeddings, quantization):
+        if quantization != "int8":
+            return embeddings.astype(np.float32), None
+        scales = np.abs(embeddings).max(axis=1) / 127.0
+        scales[scales == 0] = 1.0
+        return np.round(embeddings / scales[:, None]).astype(np.int8), scales.astype(np.float32)
+
+    @staticmethod
+    def assign(embeddings, centroids, chunk_size=8192):
+        return np.concatenate([
+            np.argmax(embeddings[start:start + chunk_size] @ centroids.T, axis=1)
+            for start in range(0, len(embeddings), chunk_size)
+        ] or [np.zeros(0, dtype=np.int64)]).astype(np.int32)
+
+    @classmethod
+    def build(cls, embeddings, nlist=0, quantization="float32"):
+        """Spherical k-means on a sample of the embeddings, then one pass to assign every row."""
+        n = len(embeddings)
+        nlist = min(n, nlist or max(1, int(math.sqrt(n)))) or 1
+        rng = np.random.default_rng(0)
+        sample = embeddings[rng.choice(n, size=min(n, cls.KMEANS_SAMPLE), replace=False)] if n else embeddings
+        centroids = sample[rng.choice(len(sample), size=nlist, replace=False)] if len(sample) else np.zeros((1, embeddings.shape[1]), dtype=np.float32)
+
+        for _ in range(cls.KMEANS_ITERATIONS):
+            labels = cls.assign(sample, centroids)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, labels, sample)
+            # Empty lists keep their previous centroid
+            filled = np.linalg.norm(sums, axis=1) > 0
+            centroids[filled] = normalize(sums[filled], norm='l2')
+
+        embeddings_q, scales = cls.quantize(embeddings, quantization)
+        return cls(embeddings_q, scales, centroids.astype(np.float32), cls.assign(embeddings, centroids))
+
+    def scores(self, rows, query_vector):
+        """Cosine similarity of the given rows to a unit query vector."""
+        scores = self.embeddings[rows] @ query_vector if self.scales is None else \
+            (self.embeddings[rows].astype(np.float32) @ query_vector) * self.scales[rows]
+        return scores
+
+    def search(self, query_vectors, top_k, nprobe=DENSE_NPROBE):
+        """(rows, scores) of the approximate top_k rows for each query vector."""
+        nprobe = max(1, min(nprobe, len(self.centroids)))
+        centroid_scores = query_vectors @ self.centroids.T
+        results = []
+        for query_vector, list_scores in zip(query_vectors, centroid_scores):
+            if not query_vector.any():
+                results.append((np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)))
+                continue
+            probe = np.argpartition(-list_scores, nprobe - 1)[:nprobe]
+            rows = np.concatenate([self.list_rows[self.list_offsets[l]:self.list_offsets[l + 1]] for l in probe])
+            scores = self.scores(rows, query_vector)
+            k = min(top_k, len(rows))
+            if k == 0:
+                results.append((rows, scores))
+                continue
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top], kind='stable')]
+            results.append((rows[top], scores[top]))
+        return results
+
+    def apply_changes(self, keep, new_embeddings):
+        """Index with only the kept rows, followed by new rows assigned to the existing centroids."""
+        embeddings_q, scales = self.quantize(new_embeddings, "int8" if self.scales is not None else "float32")
+        return DenseIndex(
+            np.concatenate([self.embeddings[keep], embeddings_q]),
+            np.concatenate([self.scales[keep], scales]) if self.scales is not None else None,
+            self.centroids,
+            np.concatenate([self.assignments[keep], self.assign(new_embeddings, self.centroids)])
+        )
+
+    def save(self, path, manifest):
+        """Write the index into its own directory inside an artifact, moved into place when complete."""
+        path = Path(path)
+        tmp_path = path.with_name(f"{path.name}.tmp-{os.getpid()}")
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        tmp_path.mkdir(parents=True)
+        np.save(tmp_path / "embeddings.npy", self.embeddings)
+        if self.scales is not None:
+            np.save(tmp_path / "scales.npy", self.scales)
+        np.save(tmp_path / "centroids.npy", self.centroids)
+        np.save(tmp_path / "assignments.npy", self.assignments)
+        with open(tmp_path / "manifest.json", "w") as f:
+            json.dump(manifest, f)
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+    @classmethod
+    def load(cls, path, manifest):
+        """Memory-map a saved index, or return None when it is missing or was built differently."""
+        path = Path(path)
+        try:
+            with open(path / "manifest.json") as f:
+                if json.load(f) != manifest:
+                    return None
+            scales_path = path / "scales.npy"
+            return cls(
+                np.load(path / "embeddings.npy", mmap_mode="r"),
+                np.load(scales_path) if scales_path.exists() else None,
+                np.load(path / "centroids.npy"),
+                np.load(path / "assignments.npy")
+            )
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.error("Error loading dense index from %s: %s", path, e)
+            return None
+
+# Catalog together with everything fitted on it, persisted as one versioned artifact
+class CatalogSnapshot:
+    """Catalog, fitted vectorizer, scoring matrix and focus-area matcher for one version of the source rows."""
+
+    def __init__(self, catalog, vectorizer, text_matrix_t, focus_area_matcher, source_hash):
+        self.catalog = catalog
+        self.vectorizer = vectorizer
+        # Pre-normalized, transposed TF-IDF matrix (features x charities)
+        self.text_matrix_t = text_matrix_t
+        self.focus_area_matcher = focus_area_matcher
+        self.focus_area_index = dict(zip(focus_area_matcher.areas, focus_area_matcher.postings))
+        self.source_hash = source_hash
+        # (column, value) of the newest source row included, for incremental syncs
+        self.watermark = None
+        # Where the rows were read from: {"origin": "supabase" | "local_snapshot", "fetched_at": epoch seconds}
+        self.source = None
+        # Collaborative-filtering scores for this catalog's rows, attached once the model is loaded
+        self.cf_scorer = None
+        # Dense retrieval index, attached when DENSE_RETRIEVAL is on and the word vectors are loaded
+        self.dense_index = None
+        # Shared-memory shards, attached by install_snapshot when CATALOG_SHARDS is set
+        self.shards = None
+        # Assigned by install_snapshot
+        self.version = 0
+
+    @classmethod
+    def build(cls, catalog, source_hash):
+        """Fit the vectorizer and build the indexes from scratch."""
+        logger.info("Preparing text vectorizer...")
+        vectorizer = CompactTfidfVectorizer() if VECTORIZER_MODE == "compact" else create_tfidf_vectorizer()
+
+        # Fit vectorizer on combined text for better matching (description + focus areas)
+        text_matrix = vectorizer.fit_transform(catalog.combined_text(row) for row in range(len(catalog)))
+        # stop_words_ only lists pruned terms for introspection and can be larger than the vocabulary
+        vectorizer.stop_words_ = None
+
+        # Pre-normalized, transposed copy so a whole batch of query vectors is scored with one sparse product
+        text_matrix_t = normalize(text_matrix, norm='l2').T.tocsr()
+
+        # Create a focus areas index and matcher so queries don't rescan every area per term
+        focus_area_matcher = FocusAreaMatcher(catalog.build_focus_area_index())
+
+        return cls(catalog, vectorizer, text_matrix_t, focus_area_matcher, source_hash)
+
+    def apply_changes(self, changes):
+        """New snapshot with the rows of changes replacing or appended to this one, using the fitted vectorizer."""
+        # Drop every existing row of a changed charity, then append the fresh rows
+        keep = np.flatnonzero(~np.isin(self.catalog.charity_ids, changes.charity_ids))
+        catalog = CharityCatalog.concat(self.catalog.take(keep), changes)
+
+        # Rows of the existing matrix are reused as they are; only the changed text is transformed
+        kept_matrix = self.text_matrix_t.T.tocsr()[keep]
+        new_matrix = normalize(self.vectorizer.transform(changes.combined_text(row) for row in range(len(changes))), norm='l2')
+        text_matrix_t = vstack([kept_matrix, new_matrix]).T.tocsr()
+
+        focus_area_matcher = self.focus_area_matcher.with_index(catalog.build_focus_area_index())
+        snapshot = CatalogSnapshot(catalog, self.vectorizer, text_matrix_t, focus_area_matcher, self.source_hash)
+        if self.dense_index is not None and word_vectors is not None:
+            new_embeddings = word_vectors.embed([changes.combined_text(row) for row in range(len(changes))])
+            snapshot.dense_index = self.dense_index.apply_changes(keep, new_embeddings)
+        return snapshot
+
+    def save(self, path):
+        """Write the artifact into a temporary directory, then move it into place."""
+        path = Path(path)
+        tmp_path = path.with_name(f"{path.name}.tmp-{os.getpid()}")
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        tmp_path.mkdir(parents=True)
+
+        self.catalog.save(tmp_path)
+        # Plain .npy files rather than .npz so the matrix can be memory-mapped on load
+        np.save(tmp_path / "text_matrix.data.npy", self.text_matrix_t.data)
+        np.save(tmp_path / "text_matrix.indices.npy", self.text_matrix_t.indices)
+        np.save(tmp_path / "text_matrix.indptr.npy", self.text_matrix_t.indptr)
+        if isinstance(self.vectorizer, CompactTfidfVectorizer):
+            self.vectorizer.save(tmp_path)
+        else:
+            with open(tmp_path / "vectorizer.pkl", "wb") as f:
+                pickle.dump(self.vectorizer, f, protocol=pickle.HIGHEST_PROTOCOL)
+        with open(tmp_path / "focus_area_matcher.pkl", "wb") as f:
+            pickle.dump(self.focus_area_matcher.to_state(), f, protocol=pickle.HIGHEST_PROTOCOL)
+        with open(tmp_path / "manifest.json", "w") as f:
+            json.dump({
+                "version": ARTIFACT_VERSION,
+                "source_hash": self.source_hash,
+                "vectorizer": "compact" if isinstance(self.vectorizer, CompactTfidfVectorizer) else "sklearn",
+                "shape": list(self.text_matrix_t.shape),
+                "charities": len(self.catalog),
+                "created_at": time.time()
+            }, f)
+
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            # Another process already published this version
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+    @classmethod
+    def load(cls, path, source_hash):
+        """Memory-map a saved artifact, or return None when it is missing or stale."""
+        path = Path(path)
+        try:
+            with open(path / "manifest.json") as f:
+                manifest = json.load(f)
+        except FileNotFoundError:
+            return None
+        if manifest.get("version") != ARTIFACT_VERSION or manifest.get("source_hash") != source_hash:
+            return None
+
+        try:
+            catalog = CharityCatalog.load(path)
+            text_matrix_t = csr_matrix((
+                np.load(path / "text_matrix.data.npy", mmap_mode="r"),
+                np.load(path / "text_matrix.indices.npy", mmap_mode="r"),
+                np.load(path / "text_matrix.indptr.npy", mmap_mode="r")
+            ), shape=tuple(manifest["shape"]), copy=False)
+            if manifest.get("vectorizer") == "compact":
+                vectorizer = CompactTfidfVectorizer.load(path)
+            else:
+                with open(path / "vectorizer.pkl", "rb") as f:
+                    vectorizer = pickle.load(f)
+            with open(path / "focus_area_matcher.pkl", "rb") as f:
+                focus_area_matcher = FocusAreaMatcher.from_state(pickle.load(f))
+        except Exception as e:
+            logger.error("Error loading search artifact from %s: %s", path, e)
+            return None
+
+        return cls(catalog, vectorizer, text_matrix_t, focus_area_matcher, source_hash)
+
+# Location of the artifact for a given source hash
+def artifact_path_for(source_hash):
+    return Path(ARTIFACT_DIR) / f"v{ARTIFACT_VERSION}-{source_hash[:16]}"
+
+# Remove all but the most recent artifacts
+def prune_artifacts(keep=ARTIFACT_KEEP):
+    artifact_dir = Path(ARTIFACT_DIR)
+    if not artifact_dir.is_dir():
+        return
+    artifacts = sorted(
+        (path for path in artifact_dir.glob("v*-*") if path.is_dir() and ".tmp-" not in path.name),
+        key=lambda path: path.stat().st_mtime,
+        reverse=True
+    )
+    for path in artifacts[keep:]:
+        shutil.rmtree(path, ignore_errors=True)
+
+# Read a Supabase table one range request at a time; configure adds filters to every request
+def fetch_table_pages(name, columns, order, configure=None, page_size=CATALOG_PAGE_SIZE):
+    start = 0
+    while True:
+        query = get_supabase().table(name).select(",".join(columns))
+        if configure is not None:
+            query = configure(query)
+        rows = query.order(order).range(start, start + page_size - 1).execute().data
+        # The server may cap a page below page_size, so only an empty page ends the table
+        if not rows:
+            return
+        yield rows
+        start += len(rows)
+
+# charity_donor columns to select, with the watermark column when the table has one
+def donor_columns():
+    columns = list(CATALOG_DONOR_COLUMNS)
+    if CATALOG_WATERMARK_COLUMN and CATALOG_WATERMARK_COLUMN not in columns:
+        try:
+            get_supabase().table("charity_donor").select(CATALOG_WATERMARK_COLUMN).limit(1).execute()
+            columns.append(CATALOG_WATERMARK_COLUMN)
+        except Exception as e:
+            logger.warning("Watermark column %s unavailable, syncing on charityId: %s", CATALOG_WATERMARK_COLUMN, e)
+    return columns
+
+# Source rows and the pieces derived from them, accumulated while the pages stream in
+class CatalogIngest:
+    """Builds catalog chunks, the content hash and the watermark page by page, mirroring pages into the local snapshot."""
+
+    def __init__(self, snapshot_writer=None):
+        self.chunks = []
+        self.digest = new_source_digest()
+        # Watermark per candidate column, see advance_watermark
+        self.watermarks = {}
+        self.rows = 0
+        self.snapshot_writer = snapshot_writer
+        # {"origin": "supabase" | "local_snapshot", "fetched_at": epoch seconds}, set once all pages are in
+        self.source = None
+
+    def add(self, frame):
+        update_source_digest(self.digest, frame)
+        for column in (CATALOG_WATERMARK_COLUMN, "charityId"):
+            self.watermarks[column] = advance_watermark(self.watermarks.get(column), frame, column)
+        self.chunks.append(CharityCatalog.from_frame(frame))
+        self.rows += len(frame)
+        if self.snapshot_writer is not None:
+            self.snapshot_writer.write(frame)
+
+    @property
+    def source_hash(self):
+        return self.digest.hexdigest()
+
+    @property
+    def watermark(self):
+        for column in (CATALOG_WATERMARK_COLUMN, "charityId"):
+            if self.watermarks.get(column) is not None:
+                return self.watermarks[column]
+        return None
+
+    def catalog(self):
+        # Duplicated charityIds can straddle pages, so they are collapsed once all chunks are in
+        return CharityCatalog.concat(*self.chunks).deduplicated()
+
+# Streams source pages into a Parquet file that replaces the previous snapshot only once every page is written
+class SourceSnapshotWriter:
+    """Best effort: a failed write drops the new snapshot and keeps the old one."""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.tmp_path = self.path.with_name(f"{self.path.name}.tmp-{os.getpid()}")
+        self.schema = None
+        self._writer = None
+        self.failed = False
+
+    def write(self, frame):
+        if self.failed:
+            return
+        try:
+            table = pa.Table.from_pandas(frame, preserve_index=False)
+            if self._writer is None:
+                # Columns that are all null in the first page are stored as strings
+                self.schema = pa.schema(
+                    [pa.field(field.name, pa.string()) if pa.types.is_null(field.type) else field for field in table.schema],
+                    metadata=table.schema.metadata
+                )
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                self._writer = pq.ParquetWriter(self.tmp_path, self.schema)
+            self._writer.write_table(table.select(self.schema.names).cast(self.schema))
+        except Exception as e:
+            logger.error("Error writing local catalog snapshot: %s", e)
+            self.abort()
+            self.failed = True
+
+    def commit(self):
+        if self.failed or self._writer is None:
+            return
+        self._writer.close()
+        os.replace(self.tmp_path, self.path)
+        logger.info("Saved local catalog snapshot to %s", self.path)
+
+    def abort(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        self.tmp_path.unlink(missing_ok=True)
+
+# Page through the charity rows in Supabase, merging in website URLs; falls back to the local snapshot when allowed
+def ingest_catalog(allow_snapshot=True):
+    logger.info("Fetching data from Supabase...")
+    writer = SourceSnapshotWriter(CATALOG_SNAPSHOT_PATH) if pq is not None and CATALOG_SNAPSHOT_PATH else None
+    ingest = CatalogIngest(writer)
     try:
-        charity2_response = supabase.table("charity_2").select("*").execute()
-        charity2_df = pd.DataFrame(charity2_response.data)
-
-        # If we have charity_2 data, merge it with our main dataframe
-        if not charity2_df.empty and 'id' in charity2_df.columns:
-            # Rename columns for consistency
-            charity2_df = charity2_df.rename(columns={'id': 'charityId', 'websiteurl': 'website'})
-
-            # Merge the dataframes, keeping all rows from df
-            if 'charityId' in df.columns:
-                # Only merge the website column if it exists
-                if 'website' in charity2_df.columns:
-                    df = pd.merge(df, charity2_df[['charityId', 'website']], on='charityId', how='left')
-                # If websiteurl exists instead of website
-                elif 'websiteurl' in charity2_df.columns:
-                    charity2_df = charity2_df.rename(columns={'websiteurl': 'website'})
-                    df = pd.merge(df, charity2_df[['charityId', 'website']], on='charityId', how='left')
+        website_map = fetch_website_map()
+        for rows in fetch_table_pages("charity_donor", donor_columns(), "charityId"):
+            ingest.add(attach_websites(pd.DataFrame(rows), website_map))
+        # An empty table is as unusable as an outage (it is also what row-level security answers)
+        if ingest.rows == 0:
+            raise RuntimeError("Supabase returned no charity rows")
     except Exception as e:
-        print(f"Error fetching charity_2 data: {e}")
-
-    print(f"Successfully loaded {len(df)} records from Supabase")
-except Exception as e:
-    print(f"Error fetching data from Supabase: {e}")
-    # Provide an empty DataFrame as fallback
-    df = pd.DataFrame(columns=["charityId", "name", "description", "focusAreas", "website"])
-
-# Clean and preprocess the data
-df['processed_description'] = df['description'].fillna('').astype(str)
-df['focusAreas'] = df['focusAreas'].fillna('').astype(str)
-
-# Split focus areas into lists for better matching
-df['focus_areas_list'] = df['focusAreas'].apply(lambda x: [area.strip() for area in x.split(',') if area.strip()])
-
-# Create a lookup dictionary for faster access - convert to dictionary properly
-charity_lookup = {}
-for _, row in df.iterrows():
-    charity_id = row['charityId']
-    # Convert row to a dictionary
-    charity_lookup[charity_id] = {
-        'charityId': charity_id,
-        'name': row['name'],
-        'description': row['description'],
-        'focus_areas_list': row['focus_areas_list'],
-        'focusAreas': row['focusAreas'],
-        'website': row.get('website', None)  # Include website URL if available
-    }
+        if writer is not None:
+            writer.abort()
+        logger.error("Error fetching data from Supabase: %s", e)
+        if not allow_snapshot:
+            raise
+        return load_source_snapshot(e)
+
+    if writer is not None:
+        writer.commit()
+    ingest.source = {"origin": "supabase", "fetched_at": time.time()}
+    logger.info("Successfully loaded %d records from Supabase", ingest.rows)
+    return ingest
+
+# Rebuild the ingest from the local Parquet snapshot, already merged with the website URLs
+def load_source_snapshot(cause):
+    path = Path(CATALOG_SNAPSHOT_PATH) if CATALOG_SNAPSHOT_PATH else None
+    if pq is None or path is None or not path.exists():
+        raise RuntimeError(f"Supabase unavailable and no local catalog snapshot to fall back to ({cause})") from cause
+
+    ingest = CatalogIngest()
+    for batch in pq.ParquetFile(path).iter_batches(batch_size=CATALOG_PAGE_SIZE):
+        ingest.add(batch.to_pandas())
+    if ingest.rows == 0:
+        raise RuntimeError(f"Local catalog snapshot {path} is empty ({cause})") from cause
+
+    ingest.source = {"origin": "local_snapshot", "fetched_at": path.stat().st_mtime}
+    logger.warning("Loaded %d records from local snapshot %s, %.0fs old",
+                   ingest.rows, path, time.time() - ingest.source["fetched_at"])
+    return ingest
+
+# Watermark (column, value, charityIds at value) moved past the rows of frame
+def advance_watermark(watermark, frame, column):
+    if column not in frame.columns or not frame[column].notna().any():
+        return watermark
+    value = frame[column].dropna().max()
+    value = value.item() if hasattr(value, "item") else value
+    at_value = frozenset(frame.loc[frame[column] == value, "charityId"].dropna().astype(int).tolist())
+    if watermark is None or value > watermark[1]:
+        return column, value, at_value
+    if value == watermark[1]:
+        return column, value, watermark[2] | at_value
+    return watermark
+
+# Fetch the charity rows changed since the watermark, oldest first, with their website URLs
+def fetch_changed_frame(watermark):
+    column, value, synced_ids = watermark
+    # gte, since a row sharing the watermark value can commit after the previous sync read that value
+    pages = fetch_table_pages("charity_donor", donor_columns(), column, configure=lambda query: query.gte(column, value))
+    df = pd.DataFrame([row for rows in pages for row in rows])
+    if df.empty:
+        return df
+    # Rows at the watermark value that the previous sync already applied
+    df = df[~((df[column] == value) & df['charityId'].isin(synced_ids))]
+    if df.empty:
+        return df
+    # Only the website rows of the changed charities are needed
+    charity_ids = df['charityId'].dropna().astype(int).unique().tolist()
+    return attach_websites(df, fetch_website_map(charity_ids))
+
+# Fetch the website tables into one charityId -> website map, limited to charity_ids when given
+def fetch_website_map(charity_ids=None):
+    if charity_ids is None:
+        configures = [None]
+    else:
+        # One in_ filter per chunk, since every id goes into the request URL
+        configures = [
+            lambda query, chunk=charity_ids[start:start + WEBSITE_ID_CHUNK_SIZE]: query.in_("id", chunk)
+            for start in range(0, len(charity_ids), WEBSITE_ID_CHUNK_SIZE)
+        ]
+    tables = []
+    for name, column in WEBSITE_TABLE_COLUMNS.items():
+        try:
+            rows = [row for configure in configures for rows in fetch_table_pages(name, ["id", column], "id", configure) for row in rows]
+        except Exception as e:
+            logger.error("Error fetching %s data: %s", name, e)
+            continue
+        tables.append(pd.DataFrame(rows, columns=["id", column]).rename(columns={column: "website"}))
+    return build_website_map(tables)
+
+# charityId -> website from website tables given in order of precedence
+def build_website_map(tables):
+    """Earlier tables win; within a table the first non-empty URL for an id wins."""
+    if not tables:
+        return pd.Series(dtype=object)
+    combined = pd.concat(tables, ignore_index=True)
+    # astype keeps the mask boolean when no rows came back, so it is not taken as a column selection
+    combined = combined[combined["website"].map(lambda website: isinstance(website, str) and website != "").astype(bool)]
+    combined = combined.drop_duplicates("id", keep="first")
+    return pd.Series(combined["website"].to_numpy(), index=combined["id"].to_numpy())
+
+# Set every row's website with one lookup in the map, instead of a merge per website table
+def attach_websites(df, website_map):
+    df["website"] = df["charityId"].map(website_map)
+    return df
 
 # Download and load the trained model from Supabase
-print("Downloading model from Supabase...")
-bucket_name = "ml-pickle"
-file_name = "charity_model.pkl"
-best_model = None
+def load_cf_model():
+    logger.info("Downloading model from Supabase...")
+    bucket_name = "ml-pickle"
+    file_name = "charity_model.pkl"
+    best_model = None
 
-try:
-    # Create a models directory if it doesn't exist
-    os.makedirs('models', exist_ok=True)
-    model_path = os.path.join('models', file_name)
-
-    # Try to load from local cache first
-    if os.path.exists(model_path):
-        print("Loading model from local cache...")
-        with open(model_path, 'rb') as f:
-            best_model = pickle.load(f)
-        print("Model loaded successfully from cache!")
-    else:
-        print("Downloading model from Supabase...")
-        try:
-            response = supabase.storage.from_(bucket_name).download(file_name)
-            with open(model_path, 'wb') as f:
-                f.write(response)
+    try:
+        # Create a models directory if it doesn't exist
+        os.makedirs('models', exist_ok=True)
+        model_path = os.path.join('models', file_name)
+
+        # Try to load from local cache first
+        if os.path.exists(model_path):
+            logger.info("Loading model from local cache...")
             with open(model_path, 'rb') as f:
                 best_model = pickle.load(f)
-            print("Model downloaded and loaded successfully!")
-        except Exception as e:
-            print(f"Error downloading model from Supabase: {e}")
-            best_model = None
+            logger.info("Model loaded successfully from cache!")
+        else:
+            logger.info("Downloading model from Supabase...")
+            try:
+                response = get_supabase().storage.from_(bucket_name).download(file_name)
+                with open(model_path, 'wb') as f:
+                    f.write(response)
+                with open(model_path, 'rb') as f:
+                    best_model = pickle.load(f)
+                logger.info("Model downloaded and loaded successfully!")
+            except Exception as e:
+                logger.error("Error downloading model from Supabase: %s", e)
+                best_model = None
 
-except Exception as e:
-    print(f"Error handling model: {e}")
-    best_model = None
+    except Exception as e:
+        logger.error("Error handling model: %s", e)
+        best_model = None
+
+    return best_model
+
+# Pipeline components whose output analyze_query_doc never reads
+UNUSED_QUERY_PIPES = ("textcat", "textcat_multilabel", "spancat", "span_finder", "entity_linker")
 
 # Load spaCy model - use a more comprehensive model for better entity recognition and linguistic features
-print("Loading NLP model...")
-try:
-    # Try to load the medium model first for better accuracy
+def load_nlp():
+    logger.info("Loading NLP model...")
     try:
-        nlp = spacy.load("en_core_web_md")
-        print("Using enhanced medium-sized NLP model with word vectors")
-    except:
-        # Fall back to small model if medium is not available
-        nlp = spacy.load("en_core_web_sm")
-        print("Using small NLP model")
-
-    # Add custom components to the pipeline
-    # Add sentence segmentation for better context understanding
-    if "sentencizer" not in nlp.pipe_names:
-        from spacy.pipeline import Sentencizer
-        nlp.add_pipe("sentencizer")
-
-    # Add custom charity-specific entity types if not already in the model
-    if "entity_ruler" not in nlp.pipe_names:
-        from spacy.pipeline import EntityRuler
-        ruler = nlp.add_pipe("entity_ruler")
-
-        # Add charity-specific patterns
-        patterns = [
-            {"label": "CHARITY_TYPE", "pattern": [{"LOWER": "nonprofit"}]},
-            {"label": "CHARITY_TYPE", "pattern": [{"LOWER": "non"}, {"LOWER": "profit"}]},
-            {"label": "CHARITY_TYPE", "pattern": [{"LOWER": "ngo"}]},
-            {"label": "CHARITY_TYPE", "pattern": [{"LOWER": "foundation"}]},
-            {"label": "CHARITY_TYPE", "pattern": [{"LOWER": "charity"}]},
-            {"label": "CHARITY_FOCUS", "pattern": [{"LOWER": "education"}]},
-            {"label": "CHARITY_FOCUS", "pattern": [{"LOWER": "health"}]},
-            {"label": "CHARITY_FOCUS", "pattern": [{"LOWER": "environment"}]},
-            {"label": "CHARITY_FOCUS", "pattern": [{"LOWER": "poverty"}]},
-            {"label": "CHARITY_FOCUS", "pattern": [{"LOWER": "children"}]},
-            {"label": "CHARITY_FOCUS", "pattern": [{"LOWER": "animal"}]},
-            {"label": "CHARITY_FOCUS", "pattern": [{"LOWER": "wildlife"}]},
-            {"label": "CHARITY_FOCUS", "pattern": [{"LOWER": "disaster"}]},
-            {"label": "CHARITY_FOCUS", "pattern": [{"LOWER": "humanitarian"}]},
-            {"label": "CHARITY_FOCUS", "pattern": [{"LOWER": "rights"}]},
-            {"label": "CHARITY_FOCUS", "pattern": [{"LOWER": "community"}]},
-            {"label": "CHARITY_FOCUS", "pattern": [{"LOWER": "development"}]},
-            {"label": "CHARITY_FOCUS", "pattern": [{"LOWER": "research"}]},
-            {"label": "CHARITY_FOCUS", "pattern": [{"LOWER": "medical"}]},
-            {"label": "CHARITY_FOCUS", "pattern": [{"LOWER": "relief"}]},
-            {"label": "CHARITY_FOCUS", "pattern": [{"LOWER": "support"}]},
-            {"label": "CHARITY_FOCUS", "pattern": [{"LOWER": "aid"}]},
-            {"label": "CHARITY_FOCUS", "pattern": [{"LOWER": "assistance"}]},
-            {"label": "CHARITY_FOCUS", "pattern": [{"LOWER": "care"}]}
-        ]
-        ruler.add_patterns(patterns)
-        print("Added charity-specific entity patterns")
-
-except Exception as e:
-    # Fallback to a simpler model
-    nlp = spacy.blank("en")
-    print(f"Using blank model as fallback due to error: {e}")
-
-# Initialize TF-IDF vectorizer and fit it only once
-print("Preparing text vectorizer...")
-tfidf_vectorizer = TfidfVectorizer(
-    min_df=1,  # Changed from 2 to 1 to include more rare terms
-    max_df=0.9,  # Reduced from 0.95 to 0.9 to filter out more common terms
-    max_features=8000,  # Increased from 5000 to 8000 for better coverage
-    strip_accents='unicode',
-    analyzer='word',
-    token_pattern=r'\w{2,}',  # Changed to require at least 2 characters
-    ngram_range=(1, 3),  # Increased back to (1, 3) for better phrase matching
-    stop_words='english',
-    use_idf=True,  # Explicitly enable IDF weighting
-    smooth_idf=True,  # Apply smoothing to IDF weights
-    sublinear_tf=True  # Apply sublinear tf scaling (log scaling)
-)
+        # Try to load the medium model first for better accuracy
+        try:
+            nlp = spacy.load("en_core_web_md")
+            logger.info("Using enhanced medium-sized NLP model with word vectors")
+        except:
+            # Fall back to small model if medium is not available
+            nlp = spacy.load("en_core_web_sm")
+            logger.info("Using small NLP model")
+
+        # Add custom components to the pipeline
+        # Add sentence segmentation for better context understanding
+        if "sentencizer" not in nlp.pipe_names:
+            from spacy.pipeline import Sentencizer
+            nlp.add_pipe("sentencizer")
+
+        # Add custom charity-specific entity types if not already in the model
+        if "entity_ruler" not in nlp.pipe_names:
+            from spacy.pipeline import EntityRuler
+            ruler = nlp.add_pipe("entity_ruler")
+
+            # Add charity-specific patterns
+            patterns = [
+                {"label": "CHARITY_TYPE", "pattern": [{"LOWER": "nonprofit"}]},
+                {"label": "CHARITY_TYPE", "pattern": [{"LOWER": "non"}, {"LOWER": "profit"}]},
+                {"label": "CHARITY_TYPE", "pattern": [{"LOWER": "ngo"}]},
+                {"label": "CHARITY_TYPE", "pattern": [{"LOWER": "foundation"}]},
+                {"label": "CHARITY_TYPE", "pattern": [{"LOWER": "charity"}]},
+                {"label": "CHARITY_FOCUS", "pattern": [{"LOWER": "education"}]},
+                {"label": "CHARITY_FOCUS", "pattern": [{"LOWER": "health"}]},
+                {"label": "CHARITY_FOCUS", "pattern": [{"LOWER": "environment"}]},
+                {"label": "CHARITY_FOCUS", "pattern": [{"LOWER": "poverty"}]},
+                {"label": "CHARITY_FOCUS", "pattern": [{"LOWER": "children"}]},
+                {"label": "CHARITY_FOCUS", "pattern": [{"LOWER": "animal"}]},
+                {"label": "CHARITY_FOCUS", "pattern": [{"LOWER": "wildlife"}]},
+                {"label": "CHARITY_FOCUS", "pattern": [{"LOWER": "disaster"}]},
+                {"label": "CHARITY_FOCUS", "pattern": [{"LOWER": "humanitarian"}]},
+                {"label": "CHARITY_FOCUS", "pattern": [{"LOWER": "rights"}]},
+                {"label": "CHARITY_FOCUS", "pattern": [{"LOWER": "community"}]},
+                {"label": "CHARITY_FOCUS", "pattern": [{"LOWER": "development"}]},
+                {"label": "CHARITY_FOCUS", "pattern": [{"LOWER": "research"}]},
+                {"label": "CHARITY_FOCUS", "pattern": [{"LOWER": "medical"}]},
+                {"label": "CHARITY_FOCUS", "pattern": [{"LOWER": "relief"}]},
+                {"label": "CHARITY_FOCUS", "pattern": [{"LOWER": "support"}]},
+                {"label": "CHARITY_FOCUS", "pattern": [{"LOWER": "aid"}]},
+                {"label": "CHARITY_FOCUS", "pattern": [{"LOWER": "assistance"}]},
+                {"label": "CHARITY_FOCUS", "pattern": [{"LOWER": "care"}]}
+            ]
+            ruler.add_patterns(patterns)
+            logger.info("Added charity-specific entity patterns")
+
+        # Keep components the query analysis never reads out of every call; the sentencizer
+        # is redundant once the parser sets sentence boundaries
+        unused = [name for name in nlp.pipe_names if name in UNUSED_QUERY_PIPES or
+                  (name in ("sentencizer", "senter") and "parser" in nlp.pipe_names)]
+        if unused:
+            nlp.select_pipes(disable=unused)
+            logger.info("Disabled unused pipeline components: %s", ", ".join(unused))
+
+    except Exception as e:
+        # Fallback to a simpler model
+        nlp = spacy.blank("en")
+        logger.error("Using blank model as fallback due to error: %s", e)
 
-# Create combined text for better matching (description + focus areas)
-df['combined_text'] = df['processed_description'] + ' ' + df['focusAreas']
+    return nlp
 
-# Fit vectorizer on combined text
-text_matrix = tfidf_vectorizer.fit_transform(df['combined_text'])
+# Loaded state, filled in by the startup stages
+# Requests read catalog_snapshot once and use that snapshot throughout, so a refresh can swap it at any time
+catalog_snapshot = None
+best_model = None
+nlp = None
+query_analyzer = None
+word_vectors = None
+snapshot_versions = itertools.count(1)
+
+# Make a catalog snapshot the one served by the scoring functions
+def install_snapshot(snapshot):
+    global catalog_snapshot
+    snapshot.version = next(snapshot_versions)
+    if CATALOG_SHARDS > 1:
+        if PREDICT_EXECUTOR == "process":
+            # Process workers already score on their own cores and cannot start pools of their own
+            logger.warning("CATALOG_SHARDS is ignored with PREDICT_EXECUTOR=process")
+        else:
+            if catalog_snapshot is None:
+                ShardedScorer.remove_stale_blocks()
+            snapshot.shards = ShardedScorer(snapshot, CATALOG_SHARDS)
+    previous, catalog_snapshot = catalog_snapshot, snapshot
+    if previous is not None and previous.shards is not None:
+        # Requests that started on the previous snapshot may still be scoring its shards
+        retiring_shards.add(previous.shards)
+        retire = threading.Timer(PREDICT_BATCH_TIMEOUT + 5, retire_shards, args=(previous.shards,))
+        retire.daemon = True
+        retire.start()
+    # Cached rankings are keyed on the version, drop the stale ones right away
+    result_cache.clear()
+    # Process workers hold a forked copy of the previous snapshot
+    predict_pool.recycle()
+
+# Startup stage: fetch the source rows and reuse the persisted artifact when they are unchanged
+def load_catalog_stage(context, allow_snapshot=True):
+    logger.info("Loading and preprocessing data...")
+    ingest = ingest_catalog(allow_snapshot)
+
+    source_hash = ingest.source_hash
+    path = artifact_path_for(source_hash)
+    snapshot = CatalogSnapshot.load(path, source_hash)
+    context.update(source_hash=source_hash, artifact_path=path, snapshot=snapshot,
+                   watermark=ingest.watermark, rows=ingest.rows, source=ingest.source)
+    origin = "Supabase" if ingest.source["origin"] == "supabase" else "the local snapshot"
+
+    if snapshot is not None:
+        logger.info("Loaded search artifact from %s", path)
+        return f"{len(snapshot.catalog)} charities from {origin}, artifact {path.name}"
+
+    context["catalog"] = ingest.catalog()
+    return f"{len(context['catalog'])} charities from {origin}"
+
+# Fit the vectorizer and indexes for the fetched rows unless they came from the artifact
+def build_catalog_snapshot(context):
+    snapshot = context["snapshot"]
+    if snapshot is None:
+        # The catalog stays in the context until the snapshot is installed, so a failed fit can be retried
+        snapshot = CatalogSnapshot.build(context["catalog"], context["source_hash"])
+        try:
+            snapshot.save(context["artifact_path"])
+            prune_artifacts()
+            logger.info("Saved search artifact to %s", context["artifact_path"])
+        except Exception as e:
+            logger.error("Error saving search artifact: %s", e)
+    snapshot.watermark = context["watermark"]
+    snapshot.source = context["source"]
+    # At startup the word vectors are not loaded yet, the dense_index stage attaches the index then
+    if word_vectors is not None:
+        attach_dense_index(snapshot)
+    return snapshot
+
+# Load the snapshot's dense index from its artifact, or embed the catalog and save one
+def attach_dense_index(snapshot):
+    path = artifact_path_for(snapshot.source_hash) / f"dense-{DENSE_QUANTIZATION}"
+    manifest = {
+        "vectors": word_vectors.model_name,
+        "dim": word_vectors.dim,
+        "quantization": DENSE_QUANTIZATION,
+        "nlist": DENSE_NLIST,
+        "charities": len(snapshot.catalog)
+    }
+    dense_index = DenseIndex.load(path, manifest)
+    if dense_index is None:
+        logger.info("Embedding charities for dense retrieval...")
+        embeddings = word_vectors.embed([snapshot.catalog.combined_text(row) for row in range(len(snapshot.catalog))])
+        dense_index = DenseIndex.build(embeddings, DENSE_NLIST, DENSE_QUANTIZATION)
+        try:
+            dense_index.save(path, manifest)
+        except Exception as e:
+            logger.error("Error saving dense index: %s", e)
+    snapshot.dense_index = dense_index
+
+# Startup stage: build or load the snapshot, then install it
+def load_vectorizer_stage(context):
+    detail = "loaded from artifact" if context["snapshot"] is not None else None
+    snapshot = build_catalog_snapshot(context)
+    install_snapshot(snapshot)
+    context.pop("catalog", None)
+    return detail or f"fitted {snapshot.text_matrix_t.shape[0]} features ({VECTORIZER_MODE})"
+
+# Startup stage: load the collaborative-filtering model and precompute its scores
+def load_cf_model_stage(context):
+    global best_model
+    best_model = load_cf_model()
+
+    # Precompute collaborative-filtering scores so ranking gathers them from an array
+    logger.info("Precomputing model scores...")
+    catalog_snapshot.cf_scorer = CollaborativeScorer(best_model, catalog_snapshot.catalog)
+    return type(best_model).__name__ if best_model is not None else "unavailable, using default scores"
+
+# Startup stage: load the spaCy pipeline
+def load_nlp_stage(context):
+    global nlp, query_analyzer
+    nlp = load_nlp()
+    query_analyzer = QueryAnalyzer(nlp)
+    return ", ".join(nlp.pipe_names) or "blank pipeline"
+
+# Startup stage: build or load the dense retrieval index once both the catalog and the word vectors are loaded
+def load_dense_stage(context):
+    global word_vectors
+    word_vectors = WordVectorEmbedder.from_nlp(nlp)
+    if word_vectors is None:
+        return "no word vectors in the spaCy model, dense retrieval off"
+    attach_dense_index(catalog_snapshot)
+    index = catalog_snapshot.dense_index
+    return f"{len(index)} {DENSE_QUANTIZATION} embeddings in {len(index.centroids)} lists"
+
+# Staged startup loader, run in the background so the port binds and liveness answers immediately
+class StartupLoader:
+    """Runs the startup stages and tracks per-component status and timings for /health/ready."""
+
+    COMPONENTS = ("catalog", "vectorizer", "nlp", "cf_model")
+
+    def __init__(self):
+        components = self.COMPONENTS + (("dense_index",) if DENSE_RETRIEVAL else ())
+        self.components = {name: {"status": "pending"} for name in components}
+        self.started_at = None
+        self.finished_at = None
+        self.attempts = 0
+        # Set once STARTUP_MAX_ATTEMPTS passes have failed; the replica will never become ready
+        self.gave_up = False
+        self._thread = None
+        self._lock = threading.Lock()
+
+    @property
+    def ready(self):
+        return all(component["status"] == "ready" for component in self.components.values())
+
+    def start(self):
+        """Start loading in a background thread (no-op if already started or loaded)."""
+        with self._lock:
+            if self._thread is not None or self.ready:
+                return
+            self._thread = threading.Thread(target=self.run, name="startup-loader", daemon=True)
+            self._thread.start()
+
+    def run(self):
+        """Run every stage in the calling thread, retrying the failed ones with backoff until all are ready."""
+        self.started_at = time.time()
+        context = {}
+        delay = STARTUP_RETRY_SECONDS
+        while True:
+            self.attempts += 1
+            self._run_pass(context)
+            if self.ready:
+                self.finished_at = time.time()
+                logger.info("API startup complete in %.2fs", self.finished_at - self.started_at)
+                return
+            if STARTUP_MAX_ATTEMPTS > 0 and self.attempts >= STARTUP_MAX_ATTEMPTS:
+                self.finished_at = time.time()
+                self.gave_up = True
+                logger.error("API startup failed after %d attempts, see /health/ready for details", self.attempts)
+                return
+            logger.warning("API startup attempt %d failed, retrying in %gs", self.attempts, delay)
+            time.sleep(delay)
+            delay = min(delay * 2, STARTUP_RETRY_MAX_SECONDS)
+
+    def _run_pass(self, context):
+        """Run the stages that are not loaded yet; the NLP model loads alongside the catalog stages."""
+        nlp_thread = None
+        if not self._loaded("nlp"):
+            nlp_thread = threading.Thread(target=self._run_stage, args=("nlp", load_nlp_stage, context), daemon=True)
+            nlp_thread.start()
+
+        # Each stage needs the one before it; the stages after a failed one report it as their cause
+        dependent = ("catalog", load_catalog_stage), ("vectorizer", load_vectorizer_stage), ("cf_model", load_cf_model_stage)
+        failed = None
+        for name, stage in dependent:
+            if failed is not None:
+                self.components[name] = {"status": "failed", "error": f"{failed} unavailable"}
+            elif not self._loaded(name) and not self._run_stage(name, stage, context):
+                failed = name
+
+        if nlp_thread is not None:
+            nlp_thread.join()
+        if "dense_index" in self.components and not self._loaded("dense_index"):
+            if self._loaded("vectorizer") and self._loaded("nlp"):
+                self._run_stage("dense_index", load_dense_stage, context)
+            else:
+                self.components["dense_index"] = {"status": "failed", "error": "catalog or NLP model unavailable"}
+
+    def _loaded(self, name):
+        return self.components[name]["status"] == "ready"
+
+    def _run_stage(self, name, stage, context):
+        self.components[name] = {"status": "loading"}
+        start = time.perf_counter()
+        try:
+            detail = stage(context)
+        except Exception as e:
+            logger.error("Error loading %s: %s", name, e)
+            self.components[name] = {"status": "failed", "seconds": round(time.perf_counter() - start, 3), "error": str(e)}
+            return False
+        self.components[name] = {"status": "ready", "seconds": round(time.perf_counter() - start, 3), "detail": detail}
+        return True
+
+    def status(self):
+        return {
+            "ready": self.ready,
+            "attempts": self.attempts,
+            "gave_up": self.gave_up,
+            "components": {name: dict(component) for name, component in self.components.items()},
+            "elapsed_seconds": round((self.finished_at or time.time()) - self.started_at, 3) if self.started_at else 0.0
+        }
 
-# Create a focus areas index for faster matching
-focus_area_index = {}
-for idx, row in df.iterrows():
-    for area in row['focus_areas_list']:
-        area_lower = area.lower()
-        if area_lower not in focus_area_index:
-            focus_area_index[area_lower] = []
-        focus_area_index[area_lower].append((row['charityId'], idx))
+startup_loader = StartupLoader()
+
+# Reject work until every component is loaded
+def ensure_ready():
+    if not startup_loader.ready:
+        raise HTTPException(
+            status_code=503,
+            detail="Service is still loading, please retry shortly",
+            headers={"Retry-After": "5"}
+        )
+
+# Keeps the served snapshot in sync with Supabase while the server runs
+class CatalogRefresher:
+    """Periodically applies rows changed since the last sync, with a full refit on a longer schedule."""
+
+    def __init__(self, interval, full_refit_interval):
+        self.interval = interval
+        self.full_refit_interval = full_refit_interval
+        self.last_sync = None
+        self.last_full_refit = None
+        self.last_error = None
+        self.synced_rows = 0
+        self._lock = threading.Lock()
+
+    def full_refit_due(self):
+        # A catalog served from the local snapshot is replaced as soon as Supabase answers again
+        if catalog_snapshot is not None and catalog_snapshot.source and catalog_snapshot.source["origin"] == "local_snapshot":
+            return True
+        if self.full_refit_interval <= 0:
+            return False
+        # Startup counts as the first full fit
+        since = self.last_full_refit or startup_loader.finished_at or time.time()
+        return time.time() - since >= self.full_refit_interval
+
+    def refresh(self, full=None):
+        """Sync once (full refit when due, or when full is True); returns the number of rows applied."""
+        with self._lock:
+            full = self.full_refit_due() if full is None else full
+            try:
+                snapshot, rows = self._full_refit() if full else self._apply_changes(catalog_snapshot)
+            except Exception as e:
+                self.last_error = str(e)
+                logger.error("Error refreshing catalog: %s", e)
+                return 0
+
+            self.last_error = None
+            self.last_sync = time.time()
+            if full:
+                self.last_full_refit = self.last_sync
+            if snapshot is None:
+                return 0
+
+            # Scores are precomputed per catalog row, so the new rows need their own scorer
+            snapshot.cf_scorer = CollaborativeScorer(best_model, snapshot.catalog)
+            install_snapshot(snapshot)
+            self.synced_rows += rows
+            logger.info("Installed catalog version %d (%s)", snapshot.version, "full refit" if full else f"{rows} changed rows")
+            return rows
+
+    def _apply_changes(self, snapshot):
+        if snapshot.watermark is None:
+            return None, 0
+        changes = fetch_changed_frame(snapshot.watermark)
+        if changes.empty:
+            return None, 0
+
+        updated = snapshot.apply_changes(CharityCatalog.from_frame(changes).deduplicated())
+        updated.watermark = advance_watermark(snapshot.watermark, changes, snapshot.watermark[0])
+        updated.source = snapshot.source
+        return updated, len(changes)
+
+    def _full_refit(self):
+        context = {}
+        # A failed fetch must not replace the live catalog with the (older) local snapshot
+        load_catalog_stage(context, allow_snapshot=False)
+        return build_catalog_snapshot(context), context["rows"]
+
+    async def run(self):
+        """Background task started by the lifespan handler."""
+        while True:
+            await asyncio.sleep(self.interval)
+            if startup_loader.ready:
+                await asyncio.to_thread(self.refresh)
+
+    def status(self):
+        return {
+            "interval": self.interval,
+            "full_refit_interval": self.full_refit_interval,
+            "last_sync": self.last_sync,
+            "last_full_refit": self.last_full_refit,
+            "synced_rows": self.synced_rows,
+            "last_error": self.last_error
+        }
 
-print("API startup complete")
+catalog_refresher = CatalogRefresher(CATALOG_REFRESH_INTERVAL, CATALOG_FULL_REFIT_INTERVAL)
+
+# Bounded LRU cache whose entries also expire after a fixed time
+class LRUCache:
+    """O(1) get/put LRU with a TTL; the hit/miss counters live in shared memory so forked workers report into them."""
+
+    COUNTERS = ("hits", "misses", "evictions", "expirations")
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = max(1, maxsize)
+        self.ttl = ttl
+        # key -> (expires_at, value), least recently used first
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._counters = multiprocessing.Array("q", len(self.COUNTERS))
+        # A forked worker may inherit the lock in a held state
+        os.register_at_fork(after_in_child=self._reset_lock)
+
+    def _reset_lock(self):
+        self._lock = threading.Lock()
+
+    def _count(self, counter, n=1):
+        with self._counters.get_lock():
+            self._counters[self.COUNTERS.index(counter)] += n
+
+    def get(self, key):
+        """Cached value for key, or None when missing or expired."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] <= now:
+                del self._entries[key]
+                expired, entry = True, None
+            else:
+                expired = False
+                if entry is not None:
+                    self._entries.move_to_end(key)
+        if expired:
+            self._count("expirations")
+        self._count("hits" if entry is not None else "misses")
+        return entry[1] if entry is not None else None
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            evicted = 0
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                evicted += 1
+        if evicted:
+            self._count("evictions", evicted)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        """Counters across all processes; size is the number of entries held by this process."""
+        with self._counters.get_lock():
+            counters = dict(zip(self.COUNTERS, self._counters[:]))
+        lookups = counters["hits"] + counters["misses"]
+        return {
+            "size": len(self),
+            "maxsize": self.maxsize,
+            "ttl": self.ttl,
+            **counters,
+            "hit_rate": round(counters["hits"] / lookups, 4) if lookups else 0.0
+        }
 
 # Function to preprocess query - enhanced with advanced NLP techniques
-query_cache = {}
-# Add cache timestamp tracking to invalidate old entries
-query_cache_timestamps = {}
-# Maximum cache size to prevent memory issues
-MAX_CACHE_SIZE = 100
+# Maximum number of processed queries kept in the cache
+MAX_CACHE_SIZE = int(os.getenv("QUERY_CACHE_SIZE", "4096"))
 # Cache expiration time in seconds (5 minutes)
-CACHE_EXPIRATION = 300
+CACHE_EXPIRATION = float(os.getenv("QUERY_CACHE_TTL", "300"))
+# Processed queries keyed on the normalized query text
+query_cache = LRUCache(MAX_CACHE_SIZE, CACHE_EXPIRATION)
+
+# Ranked candidates before jitter and diversity, see result_cache_key
+result_cache = LRUCache(int(os.getenv("RESULT_CACHE_SIZE", "1024")), float(os.getenv("RESULT_CACHE_TTL", "300")))
+# Seed used for rankings requested with randomize=false
+DETERMINISTIC_SEED = 0
+# Match type of a ranked candidate, kept as an index into MATCH_TYPES
+MATCH_CATEGORY, MATCH_DESCRIPTION, MATCH_BOTH = 0, 1, 2
+MATCH_TYPES = ("category", "description", "both")
 
 # Define charity-specific synonyms for better matching
 charity_synonyms = {
@@ -295,27 +2022,320 @@ charity_synonyms = {
     "housing": ["shelter", "homes", "homelessness", "affordable housing"]
 }
 
-def preprocess_query(text):
+# Common charity categories to give higher weight
+important_categories = {
+    "education": 1.5,
+    "health": 1.5,
+    "environment": 1.5,
+    "poverty": 1.5,
+    "children": 1.5,
+    "animal": 1.5,
+    "disaster": 1.5,
+    "humanitarian": 1.5,
+    "rights": 1.5,
+    "community": 1.4,
+    "development": 1.4,
+    "research": 1.4,
+    "medical": 1.4,
+    "relief": 1.4,
+    "support": 1.3,
+    "aid": 1.3,
+    "assistance": 1.3,
+    "care": 1.3
+}
+
+# Aho-Corasick automaton over a fixed set of phrases
+class PhraseAutomaton:
+    """Reports every phrase occurring in a text with one pass over the text."""
+
+    def __init__(self, phrases):
+        self.phrases = list(dict.fromkeys(phrases))
+        # Trie nodes: outgoing edges, failure link and the phrases ending at the node
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [[]]
+        for index, phrase in enumerate(self.phrases):
+            node = 0
+            for char in phrase:
+                if char not in self.goto[node]:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append([])
+                    self.goto[node][char] = len(self.goto) - 1
+                node = self.goto[node][char]
+            self.output[node].append(index)
+
+        # Failure links in breadth-first order; a node also reports what its failure target reports
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in self.goto[node].items():
+                queue.append(child)
+                target = self.fail[node]
+                while target and char not in self.goto[target]:
+                    target = self.fail[target]
+                self.fail[child] = self.goto[target].get(char, 0)
+                self.output[child] = self.output[child] + self.output[self.fail[child]]
+
+    def find(self, text):
+        """Indexes into self.phrases of the phrases occurring anywhere in text."""
+        found = set()
+        node = 0
+        for char in text:
+            while node and char not in self.goto[node]:
+                node = self.fail[node]
+            node = self.goto[node].get(char, 0)
+            if self.output[node]:
+                found.update(self.output[node])
+        return found
+
+# Every word listed as a synonym of some charity term
+synonym_terms = {synonym for synonyms in charity_synonyms.values() for synonym in synonyms}
+# Synonym keys and values -> the synonym keys they belong to
+synonym_phrase_keys = {}
+for synonym_key, synonyms in charity_synonyms.items():
+    for phrase in (synonym_key, *synonyms):
+        synonym_phrase_keys.setdefault(phrase, set()).add(synonym_key)
+synonym_automaton = PhraseAutomaton(synonym_phrase_keys)
+# Phrases are kept in dict order, so the lowest index is the first category of the original scan
+category_automaton = PhraseAutomaton(important_categories)
+
+# Look up a processed query in the cache
+def get_cached_query(text):
+    cached = query_cache.get(normalize_query(text))
+    if cached is None:
+        return None
+    # Queries differing only in case or spacing share an entry, but each keeps its own original text
+    return cached if cached["original"] == text else dict(cached, original=text)
+
+# Queries of at most this many words skip the parser and NER, see QueryAnalyzer
+FAST_PATH_MAX_TOKENS = int(os.getenv("FAST_PATH_MAX_TOKENS", "3"))
+# Upper bound on the words the fast path learns from queries, least recently used dropped first
+MAX_LEXICON_SIZE = int(os.getenv("MAX_LEXICON_SIZE", "100000"))
+
+# Phrases that signal a charity interest, read by analyze_query_doc
+interest_patterns = ["want to help", "care about", "interested in", "support for", "donate to"]
+
+# Tiered query analysis: short queries from a lexicon, everything else through the full pipeline
+class QueryAnalyzer:
+    """Builds the parsed Doc for analyze_query_doc, without the parser and NER for short queries."""
+
+    # Parts of speech forming a noun phrase, and the ones that can head it
+    PHRASE_POS = ("ADJ", "NOUN", "PROPN", "NUM")
+    NOUN_POS = ("NOUN", "PROPN")
+
+    def __init__(self, nlp, max_fast_tokens=FAST_PATH_MAX_TOKENS):
+        self.nlp = nlp
+        self.max_fast_tokens = max_fast_tokens
+        # Components that tag and lemmatize, run on their own for words missing from the lexicon
+        self.tag_pipes = [(name, pipe) for name, pipe in nlp.pipeline
+                          if name not in ("parser", "ner", "entity_ruler", "sentencizer", "senter")]
+        # Entity-ruler patterns as lowercase token tuples -> label
+        self.ruler_patterns = {}
+        if "entity_ruler" in nlp.pipe_names:
+            for entry in nlp.get_pipe("entity_ruler").patterns:
+                if isinstance(entry["pattern"], list) and all(set(token) == {"LOWER"} for token in entry["pattern"]):
+                    self.ruler_patterns[tuple(token["LOWER"] for token in entry["pattern"])] = entry["label"]
+        self.max_pattern_length = max(map(len, self.ruler_patterns), default=1)
+        # Lowercase domain word -> (pos, lemma, entity label or None)
+        self.lexicon = {}
+        # Words learned from queries -> (pos, lemma, None), or None when their tag depends on the context
+        self.learned = OrderedDict()
+        self._learned_lock = threading.Lock()
+        self.enabled = max_fast_tokens > 0 and self._tag(nlp.make_doc("charity")).has_annotation("POS")
+        if self.enabled:
+            self._build_lexicon()
+
+    def _tag(self, doc):
+        for _, pipe in self.tag_pipes:
+            doc = pipe(doc)
+        return doc
+
+    def _build_lexicon(self):
+        # Domain words are analyzed once with the full pipeline so single-word entities are known too
+        words = set(charity_synonyms)
+        for synonyms in charity_synonyms.values():
+            for synonym in synonyms:
+                words.update(synonym.split())
+        for pattern in self.ruler_patterns:
+            words.update(pattern)
+        words = sorted(word for word in words if word.isalpha())
+        for word, doc in zip(words, self.nlp.pipe(words)):
+            if len(doc) == 1:
+                label = doc.ents[0].label_ if doc.ents else None
+                self.lexicon[word] = (doc[0].pos_, doc[0].lemma_, label)
+
+    def analyze(self, text):
+        """Parsed Doc for the normalized query text."""
+        return self.fast_doc(text) or self.nlp(text)
+
+    def analyze_many(self, texts):
+        """Parsed Docs for many normalized queries; the long ones share one nlp.pipe pass."""
+        docs = [self.fast_doc(text) for text in texts]
+        slow = [i for i, doc in enumerate(docs) if doc is None]
+        for i, doc in zip(slow, self.nlp.pipe(texts[i] for i in slow)):
+            docs[i] = doc
+        return docs
+
+    def fast_doc(self, text):
+        """Doc assembled from the lexicon and ruler patterns, or None when the query needs the full pipeline."""
+        if not self.enabled or any(pattern in text for pattern in interest_patterns):
+            return None
+        tokens = self.nlp.make_doc(text)
+        if not 0 < len(tokens) <= self.max_fast_tokens or not all(token.is_alpha for token in tokens):
+            return None
+
+        words = [token.text for token in tokens]
+        entries, seen = zip(*(self._entry(word) for word in words))
+        entries = list(entries)
+        if None in entries:
+            # Tag the whole query once so unknown words get their part of speech in context
+            tagged = self._tag(tokens)
+            for i, token in enumerate(tagged):
+                if entries[i] is None:
+                    entries[i] = (token.pos_, token.lemma_, None)
+                    if not seen[i]:
+                        self._learn(words[i], entries[i])
+
+        pos = [entry[0] for entry in entries]
+        # Proper nouns are where NER matters, leave those to the full pipeline
+        if "PROPN" in pos:
+            return None
+
+        heads, deps = self._attach(pos)
+        return Doc(
+            self.nlp.vocab,
+            words=words,
+            spaces=[bool(token.whitespace_) for token in tokens],
+            pos=pos,
+            lemmas=[entry[1] for entry in entries],
+            heads=heads,
+            deps=deps,
+            ents=self._entity_tags(words, entries)
+        )
+
+    def _entry(self, word):
+        """(entry, seen): the lexicon or learned entry of a word, and whether the word was met before."""
+        entry = self.lexicon.get(word)
+        if entry is not None:
+            return entry, True
+        with self._learned_lock:
+            if word in self.learned:
+                self.learned.move_to_end(word)
+                return self.learned[word], True
+        return None, False
+
+    def _learn(self, word, entry):
+        # Only a tag the word also gets on its own is reused in other queries
+        alone = self._tag(self.nlp.make_doc(word))
+        context_free = len(alone) == 1 and (alone[0].pos_, alone[0].lemma_) == entry[:2]
+        with self._learned_lock:
+            self.learned[word] = entry if context_free else None
+            while len(self.learned) > MAX_LEXICON_SIZE:
+                self.learned.popitem(last=False)
+
+    def _attach(self, pos):
+        """Heads and dependency labels approximating the parser for a few-word query."""
+        n = len(pos)
+        heads = list(range(n))
+        deps = ["dep"] * n
+
+        # Runs of adjectives and nouns attach to their last noun as compound, amod or nummod
+        phrases = []
+        start = 0
+        while start < n:
+            if pos[start] not in self.PHRASE_POS:
+                start += 1
+                continue
+            end = start
+            while end + 1 < n and pos[end + 1] in self.PHRASE_POS:
+                end += 1
+            nouns = [i for i in range(start, end + 1) if pos[i] in self.NOUN_POS]
+            if nouns:
+                head = nouns[-1]
+                for i in range(start, head):
+                    heads[i] = head
+                    deps[i] = "compound" if pos[i] in self.NOUN_POS else ("nummod" if pos[i] == "NUM" else "amod")
+                phrases.append((start, head))
+            start = end + 1
+
+        # The first verb is the root, otherwise the first noun phrase, otherwise the last word
+        verbs = [i for i in range(n) if pos[i] == "VERB"]
+        root = verbs[0] if verbs else (phrases[0][1] if phrases else n - 1)
+        deps[root] = "ROOT"
+
+        for start, head in phrases:
+            before = start - 1
+            if before >= 0 and pos[before] == "DET":
+                heads[before], deps[before] = head, "det"
+                before -= 1
+            if head == root:
+                continue
+            if before >= 0 and pos[before] == "ADP":
+                heads[head], deps[head] = before, "pobj"
+            else:
+                heads[head], deps[head] = root, "dobj" if pos[root] == "VERB" else "conj"
+
+        for i in range(n):
+            if deps[i] == "dep":
+                heads[i] = root
+                if pos[i] == "ADP":
+                    deps[i] = "prep"
+        return heads, deps
+
+    def _entity_tags(self, words, entries):
+        """IOB entity tags: single-word entities from the lexicon, then the entity-ruler patterns."""
+        tags = ["O"] * len(words)
+        i = 0
+        while i < len(words):
+            label = entries[i][2]
+            length = 1
+            if label is None:
+                for size in range(min(self.max_pattern_length, len(words) - i), 0, -1):
+                    label = self.ruler_patterns.get(tuple(words[i:i + size]))
+                    if label is not None:
+                        length = size
+                        break
+            if label is not None:
+                tags[i] = f"B-{label}"
+                for j in range(i + 1, i + length):
+                    tags[j] = f"I-{label}"
+            i += length
+        return tags
+
+# Normalize text - lowercase and strip extra whitespace
+def normalize_query(text):
+    return " ".join(text.lower().split())
+
+def preprocess_query(text, timings=None):
+    timings = timings or RequestTimings()
     # Check cache first, but only if it's not expired
-    current_time = time.time()
-    if text in query_cache:
-        # Check if cache entry is still valid
-        if text in query_cache_timestamps and current_time - query_cache_timestamps[text] < CACHE_EXPIRATION:
-            print(f"Using cached query processing for: '{text}'")
-            return query_cache[text]
-        else:
-            # Cache entry expired, remove it
-            if text in query_cache:
-                del query_cache[text]
-            if text in query_cache_timestamps:
-                del query_cache_timestamps[text]
+    cached = get_cached_query(text)
+    if cached is not None:
+        return cached
+
+    # Process with spaCy for linguistic analysis, short queries without the parser and NER
+    result = analyze_query_doc(text, query_analyzer.analyze(normalize_query(text)))
+    timings.count("queries_parsed")
+    cache_query(text, result)
+    return result
+
+# Preprocess many queries at once, parsing every uncached long one in a single nlp.pipe pass
+def preprocess_queries(texts, timings=None):
+    timings = timings or RequestTimings()
+    results = [get_cached_query(text) for text in texts]
+    missing = [i for i, result in enumerate(results) if result is None]
+    timings.count("queries_parsed", len(missing))
 
-    # Normalize text - lowercase and strip extra whitespace
-    normalized_text = " ".join(text.lower().split())
+    docs = query_analyzer.analyze_many([normalize_query(texts[i]) for i in missing])
+    for i, doc in zip(missing, docs):
+        results[i] = analyze_query_doc(texts[i], doc)
+        cache_query(texts[i], results[i])
 
-    # Process with spaCy for linguistic analysis
-    doc = nlp(normalized_text)
+    return results
 
+# Extract keywords, entities and phrases from a parsed query
+def analyze_query_doc(text, doc):
     # Extract main entities and concepts with their labels
     entities = []
     charity_entities = []
@@ -363,7 +2383,7 @@ def preprocess_query(text):
         elif token.pos_ in ["ADJ", "VERB"] and not token.is_stop and len(token.text) > 2:
             # Only include adjectives and verbs that might be relevant to charity domains
             lemma = token.lemma_.lower()
-            if any(lemma in syn_list for syn_list in charity_synonyms.values()):
+            if lemma in synonym_terms:
                 keywords.append(lemma)
 
     # Add noun chunks (noun phrases) for better phrase matching
@@ -373,10 +2393,11 @@ def preprocess_query(text):
             chunk_text = chunk.text.lower()
             noun_chunks.append(chunk_text)
 
-            # Check for charity-related phrases
-            for key, synonyms in charity_synonyms.items():
-                if key in chunk_text or any(syn in chunk_text for syn in synonyms):
-                    important_keywords.append(chunk_text)
+            # Check for charity-related phrases, once for every synonym key the chunk mentions
+            matched_keys = set()
+            for index in synonym_automaton.find(chunk_text):
+                matched_keys.update(synonym_phrase_keys[synonym_automaton.phrases[index]])
+            important_keywords.extend([chunk_text] * len(matched_keys))
 
     # Extract contextual information from sentences
     contextual_info = []
@@ -385,7 +2406,6 @@ def preprocess_query(text):
         sent_text = sent.text.lower()
 
         # Check for phrases like "I want to help...", "I care about...", etc.
-        interest_patterns = ["want to help", "care about", "interested in", "support for", "donate to"]
         for pattern in interest_patterns:
             if pattern in sent_text:
                 contextual_info.append(pattern)
@@ -417,27 +2437,87 @@ def preprocess_query(text):
         "contextual_info": contextual_info
     }
 
-    # Cache the result with timestamp
-    current_time = time.time()
-    query_cache[text] = result
-    query_cache_timestamps[text] = current_time
-
-    # Manage cache size to prevent memory issues
-    if len(query_cache) > MAX_CACHE_SIZE:
-        # Remove oldest entries
-        oldest_queries = sorted(query_cache_timestamps.items(), key=lambda x: x[1])[:len(query_cache) // 4]
-        for old_query, _ in oldest_queries:
-            if old_query in query_cache:
-                del query_cache[old_query]
-            if old_query in query_cache_timestamps:
-                del query_cache_timestamps[old_query]
-        print(f"Cache cleaned: removed {len(oldest_queries)} oldest entries")
-
     return result
 
+# Cache a processed query under its normalized text
+def cache_query(text, result):
+    query_cache.put(normalize_query(text), result)
+
 # Function to get semantic similarity with advanced techniques
-def get_semantic_similarity(query_info, top_n=25):  # Increased to 25 for better recall
-    # Create multiple query representations for better matching
+def get_semantic_similarity(query_info, top_n=25, snapshot=None):  # Increased to 25 for better recall
+    return get_semantic_similarity_batch([query_info], top_n=top_n, snapshot=snapshot)[0]
+
+# Semantic matches for many queries, scored with a single sparse product against text_matrix
+def get_semantic_similarity_batch(query_infos, top_n=25, snapshot=None, timings=None):
+    snapshot = snapshot or catalog_snapshot
+    timings = timings or RequestTimings()
+    with timings.stage("vectorize"):
+        query_vectors, representation_counts = vectorize_queries(query_infos, snapshot, timings=timings)
+    with timings.stage("semantic"):
+        results = score_semantic_matches(query_vectors, representation_counts, snapshot.text_matrix_t,
+                                         snapshot.catalog.charity_ids, top_n)
+        return apply_dense_retrieval(query_infos, results, snapshot, top_n)
+
+# Normalized TF-IDF vectors for every representation of every query, and the number of representations per query
+def vectorize_queries(query_infos, snapshot, timings=None):
+    timings = timings or RequestTimings()
+    representations = [build_query_representations(query_info) for query_info in query_infos]
+
+    # Transform all query representations of all queries at once
+    all_representations = [text for query_representations in representations for text in query_representations]
+    query_vectors = normalize(snapshot.vectorizer.transform(all_representations), norm='l2')
+    timings.count("representations", len(all_representations))
+    return query_vectors, [len(query_representations) for query_representations in representations]
+
+# Top semantic matches per query against a (features x charities) matrix
+def score_semantic_matches(query_vectors, representation_counts, text_matrix_t, charity_ids, top_n):
+    # Cosine similarity of every representation against every charity in one sparse product
+    similarity = (query_vectors @ text_matrix_t).tocsr()
+
+    # Split the rows back out per query
+    results = []
+    start = 0
+    for count in representation_counts:
+        end = start + count
+        results.append(rank_semantic_scores(similarity[start:end], representation_weights[:count], top_n, charity_ids))
+        start = end
+    return results
+
+# Blend dense retrieval hits into the semantic matches when the snapshot has a dense index
+def apply_dense_retrieval(query_infos, results, snapshot, top_n):
+    if snapshot.dense_index is None or word_vectors is None:
+        return results
+
+    # Dense retrieval catches paraphrases that share no terms with the description
+    query_vectors = word_vectors.embed([query_info["original"] + " " + query_info["expanded"] for query_info in query_infos])
+    dense_matches = snapshot.dense_index.search(query_vectors, top_n)
+    blended = []
+    for sparse_matches, query_vector, (rows, scores) in zip(results, query_vectors, dense_matches):
+        # Exact dense similarity of every sparse match, including the ones outside the probed lists
+        sparse_rows = np.array([snapshot.catalog.row_of[charity_id] for charity_id, _ in sparse_matches], dtype=np.int64)
+        sparse_dense_scores = snapshot.dense_index.scores(sparse_rows, query_vector) if query_vector.any() else None
+        blended.append(blend_dense_scores(sparse_matches, sparse_dense_scores, rows, scores, snapshot.catalog.charity_ids, top_n))
+    return blended
+
+# Mix dense similarities into the sparse semantic matches, by DENSE_WEIGHT
+def blend_dense_scores(sparse_matches, sparse_dense_scores, dense_rows, dense_scores, charity_ids, top_n):
+    # Queries without known words have no dense score, so their sparse scores stand
+    if sparse_dense_scores is None:
+        return list(sparse_matches)[:top_n]
+
+    blended = {
+        charity_id: (1 - DENSE_WEIGHT) * score + DENSE_WEIGHT * max(float(dense_score), 0.0)
+        for (charity_id, score), dense_score in zip(sparse_matches, sparse_dense_scores)
+    }
+    # Dense-only hits from the index, which catch paraphrases that share no terms with the query
+    for row, score in zip(dense_rows, dense_scores):
+        charity_id = charity_ids[row]
+        if score >= DENSE_MIN_SIMILARITY and charity_id not in blended:
+            blended[charity_id] = DENSE_WEIGHT * float(score)
+    return sorted(blended.items(), key=lambda item: item[1], reverse=True)[:top_n]
+
+# Create multiple query representations for better matching
+def build_query_representations(query_info):
     query_representations = [
         query_info["expanded"],  # Full expanded query with all terms
         query_info["processed"],  # Just the keywords
@@ -464,62 +2544,51 @@ def get_semantic_similarity(query_info, top_n=25):  # Increased to 25 for better
         specialized_representations.append(" ".join(query_info["contextual_info"]))
 
     # Combine all representations
-    all_representations = query_representations + specialized_representations
-
-    # Transform all query representations
-    query_vectors = tfidf_vectorizer.transform(all_representations)
-
-    # Calculate cosine similarity for each representation
-    all_scores = []
-
-    # Define weights for different representation types
-    representation_weights = {
-        0: 1.0,  # expanded - base weight
-        1: 0.9,  # processed
-        2: 0.8,  # original
-        3: 1.1,  # noun_chunks
-        4: 1.3,  # important_keywords
-        5: 1.4,  # charity_entities
-        6: 1.2   # contextual_info
-    }
-
-    # Calculate similarity scores for each representation
-    for i, query_vector in enumerate(query_vectors):
-        # Calculate similarity
-        sim_scores = cosine_similarity(query_vector, text_matrix).flatten()
-
-        # Apply weight based on representation type
-        weight = representation_weights.get(i, 1.0)
-        all_scores.append(sim_scores * weight)
-
-    # Combine scores using a weighted average approach
-    # This gives better results than just taking the maximum
-    combined_scores = np.zeros(len(df))
-
-    # First pass: take the maximum score for each charity
-    for scores in all_scores:
-        combined_scores = np.maximum(combined_scores, scores)
+    return query_representations + specialized_representations
+
+# Weights for the query representations, by position
+# (expanded, processed, original, noun_chunks, important_keywords, charity_entities, contextual_info)
+representation_weights = np.array([1.0, 0.9, 0.8, 1.1, 1.3, 1.4, 1.2])
+# Multi-representation boost after n hits, built by repeated addition of 5% steps as before
+representation_boost_steps = np.cumsum([0.0] + [0.05] * len(representation_weights))
+
+# Turn a (representations x charities) similarity matrix into the top semantic matches
+def rank_semantic_scores(similarity, weights, top_n, charity_ids):
+    # Only charities sharing a term with at least one representation can score above zero
+    candidates = np.unique(similarity.indices)
+    if candidates.size == 0:
+        return []
 
-    # Second pass: boost scores that appear in multiple representations
-    # This rewards charities that match across different aspects of the query
-    boost_scores = np.zeros(len(df))
-    for scores in all_scores:
-        # Only count scores above a minimum threshold
-        boost_scores += (scores > 0.01).astype(float) * 0.05
+    # Weighted scores for the candidate columns only
+    scores = similarity[:, candidates].toarray() * weights[:, None]
 
-    # Apply the boost (capped at 30% increase)
-    boost_factor = np.minimum(boost_scores, 0.3)
+    # Take the maximum score for each charity, then boost charities matched by several
+    # representations (each representation above 0.01 adds 5%, capped at 30%)
+    combined_scores = scores.max(axis=0)
+    boost_factor = np.minimum(representation_boost_steps[(scores > 0.01).sum(axis=0)], 0.3)
     final_scores = combined_scores * (1 + boost_factor)
 
-    # Get indices of top matches
-    top_indices = np.argsort(final_scores)[-top_n:][::-1]
+    # Partial sort down to the top matches, then order just those
+    k = min(top_n, final_scores.size)
+    top_indices = np.argpartition(-final_scores, k - 1)[:k]
+    top_indices = top_indices[np.argsort(-final_scores[top_indices], kind='stable')]
 
     # Return results with a lower threshold for better recall
-    return [(df.iloc[idx]['charityId'], final_scores[idx]) for idx in top_indices if final_scores[idx] > 0.003]
+    return [(charity_ids[candidates[idx]], final_scores[idx]) for idx in top_indices if final_scores[idx] > 0.003]
 
 # Function to match focus areas with advanced fuzzy matching
-def match_focus_areas(query_info):
+def match_focus_areas(query_info, snapshot=None, timings=None):
+    focus_area_matcher = (snapshot or catalog_snapshot).focus_area_matcher
     matches = {}
+    for area_id, match_weight in focus_area_weights(query_info, focus_area_matcher, timings=timings):
+        for charity_id, _ in focus_area_matcher.postings[area_id]:
+            matches[charity_id] = matches.get(charity_id, 0) + match_weight
+    return scale_focus_matches(matches)
+
+# (area_id, match weight) for every focus area hit by the query's terms, in scoring order
+def focus_area_weights(query_info, focus_area_matcher, timings=None):
+    timings = timings or RequestTimings()
+    area_weights = []
 
     # Prepare all terms to check with appropriate weighting
     weighted_terms = []
@@ -561,89 +2630,31 @@ def match_focus_areas(query_info):
         else:
             unique_weighted_terms[term] = weight
 
-    # Common charity categories to give higher weight
-    important_categories = {
-        "education": 1.5,
-        "health": 1.5,
-        "environment": 1.5,
-        "poverty": 1.5,
-        "children": 1.5,
-        "animal": 1.5,
-        "disaster": 1.5,
-        "humanitarian": 1.5,
-        "rights": 1.5,
-        "community": 1.4,
-        "development": 1.4,
-        "research": 1.4,
-        "medical": 1.4,
-        "relief": 1.4,
-        "support": 1.3,
-        "aid": 1.3,
-        "assistance": 1.3,
-        "care": 1.3
-    }
-
     # Check each term against focus areas
     for term, base_weight in unique_weighted_terms.items():
         # Skip very short terms
         if len(term) < 3:
             continue
+        timings.count("focus_terms")
 
-        # Determine term weight based on importance
+        # Determine term weight based on importance, from the first category contained in the term
         term_weight = base_weight
-        for category, weight in important_categories.items():
-            if category in term:
-                term_weight *= weight  # Multiply weights for compounding effect
-                break
-
-        # Exact match lookup (highest weight)
-        if term in focus_area_index:
-            for charity_id, _ in focus_area_index[term]:
-                matches[charity_id] = matches.get(charity_id, 0) + (1.0 * term_weight)
-
-        # Word boundary match (medium weight)
-        # This checks if the term appears as a whole word in the focus area
-        for focus_area in focus_area_index:
-            if re.search(r'\b' + re.escape(term) + r'\b', focus_area):
-                for charity_id, _ in focus_area_index[focus_area]:
-                    matches[charity_id] = matches.get(charity_id, 0) + (0.8 * term_weight)
-
-        # Fuzzy matching using Levenshtein distance
-        # Only for terms of sufficient length to avoid false matches
-        if len(term) >= 4:
-            for focus_area in focus_area_index:
-                # Skip exact matches (already handled)
-                if term == focus_area:
-                    continue
-
-                # Calculate Levenshtein distance
-                try:
-                    distance = Levenshtein.distance(term, focus_area)
-
-                    # Only consider close matches
-                    max_distance = min(3, len(term) // 3)  # Adaptive threshold based on term length
-
-                    if distance <= max_distance:
-                        # Calculate similarity score (1.0 = exact match, decreasing with distance)
-                        similarity = 1.0 - (distance / (len(term) + 1))
-
-                        # Apply similarity score to weight
-                        match_weight = 0.7 * similarity * term_weight
-
-                        for charity_id, _ in focus_area_index[focus_area]:
-                            matches[charity_id] = matches.get(charity_id, 0) + match_weight
-                except Exception:
-                    # Skip if Levenshtein calculation fails
-                    pass
-
-        # Partial match lookup (lowest weight)
-        # Only do this for terms that are at least 5 characters long to avoid false matches
-        if len(term) >= 5:
-            for focus_area in focus_area_index:
-                if term in focus_area and not re.search(r'\b' + re.escape(term) + r'\b', focus_area):
-                    for charity_id, _ in focus_area_index[focus_area]:
-                        matches[charity_id] = matches.get(charity_id, 0) + (0.4 * term_weight)
-
+        categories = category_automaton.find(term)
+        if categories:
+            term_weight *= important_categories[category_automaton.phrases[min(categories)]]  # Multiply weights for compounding effect
+
+        # Exact (1.0), whole-word (0.8), fuzzy (0.7 * similarity) and partial (0.4) hits
+        # come from the prebuilt matcher instead of scanning every focus area
+        for area_id, factor in focus_area_matcher.match(term):
+            area_weights.append((area_id, factor * term_weight))
+
+    # Every matched area adds its postings to the candidate scores
+    timings.count("focus_areas_matched", len(area_weights))
+    timings.count("focus_postings", sum(len(focus_area_matcher.postings[area_id]) for area_id, _ in area_weights))
+    return area_weights
+
+# Scale accumulated focus-area scores into (charity_id, 0-1 score) pairs
+def scale_focus_matches(matches):
     # Apply a logarithmic scaling to prevent extreme scores
     scaled_matches = {charity_id: math.log(1 + score) for charity_id, score in matches.items()}
 
@@ -651,361 +2662,1146 @@ def match_focus_areas(query_info):
     max_score = max(scaled_matches.values()) if scaled_matches else 1
     return [(charity_id, score/max_score) for charity_id, score in scaled_matches.items()]
 
-# Advanced prediction function with state-of-the-art scoring and filtering
-def predict_charities(user_input, top_n=5):
-    print(f"Processing charity prediction for query: '{user_input}'")
+# Prometheus histograms, observed by the process serving /metrics (workers hand their timings back)
+stage_seconds = Histogram(
+    "charity_stage_seconds", "Wall time of one ranking stage per request", ["endpoint", "stage"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+)
+request_seconds = Histogram(
+    "charity_request_seconds", "Wall time of a prediction request, queueing included", ["endpoint", "status"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+)
+ranking_candidates = Histogram(
+    "charity_ranking_candidates", "Candidates scored per ranked query",
+    buckets=(10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 25000)
+)
+
+# Stage timings and work counters of one request, measured in whichever worker ran it
+class RequestTimings:
+    """Seconds per ranking stage, summed over every query of the request; pickles back from process workers."""
 
-    # Add a small amount of randomness to ensure different results each time
-    randomization_seed = int(time.time()) % 10000
-    random.seed(randomization_seed)
-    print(f"Using randomization seed: {randomization_seed}")
+    def __init__(self):
+        self.stages = {}
+        self.candidate_counts = []
+        # Units of work per stage (queries parsed, representations transformed, postings scanned, ...)
+        self.counters = {}
 
-    # Preprocess the query with advanced NLP
-    query_info = preprocess_query(user_input)
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + time.perf_counter() - start
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def observe(self, endpoint):
+        """Record into the Prometheus histograms."""
+        for name, seconds in self.stages.items():
+            stage_seconds.labels(endpoint, name).observe(seconds)
+        for count in self.candidate_counts:
+            ranking_candidates.observe(count)
+
+    def breakdown(self):
+        return {
+            "stages_ms": {name: round(seconds * 1000, 3) for name, seconds in self.stages.items()},
+            "counters": dict(self.counters)
+        }
+
+    def server_timing(self, total=None):
+        """Server-Timing header value: a duration per stage and a description per counter."""
+        entries = [f"{name};dur={seconds * 1000:.3f}" for name, seconds in self.stages.items()]
+        entries += [f'{name};desc="{value}"' for name, value in self.counters.items()]
+        if total is not None:
+            entries.append(f"total;dur={total * 1000:.3f}")
+        return ", ".join(entries)
+
+# Advanced prediction function with state-of-the-art scoring and filtering
+def predict_charities(user_input, top_n=5, user_id=None, randomize=True, seed=None, timings=None):
+    logger.debug("Processing charity prediction for query: %r", user_input)
+    timings = timings or RequestTimings()
+
+    # Every stage scores against the same snapshot even if a refresh swaps it meanwhile
+    snapshot = catalog_snapshot
+    rng = ranking_generator(ranking_seed(randomize, seed))
+
+    # Repeated queries reuse the ranked candidates and only redo the fillers, jitter and diversity step
+    cache_key = result_cache_key(user_input, user_id, snapshot)
+    ranked = result_cache.get(cache_key)
+    if ranked is not None:
+        timings.count("result_cache_hits")
+    else:
+        # Preprocess the query with advanced NLP
+        with timings.stage("preprocess"):
+            query_info = preprocess_query(user_input, timings=timings)
+
+        # Get semantic similarity and focus area matches with enhanced techniques
+        [semantic_matches], [focus_matches] = score_queries([query_info], snapshot, timings=timings)
+
+        ranked = rank_charities(user_input, query_info, semantic_matches, user_id=user_id,
+                                snapshot=snapshot, focus_matches=focus_matches, timings=timings)
+        result_cache.put(cache_key, ranked)
+
+    with timings.stage("diversify"):
+        return diversify_recommendations(ranked.with_random_fillers(top_n, rng), top_n, rng, timings=timings)
+
+# Predict charities for many queries, sharing one nlp.pipe pass and one sparse product
+def predict_charities_batch(user_inputs, top_ns, user_ids=None, randomizes=None, seeds=None, timings=None):
+    logger.debug("Processing batch charity prediction for %d queries", len(user_inputs))
+    timings = timings or RequestTimings()
+
+    snapshot = catalog_snapshot
+    user_ids = user_ids or [None] * len(user_inputs)
+    randomizes = randomizes or [True] * len(user_inputs)
+    seeds = seeds or [None] * len(user_inputs)
+    cache_keys = [result_cache_key(user_input, user_id, snapshot) for user_input, user_id in zip(user_inputs, user_ids)]
+    cached = [result_cache.get(cache_key) for cache_key in cache_keys]
+
+    # Only the queries without a cached ranking are parsed and scored
+    missing = [i for i, ranked in enumerate(cached) if ranked is None]
+    timings.count("result_cache_hits", len(cached) - len(missing))
+    with timings.stage("preprocess"):
+        query_infos = preprocess_queries([user_inputs[i] for i in missing], timings=timings)
+    semantic_matches, focus_matches = score_queries(query_infos, snapshot, timings=timings) if missing else ([], [])
+    uncached = dict(zip(missing, zip(query_infos, semantic_matches, focus_matches)))
+
+    results = []
+    for i, (user_input, top_n, user_id, randomize, seed) in enumerate(zip(user_inputs, top_ns, user_ids, randomizes, seeds)):
+        rng = ranking_generator(ranking_seed(randomize, seed))
+        ranked = cached[i]
+        if ranked is None:
+            query_info, matches, focus = uncached[i]
+            ranked = rank_charities(user_input, query_info, matches, user_id=user_id,
+                                    snapshot=snapshot, focus_matches=focus, timings=timings)
+            result_cache.put(cache_keys[i], ranked)
+        with timings.stage("diversify"):
+            results.append(diversify_recommendations(ranked.with_random_fillers(top_n, rng), top_n, rng, timings=timings))
+    return results
+
+# Semantic and focus-area matches for parsed queries, merged across shards when the catalog is sharded
+def score_queries(query_infos, snapshot, top_n=25, timings=None):
+    timings = timings or RequestTimings()
+    if snapshot.shards is None:
+        semantic_matches = get_semantic_similarity_batch(query_infos, top_n=top_n, snapshot=snapshot, timings=timings)
+        with timings.stage("focus"):
+            focus_matches = [match_focus_areas(query_info, snapshot=snapshot, timings=timings) for query_info in query_infos]
+        return semantic_matches, focus_matches
+
+    with timings.stage("vectorize"):
+        query_vectors, representation_counts = vectorize_queries(query_infos, snapshot, timings=timings)
+    with timings.stage("focus"):
+        area_weights = [focus_area_weights(query_info, snapshot.focus_area_matcher, timings=timings) for query_info in query_infos]
+    # Both matchers run inside the shard workers
+    with timings.stage("shards"):
+        semantic_matches, focus_matches = snapshot.shards.score(query_vectors, representation_counts, area_weights, top_n)
+    with timings.stage("semantic"):
+        semantic_matches = apply_dense_retrieval(query_infos, semantic_matches, snapshot, top_n)
+    return semantic_matches, focus_matches
+
+# Seed for one ranking: the requested one, a fresh one to ensure different results each time,
+# or a fixed one so a request without randomization is repeatable
+def ranking_seed(randomize, seed=None):
+    if seed is not None:
+        return seed
+    return secrets.randbits(32) if randomize else DETERMINISTIC_SEED
+
+# Request-scoped generator for the random fillers, the jitter and the fallback picks
+def ranking_generator(seed):
+    logger.debug("Using randomization seed: %d", seed)
+    return np.random.default_rng(seed)
+
+# Result cache key: the ranking depends on the query, the user, and the catalog version
+def result_cache_key(user_input, user_id, snapshot):
+    return (normalize_query(user_input), user_id, snapshot.version)
+
+# Candidates of one ranking as parallel arrays, sorted by relevance before jitter and diversity
+class RankedCandidates:
+    """What the result cache keeps per query; response dicts are only built for the rows a request returns."""
+
+    def __init__(self, catalog, rows, semantic_scores, focus_scores, model_scores, cf_scorer, user_id,
+                 has_charity_terms, boost_categories):
+        self.catalog = catalog
+        # Kept so random fillers can be scored the same way as the matched candidates
+        self.cf_scorer = cf_scorer
+        self.user_id = user_id
+        self.has_charity_terms = has_charity_terms
+        self.boost_categories = boost_categories
+
+        relevance, match_types, match_strengths = score_candidates(
+            catalog, rows, semantic_scores, focus_scores, model_scores, has_charity_terms, boost_categories
+        )
+
+        # Sort by relevance score
+        order = np.argsort(-relevance, kind="stable")
+        self.rows = rows[order]
+        self.relevance = relevance[order]
+        self.semantic_scores = semantic_scores[order]
+        self.focus_scores = focus_scores[order]
+        self.model_scores = model_scores[order]
+        # Indexes into MATCH_TYPES
+        self.match_types = match_types[order]
+        self.match_strengths = match_strengths[order]
+
+    def __len__(self):
+        return len(self.rows)
+
+    def with_random_fillers(self, top_n, rng):
+        """These candidates plus random low-scored charities when fewer than twice top_n matched."""
+        if len(self) >= top_n * 2:
+            return self
+
+        # Add random charities until we have 3x the requested number for good diversity
+        eligible = np.setdiff1d(np.arange(len(self.catalog)), self.rows)
+        fillers = rng.choice(eligible, size=min(len(eligible), top_n * 3 - len(self)), replace=False)
+        # Add with low scores to both matching methods, random between 0.1-0.3
+        semantic_scores = 0.1 + (rng.random(len(fillers)) * 0.2)
+        focus_scores = 0.1 + (rng.random(len(fillers)) * 0.2)
+        model_scores = self.cf_scorer.scores_for_rows(fillers, self.user_id)
+        logger.debug("Added random charities, new total: %d", len(self) + len(fillers))
+        return RankedCandidates(
+            self.catalog,
+            np.concatenate([self.rows, fillers]),
+            np.concatenate([self.semantic_scores, semantic_scores]),
+            np.concatenate([self.focus_scores, focus_scores]),
+            np.concatenate([self.model_scores, model_scores]),
+            self.cf_scorer, self.user_id, self.has_charity_terms, self.boost_categories
+        )
+
+    def name(self, i):
+        return self.catalog.names[self.rows[i]]
+
+    def recommendation(self, i, relevance_score=None):
+        """Response dict for candidate i, with its relevance replaced by relevance_score when given."""
+        return self.catalog.recommendation(self.rows[i], self.relevance[i] if relevance_score is None else relevance_score, {
+            "match_type": MATCH_TYPES[self.match_types[i]],
+            "match_strength": float(self.match_strengths[i]),
+            "semantic_score": float(self.semantic_scores[i]),
+            "focus_score": float(self.focus_scores[i]),
+            "model_score": float(self.model_scores[i])
+        })
+
+# Matched charities with their semantic and focus area scores, ranked; random fillers are added per request
+def rank_charities(user_input, query_info, semantic_matches, user_id=None, snapshot=None, focus_matches=None, timings=None):
+    snapshot = snapshot or catalog_snapshot
+    catalog = snapshot.catalog
+    timings = timings or RequestTimings()
 
-    # Get semantic similarity matches with enhanced techniques
-    semantic_matches = get_semantic_similarity(query_info)
     semantic_charity_ids = {charity_id: score for charity_id, score in semantic_matches}
-    print(f"Found {len(semantic_charity_ids)} semantic matches")
+    logger.debug("Found %d semantic matches", len(semantic_charity_ids))
 
     # Get focus area matches with fuzzy matching
-    focus_matches = match_focus_areas(query_info)
+    if focus_matches is None:
+        with timings.stage("focus"):
+            focus_matches = match_focus_areas(query_info, snapshot=snapshot, timings=timings)
     focus_charity_ids = {charity_id: score for charity_id, score in focus_matches}
-    print(f"Found {len(focus_charity_ids)} focus area matches")
+    logger.debug("Found %d focus area matches", len(focus_charity_ids))
 
     # Combine all matching charity IDs
     all_charity_ids = set(semantic_charity_ids.keys()).union(set(focus_charity_ids.keys()))
-    print(f"Combined unique charity matches: {len(all_charity_ids)}")
-
-    # If we don't have enough matches, add some random charities to ensure diversity
-    if len(all_charity_ids) < top_n * 2:
-        # Get some random charity IDs from our dataset
-        available_ids = list(charity_lookup.keys())
-        # Shuffle to ensure randomness
-        random.shuffle(available_ids)
-        # Add random charities until we have at least twice the requested number
-        for charity_id in available_ids:
-            if charity_id not in all_charity_ids:
-                all_charity_ids.add(charity_id)
-                # Add with low scores to both matching methods
-                semantic_charity_ids[charity_id] = 0.1 + (random.random() * 0.2)  # Random score between 0.1-0.3
-                focus_charity_ids[charity_id] = 0.1 + (random.random() * 0.2)     # Random score between 0.1-0.3
-                if len(all_charity_ids) >= top_n * 3:  # Get 3x the requested number for good diversity
-                    break
-        print(f"Added random charities, new total: {len(all_charity_ids)}")
-
-    if not all_charity_ids:
-        print("No matching charities found, returning empty list")
-        return []
-
-    # Calculate final scores and prepare results
-    final_recommendations = []
-    raw_scores = []
-
-    for charity_id in all_charity_ids:
-        # Faster lookup using our prebuilt dictionary
-        if charity_id not in charity_lookup:
-            continue
-
-        charity_info = charity_lookup[charity_id]
-
-        # Get model prediction score (if available)
-        model_score = 0.5  # Default score
-        try:
-            if best_model is not None:
-                model_score = best_model.predict(1, charity_id).est
-        except Exception as model_error:
-            print(f"Model prediction error for charity {charity_id}: {str(model_error)}")
-            # Keep using the default score
-
-        # Get semantic similarity score (if available)
-        semantic_score = semantic_charity_ids.get(charity_id, 0)
-
-        # Get focus area match score (if available)
-        focus_score = focus_charity_ids.get(charity_id, 0)
-
-        # Calculate a combined match score for determining match type
-        combined_match_score = (semantic_score + focus_score) / 2
-
-        # Determine match type with more nuanced classification
-        if semantic_score > 0.7 and focus_score > 0.7:
-            match_type = "both"
-            match_strength = combined_match_score * 1.1  # Bonus for strong match on both dimensions
-        elif semantic_score > 0.7:
-            match_type = "description"
-            match_strength = semantic_score * 1.05  # Slight bonus for strong description match
-        elif focus_score > 0.7:
-            match_type = "category"
-            match_strength = focus_score * 1.05  # Slight bonus for strong category match
-        elif semantic_score > 0.4 and focus_score > 0.4:
-            # Medium confidence match on both dimensions
-            match_type = "both"
-            match_strength = combined_match_score
-        elif semantic_score > 0.4:
-            match_type = "description"
-            match_strength = semantic_score
-        elif focus_score > 0.4:
-            match_type = "category"
-            match_strength = focus_score
-        elif semantic_score > 0 and focus_score > 0:
-            # Lower confidence match on both dimensions
-            match_type = "both"
-            match_strength = combined_match_score * 0.9  # Slight penalty for lower confidence
-        elif semantic_score > 0:
-            match_type = "description"
-            match_strength = semantic_score * 0.9  # Slight penalty for lower confidence
-        else:
-            match_type = "category"
-            match_strength = focus_score * 0.9  # Slight penalty for lower confidence
-
-        # Calculate combined relevance score with adaptive weighting
-        # Base weights
-        model_weight = 0.25  # Reduced model weight
-        semantic_weight = 0.375  # Increased semantic weight
-        focus_weight = 0.375  # Increased focus weight
-
-        # Adjust weights based on score confidence and query characteristics
-        # Check if query has strong charity-specific terms
-        has_charity_terms = len(query_info.get("charity_entities", [])) > 0 or len(query_info.get("important_keywords", [])) > 0
-
-        if has_charity_terms:
-            # If query has charity-specific terms, give more weight to focus area matching
-            focus_weight += 0.1
-            model_weight -= 0.05
-            semantic_weight -= 0.05
-
-        # Adjust weights based on score confidence
-        if semantic_score > 0.8:
-            semantic_weight += 0.15
-            model_weight -= 0.075
-            focus_weight -= 0.075
-        elif focus_score > 0.8:
-            focus_weight += 0.15
-            model_weight -= 0.075
-            semantic_weight -= 0.075
-        elif semantic_score > 0.6:
-            semantic_weight += 0.1
-            model_weight -= 0.05
-            focus_weight -= 0.05
-        elif focus_score > 0.6:
-            focus_weight += 0.1
-            model_weight -= 0.05
-            semantic_weight -= 0.05
-
-        # Calculate final relevance score
-        relevance = (model_score * model_weight) + (semantic_score * semantic_weight) + (focus_score * focus_weight)
-
-        # Apply various boosting factors
-
-        # Boost score for charities with websites (indicates legitimacy)
-        if charity_info.get("website"):
-            relevance *= 1.08  # 8% boost for having a website
-
-        # Boost score for charities with longer, more detailed descriptions
-        description_length = len(charity_info["description"])
-        if description_length > 300:  # Long, detailed description
-            relevance *= 1.05
-        elif description_length > 150:  # Medium-length description
-            relevance *= 1.03
-
-        # Boost score for charities with multiple focus areas (more comprehensive)
-        if len(charity_info["focus_areas_list"]) >= 3:
-            relevance *= 1.04  # 4% boost for having 3+ focus areas
-
-        # Add veteran-specific boost
-        if any(term in user_input.lower() for term in ["veteran", "veterans", "military", "service member", "armed forces"]):
-            if charity_info["focus_areas_list"] and any(area.lower() in ["veterans", "military", "armed forces"] for area in charity_info["focus_areas_list"]):
-                relevance *= 1.25  # 25% boost for veteran-focused charities when searching for veteran causes
-
-        # Store raw score for outlier detection
-        raw_scores.append(relevance)
-
-        # Create recommendation object with enhanced details
-        # Handle potential NaN values in website field
-        website = charity_info.get("website", None)
-        if website is not None and (isinstance(website, float) and math.isnan(website)):
-            website = None
-
-        recommendation = {
-            "charityId": int(charity_info["charityId"]),
-            "name": charity_info["name"],
-            "description": charity_info["description"],
-            "focus_areas": charity_info["focus_areas_list"],
-            "relevance_score": float(relevance),
-            "match_details": {
-                "match_type": match_type,
-                "match_strength": float(match_strength),
-                "semantic_score": float(semantic_score),
-                "focus_score": float(focus_score),
-                "model_score": float(model_score)
-            },
-            "website": website  # Include website URL with NaN check
-        }
-
-        final_recommendations.append(recommendation)
-
-    # Sort by relevance score
-    final_recommendations.sort(key=lambda x: x["relevance_score"], reverse=True)
+    logger.debug("Combined unique charity matches: %d", len(all_charity_ids))
+
+    # Catalog rows for the candidates, with their scores from both matching methods
+    candidate_ids = [charity_id for charity_id in all_charity_ids if charity_id in catalog.row_of]
+    candidate_rows = np.array([catalog.row_of[charity_id] for charity_id in candidate_ids], dtype=np.int64)
+    semantic_scores = np.array([semantic_charity_ids.get(charity_id, 0) for charity_id in candidate_ids], dtype=np.float64)
+    focus_scores = np.array([focus_charity_ids.get(charity_id, 0) for charity_id in candidate_ids], dtype=np.float64)
+
+    # Check if query has strong charity-specific terms
+    has_charity_terms = len(query_info.get("charity_entities", [])) > 0 or len(query_info.get("important_keywords", [])) > 0
+    boost_categories = query_boost_categories(user_input)
+
+    # Model scores of the candidates only; fillers are scored when a request adds them
+    with timings.stage("model"):
+        model_scores = snapshot.cf_scorer.scores_for_rows(candidate_rows, user_id)
+
+    with timings.stage("rank"):
+        ranked = RankedCandidates(catalog, candidate_rows, semantic_scores, focus_scores, model_scores,
+                                  snapshot.cf_scorer, user_id, has_charity_terms, boost_categories)
+    timings.candidate_counts.append(len(ranked))
+    timings.count("candidates", len(ranked))
+    return ranked
+
+# Combine semantic, focus area and model scores of candidate rows into relevance, match type and match strength
+def score_candidates(catalog, candidate_rows, semantic_scores, focus_scores, model_scores, has_charity_terms, boost_categories):
+    # Calculate a combined match score for determining match type
+    combined_match_scores = (semantic_scores + focus_scores) / 2
+
+    # Determine match type with more nuanced classification; the first condition that holds wins
+    semantic_strong, focus_strong = semantic_scores > 0.7, focus_scores > 0.7
+    semantic_medium, focus_medium = semantic_scores > 0.4, focus_scores > 0.4
+    semantic_any, focus_any = semantic_scores > 0, focus_scores > 0
+    match_conditions = [
+        semantic_strong & focus_strong,
+        semantic_strong,
+        focus_strong,
+        semantic_medium & focus_medium,
+        semantic_medium,
+        focus_medium,
+        semantic_any & focus_any,
+        semantic_any
+    ]
+    match_types = np.select(match_conditions, [
+        MATCH_BOTH, MATCH_DESCRIPTION, MATCH_CATEGORY, MATCH_BOTH, MATCH_DESCRIPTION, MATCH_CATEGORY, MATCH_BOTH, MATCH_DESCRIPTION
+    ], MATCH_CATEGORY).astype(np.int8)
+    match_strengths = np.select(match_conditions, [
+        combined_match_scores * 1.1,  # Bonus for strong match on both dimensions
+        semantic_scores * 1.05,  # Slight bonus for strong description match
+        focus_scores * 1.05,  # Slight bonus for strong category match
+        combined_match_scores,
+        semantic_scores,
+        focus_scores,
+        combined_match_scores * 0.9,  # Slight penalty for lower confidence
+        semantic_scores * 0.9
+    ], focus_scores * 0.9)
+
+    # Calculate combined relevance score with adaptive weighting
+    # Base weights
+    model_weight = 0.25  # Reduced model weight
+    semantic_weight = 0.375  # Increased semantic weight
+    focus_weight = 0.375  # Increased focus weight
+
+    # Adjust weights based on score confidence and query characteristics
+    if has_charity_terms:
+        # If query has charity-specific terms, give more weight to focus area matching
+        focus_weight += 0.1
+        model_weight -= 0.05
+        semantic_weight -= 0.05
+
+    # Adjust weights based on score confidence, per candidate
+    confidence_conditions = [semantic_scores > 0.8, focus_scores > 0.8, semantic_scores > 0.6, focus_scores > 0.6]
+    semantic_weights = semantic_weight + np.select(confidence_conditions, [0.15, -0.075, 0.1, -0.05], 0.0)
+    focus_weights = focus_weight + np.select(confidence_conditions, [-0.075, 0.15, -0.05, 0.1], 0.0)
+    model_weights = model_weight + np.select(confidence_conditions, [-0.075, -0.075, -0.05, -0.05], 0.0)
+
+    # Calculate final relevance score
+    relevance = (model_scores * model_weights) + (semantic_scores * semantic_weights) + (focus_scores * focus_weights)
+
+    # Apply the boosting factors in one multiply: the static ones precomputed per charity,
+    # times the category boosts for categories the query mentions (e.g. veteran-focused charities for veteran causes)
+    boosts = catalog.static_boosts[candidate_rows]
+    for category in boost_categories:
+        boosts = boosts * np.where(catalog.category_flags[candidate_rows, category], CATEGORY_BOOSTS[category]["boost"], 1.0)
+    relevance *= boosts
+
+    return relevance, match_types, match_strengths
+
+# Jitter the ranked candidates and keep the top ones diverse in match type and name
+def diversify_recommendations(ranked, top_n, rng, timings=None):
+    timings = timings or RequestTimings()
+    candidate_count = len(ranked)
 
     # Apply post-processing to ensure diversity and quality
-    if len(final_recommendations) > top_n:
-        print(f"Applying diversity post-processing to {len(final_recommendations)} recommendations")
+    if candidate_count > top_n:
+        logger.debug("Applying diversity post-processing to %d recommendations", candidate_count)
 
         # Add a small random factor to scores to break ties and add variety
-        for rec in final_recommendations:
-            # Add up to 5% random variation to scores
-            random_factor = 1.0 + ((random.random() * 0.1) - 0.05)  # -5% to +5%
-            rec["relevance_score"] *= random_factor
+        # Add up to 5% random variation to scores
+        random_factors = 1.0 + ((rng.random(candidate_count) * 0.1) - 0.05)  # -5% to +5%
+        scores = ranked.relevance * random_factors
+
+        # Only the head of the re-sorted list is ever looked at: the top plus the diversity window
+        head_size = min(candidate_count, top_n + 10)
+        head = np.arange(candidate_count) if head_size == candidate_count else np.sort(np.argpartition(-scores, head_size - 1)[:head_size])
+        head = head[np.argsort(-scores[head], kind="stable")].tolist()
 
-        # Re-sort after adding randomness
-        final_recommendations.sort(key=lambda x: x["relevance_score"], reverse=True)
+        def by_score(candidates):
+            return sorted(candidates, key=lambda i: scores[i], reverse=True)
 
         # Get the top recommendations
-        top_recommendations = final_recommendations[:top_n]
+        top_recommendations = head[:top_n]
 
         # Check if we have enough diversity in match types
-        match_types = [rec["match_details"]["match_type"] for rec in top_recommendations]
+        match_types = [ranked.match_types[i] for i in top_recommendations]
 
         # If all top recommendations are of the same match type, try to add diversity
-        if len(set(match_types)) == 1 and len(final_recommendations) > top_n + 3:
-            print("All top recommendations have the same match type, adding diversity")
+        if len(set(match_types)) == 1 and candidate_count > top_n + 3:
+            logger.debug("All top recommendations have the same match type, adding diversity")
             # Find recommendations with different match types
-            diverse_candidates = [rec for rec in final_recommendations[top_n:top_n+10]
-                                if rec["match_details"]["match_type"] != match_types[0]]
+            diverse_candidates = [i for i in head[top_n:top_n+10] if ranked.match_types[i] != match_types[0]]
 
             # If we found diverse candidates, replace some of the lower-scoring top recommendations
             if diverse_candidates:
                 # Replace up to 2 of the lowest-scoring recommendations with diverse candidates
                 num_to_replace = min(2, len(diverse_candidates))
-                top_recommendations = top_recommendations[:-num_to_replace] + diverse_candidates[:num_to_replace]
-                # Re-sort by relevance score
-                top_recommendations.sort(key=lambda x: x["relevance_score"], reverse=True)
-                print(f"Added {num_to_replace} diverse recommendations")
+                top_recommendations = by_score(top_recommendations[:-num_to_replace] + diverse_candidates[:num_to_replace])
+                timings.count("diversity_rounds")
+                logger.debug("Added %d diverse recommendations", num_to_replace)
 
         # Also check for name diversity to avoid similar charities
-        charity_names = [rec["name"].lower() for rec in top_recommendations]
+        charity_names = [ranked.name(i).lower() for i in top_recommendations]
         if len(set(charity_names)) < len(charity_names):
-            print("Detected potential duplicate charity names, attempting to diversify")
+            logger.debug("Detected potential duplicate charity names, attempting to diversify")
             # Find unique names by keeping track of what we've seen
             seen_names = set()
             unique_recommendations = []
 
-            for rec in top_recommendations:
-                name_lower = rec["name"].lower()
+            for i, name_lower in zip(top_recommendations, charity_names):
                 if name_lower not in seen_names:
                     seen_names.add(name_lower)
-                    unique_recommendations.append(rec)
-
-            # If we removed duplicates, fill in with other recommendations
-            if len(unique_recommendations) < top_n and len(final_recommendations) > top_n:
-                # Find recommendations not already in our unique set
-                additional_recs = [rec for rec in final_recommendations[top_n:]
-                                  if rec["name"].lower() not in seen_names]
+                    unique_recommendations.append(i)
 
-                # Add as many as needed to reach top_n
+            # If we removed duplicates, fill in with other recommendations below the top, in score order
+            if len(unique_recommendations) < top_n:
                 needed = top_n - len(unique_recommendations)
-                unique_recommendations.extend(additional_recs[:needed])
-
-                # Re-sort by relevance score
-                unique_recommendations.sort(key=lambda x: x["relevance_score"], reverse=True)
-                print(f"Removed duplicate names and added {min(needed, len(additional_recs))} new recommendations")
+                below_top = itertools.chain(head[top_n:], ranked_tail(scores, head))
+                additional_recs = list(itertools.islice(
+                    (i for i in below_top if ranked.name(i).lower() not in seen_names), needed
+                ))
+                unique_recommendations = by_score(unique_recommendations + additional_recs)
+                timings.count("diversity_rounds")
+                logger.debug("Removed duplicate names and added %d new recommendations", len(additional_recs))
 
             # Use our deduplicated recommendations if we have any
             if unique_recommendations:
                 top_recommendations = unique_recommendations
 
-        print(f"Returning {len(top_recommendations)} diverse recommendations")
-        return top_recommendations
+        logger.debug("Returning %d diverse recommendations", len(top_recommendations))
+        return [ranked.recommendation(i, scores[i]) for i in top_recommendations]
     else:
-        print(f"Returning all {len(final_recommendations)} recommendations (not enough for diversity processing)")
-        return final_recommendations
+        logger.debug("Returning all %d recommendations (not enough for diversity processing)", candidate_count)
+        return [ranked.recommendation(i) for i in range(candidate_count)]
+
+# Candidates outside the head, in descending score order; only sorted when a name fill runs past the head
+def ranked_tail(scores, head):
+    rest = np.setdiff1d(np.arange(len(scores)), head)
+    yield from rest[np.argsort(-scores[rest], kind="stable")].tolist()
+
+# Catalog partitioned by row range for scoring in worker processes
+class ShardedScorer:
+    """Each shard's TF-IDF columns, focus-area postings and charity ids live in shared memory blocks."""
+
+    # Shared memory block names start with this prefix and the creating process id
+    BLOCK_PREFIX = "blockchair-shard"
+
+    def __init__(self, snapshot, shard_count):
+        # Forked workers inherit this object, only the process that created the blocks may unlink them
+        self.owner_pid = os.getpid()
+        self._blocks = []
+        self.shards = []
+        n = len(snapshot.catalog)
+        bounds = np.linspace(0, n, max(1, min(shard_count, n)) + 1).astype(np.int64)
+
+        # Charity-major copy of the matrix so each shard is a cheap row slice
+        doc_matrix = snapshot.text_matrix_t.T.tocsr()
+
+        # Focus-area postings as parallel (area, row) arrays
+        postings = snapshot.focus_area_matcher.postings
+        posting_sizes = [len(posting) for posting in postings]
+        posting_areas = np.repeat(np.arange(len(postings), dtype=np.int64), posting_sizes)
+        posting_rows = np.fromiter((row for posting in postings for _, row in posting), dtype=np.int64, count=sum(posting_sizes))
+
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            matrix_t = doc_matrix[start:end].T.tocsr()
+            in_shard = (posting_rows >= start) & (posting_rows < end)
+            order = np.argsort(posting_areas[in_shard], kind='stable')
+            areas = posting_areas[in_shard][order]
+            self.shards.append({
+                "shape": matrix_t.shape,
+                "arrays": {
+                    "data": self._share(matrix_t.data),
+                    "indices": self._share(matrix_t.indices),
+                    "indptr": self._share(matrix_t.indptr),
+                    "charity_ids": self._share(snapshot.catalog.charity_ids[start:end]),
+                    # Local rows grouped by area, area_indptr[a]:area_indptr[a + 1] for area a
+                    "area_rows": self._share(posting_rows[in_shard][order] - start),
+                    "area_indptr": self._share(np.searchsorted(areas, np.arange(len(postings) + 1)))
+                }
+            })
+
+    def _share(self, array):
+        array = np.ascontiguousarray(array)
+        name = f"{self.BLOCK_PREFIX}-{self.owner_pid}-{secrets.token_hex(6)}"
+        block = shared_memory.SharedMemory(name=name, create=True, size=max(1, array.nbytes))
+        np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+        self._blocks.append(block)
+        return (block.name, array.dtype.str, array.shape)
+
+    def score(self, query_vectors, representation_counts, area_weights, top_n):
+        """Semantic top_n and focus matches per query, scored shard by shard in parallel and merged."""
+        executor = get_shard_pool()
+        futures = [
+            executor.submit(score_catalog_shard, shard, query_vectors, representation_counts, area_weights, top_n)
+            for shard in self.shards
+        ]
+        parts = [future.result() for future in futures]
+
+        semantic_matches = []
+        focus_matches = []
+        for i in range(len(representation_counts)):
+            # Shards are in row order, so the stable sort breaks ties like the single-matrix ranking
+            candidates = [match for semantic, _ in parts for match in semantic[i]]
+            candidates.sort(key=lambda match: match[1], reverse=True)
+            semantic_matches.append(candidates[:top_n])
+
+            matches = {}
+            for _, focus in parts:
+                charity_ids, scores = focus[i]
+                for charity_id, score in zip(charity_ids.tolist(), scores.tolist()):
+                    matches[charity_id] = matches.get(charity_id, 0) + score
+            focus_matches.append(scale_focus_matches(matches))
+        return semantic_matches, focus_matches
+
+    def close(self):
+        """Release the shared memory; workers still holding a block keep their mapping."""
+        if os.getpid() != self.owner_pid:
+            return
+        blocks, self._blocks = self._blocks, []
+        for block in blocks:
+            block.close()
+            try:
+                block.unlink()
+            except FileNotFoundError:
+                pass
+
+    @classmethod
+    def remove_stale_blocks(cls, shm_dir="/dev/shm"):
+        """Unlink blocks left behind by processes that were killed before they could close their shards."""
+        shm_dir = Path(shm_dir)
+        if not shm_dir.is_dir():
+            return 0
+        removed = 0
+        for path in shm_dir.glob(f"{cls.BLOCK_PREFIX}-*"):
+            try:
+                pid = int(path.name[len(cls.BLOCK_PREFIX) + 1:].split("-")[0])
+                os.kill(pid, 0)
+            except ValueError:
+                continue
+            except ProcessLookupError:
+                path.unlink(missing_ok=True)
+                removed += 1
+            except PermissionError:
+                # Another user's process is alive
+                continue
+        if removed:
+            logger.warning("Removed %d shared memory blocks left by stopped processes", removed)
+        return removed
+
+# Shards of replaced snapshots, closed once in-flight requests are done with them
+retiring_shards = set()
+
+def retire_shards(shards):
+    retiring_shards.discard(shards)
+    shards.close()
+
+# Release the served and retiring shards' shared memory at shutdown
+def close_catalog_shards():
+    for shards in list(retiring_shards):
+        retire_shards(shards)
+    if catalog_snapshot is not None and catalog_snapshot.shards is not None:
+        catalog_snapshot.shards.close()
+
+# Process pool scoring catalog shards, started on first use
+shard_pool = None
+shard_pool_lock = threading.Lock()
+
+def get_shard_pool():
+    global shard_pool
+    with shard_pool_lock:
+        if shard_pool is None:
+            shard_pool = ProcessPoolExecutor(max_workers=CATALOG_SHARDS, mp_context=multiprocessing.get_context("fork"))
+            logger.info("Started shard pool with %d workers", CATALOG_SHARDS)
+        return shard_pool
+
+def shutdown_shard_pool():
+    global shard_pool
+    with shard_pool_lock:
+        if shard_pool is not None:
+            shard_pool.shutdown(wait=False, cancel_futures=True)
+            shard_pool = None
+
+# Shared memory blocks a shard worker has attached, by block name; room for six arrays per shard
+# of the served snapshot and of one that is being retired
+attached_shard_blocks = OrderedDict()
+MAX_ATTACHED_SHARD_BLOCKS = 2 * 6 * max(1, CATALOG_SHARDS)
+
+def attach_shard_array(spec):
+    name, dtype, shape = spec
+    entry = attached_shard_blocks.get(name)
+    if entry is None:
+        block = shared_memory.SharedMemory(name=name)
+        # The array comes after its block so it is released first when the entry is dropped
+        entry = (block, np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf))
+        attached_shard_blocks[name] = entry
+        while len(attached_shard_blocks) > MAX_ATTACHED_SHARD_BLOCKS:
+            attached_shard_blocks.popitem(last=False)
+    else:
+        attached_shard_blocks.move_to_end(name)
+    return entry[1]
+
+# Runs in a shard worker: local semantic top_n and raw focus-area scores for one shard
+def score_catalog_shard(shard, query_vectors, representation_counts, area_weights, top_n):
+    arrays = {key: attach_shard_array(spec) for key, spec in shard["arrays"].items()}
+    charity_ids = arrays["charity_ids"]
+    matrix_t = csr_matrix((arrays["data"], arrays["indices"], arrays["indptr"]), shape=shard["shape"], copy=False)
+    semantic = score_semantic_matches(query_vectors, representation_counts, matrix_t, charity_ids, top_n)
+
+    area_rows, area_indptr = arrays["area_rows"], arrays["area_indptr"]
+    focus = []
+    for query_area_weights in area_weights:
+        scores = np.zeros(len(charity_ids))
+        for area_id, match_weight in query_area_weights:
+            np.add.at(scores, area_rows[area_indptr[area_id]:area_indptr[area_id + 1]], match_weight)
+        hits = np.flatnonzero(scores)
+        focus.append((np.array(charity_ids[hits]), scores[hits]))
+    return semantic, focus
+
+# Bounded worker pool so CPU-heavy prediction work never runs on the event loop
+class PredictWorkerPool:
+    """Runs blocking prediction calls on a thread or process pool with a bounded backlog."""
+
+    def __init__(self, kind, workers, max_queue, timeout):
+        self.kind = kind
+        self.workers = max(1, workers)
+        self.max_queue = max(0, max_queue)
+        self.timeout = timeout
+        self._executor = None
+        self._pending = 0
+        self._rejected = 0
+        self._timed_out = 0
+        self._lock = threading.Lock()
+        # Guards creating, submitting to and recycling the executor
+        self._executor_lock = threading.Lock()
+
+    def _get_executor(self):
+        # Created lazily so process workers are forked after all data has been loaded
+        if self._executor is None:
+            if self.kind == "process":
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context("fork")
+                )
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="predict")
+            logger.info("Started %s predict pool with %d workers", self.kind, self.workers)
+        return self._executor
+
+    def _try_acquire(self):
+        with self._lock:
+            # Running requests occupy workers, anything above that waits in the executor queue
+            if self._pending >= self.workers + self.max_queue:
+                self._rejected += 1
+                return False
+            self._pending += 1
+            return True
+
+    def _release(self, _future=None):
+        with self._lock:
+            self._pending -= 1
+
+    async def run(self, fn, *args, timeout=None):
+        timeout = self.timeout if timeout is None else timeout
+        if not self._try_acquire():
+            raise HTTPException(
+                status_code=429,
+                detail="Server is busy, please retry shortly",
+                headers={"Retry-After": "1"}
+            )
+
+        try:
+            with self._executor_lock:
+                future = self._get_executor().submit(fn, *args)
+        except Exception:
+            self._release()
+            raise
+        # The slot is only freed once the work really finishes, even if the caller gave up on it
+        future.add_done_callback(self._release)
+
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), timeout=timeout)
+        except asyncio.TimeoutError:
+            with self._lock:
+                self._timed_out += 1
+            # Drops the job if it is still queued; a running job finishes in the background
+            future.cancel()
+            raise HTTPException(status_code=504, detail=f"Request timed out after {timeout:g}s")
+
+    def stats(self):
+        with self._lock:
+            return {
+                "kind": self.kind,
+                "workers": self.workers,
+                "max_queue": self.max_queue,
+                "pending": self._pending,
+                "rejected": self._rejected,
+                "timed_out": self._timed_out
+            }
+
+    def recycle(self):
+        """Replace process workers so new ones fork from the current state; queued jobs still finish."""
+        if self.kind != "process":
+            return
+        with self._executor_lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+predict_pool = PredictWorkerPool(PREDICT_EXECUTOR, PREDICT_WORKERS, PREDICT_MAX_QUEUE, PREDICT_TIMEOUT)
+
+# cProfile capture of the next N prediction requests, started from /admin/profile
+class RequestProfiler:
+    """Hands out one profile file per captured request and merges them once the last one finishes."""
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self.capture = None
+        self._captures = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def start(self, requests):
+        with self._lock:
+            if self.capture is not None and self.capture["state"] == "capturing":
+                raise RuntimeError("A profile capture is already running")
+            path = self.directory / f"{time.strftime('capture-%Y%m%d-%H%M%S')}-{os.getpid()}-{next(self._captures)}"
+            path.mkdir(parents=True, exist_ok=True)
+            self.capture = {"state": "capturing", "path": str(path), "requested": requests,
+                            "remaining": requests, "pending": 0, "files": [], "output": None}
+        return self.status()
+
+    def claim(self):
+        """Profile file for this request, or None when no capture wants it."""
+        with self._lock:
+            capture = self.capture
+            if capture is None or capture["remaining"] == 0:
+                return None
+            capture["remaining"] -= 1
+            capture["pending"] += 1
+            path = str(Path(capture["path"]) / f"request-{len(capture['files']):04d}.prof")
+            capture["files"].append(path)
+            return path
+
+    def release(self, path):
+        with self._lock:
+            capture = self.capture
+            if capture is None or path not in capture["files"]:
+                return
+            capture["pending"] -= 1
+            if capture["remaining"] or capture["pending"]:
+                return
+            # Requests that timed out may still be running and have no file yet
+            files = [file for file in capture["files"] if os.path.exists(file)]
+            if files:
+                capture["output"] = str(Path(capture["path"]) / "combined.prof")
+                pstats.Stats(*files).dump_stats(capture["output"])
+            capture["state"] = "done"
+        logger.info("Profile capture of %d requests written to %s", len(files), capture["path"])
+
+    def status(self):
+        with self._lock:
+            if self.capture is None:
+                return {"state": "idle"}
+            return {key: value for key, value in self.capture.items() if key != "files"}
+
+request_profiler = RequestProfiler(PROFILE_DIR)
+
+# Random charities returned when a query produced no recommendations at all
+def fallback_recommendations(top_n, rng, snapshot=None):
+    catalog = (snapshot or catalog_snapshot).catalog
+    try:
+        logger.debug("Attempting to return random charities as fallback")
+        # Get all available charity IDs
+        available_ids = catalog.unique_ids()
+
+        # Take top_n of them at random
+        picks = rng.choice(len(available_ids), size=min(top_n, len(available_ids)), replace=False)
+        fallback_ids = [available_ids[i] for i in picks]
+
+        # Create recommendation objects for these IDs
+        fallback_recommendations = []
+        for charity_id in fallback_ids:
+            # Create a basic recommendation with a neutral score
+            recommendation = catalog.recommendation(catalog.row_of[charity_id], 0.5, {
+                "match_type": "fallback",
+                "match_strength": 0.5,
+                "semantic_score": 0.5,
+                "focus_score": 0.5,
+                "model_score": 0.5
+            })
+
+            fallback_recommendations.append(recommendation)
+
+        logger.debug("Returning %d fallback recommendations", len(fallback_recommendations))
+        return fallback_recommendations
+    except Exception as fallback_error:
+        logger.error("Error generating fallback recommendations: %s", fallback_error)
+        return []
+
+# Synchronous body of /predict, executed inside the worker pool
+def run_prediction(query, top_n, randomize, user_id=None, seed=None):
+    """Recommendations, and the stage timings for the process serving /metrics."""
+    seed = ranking_seed(randomize, seed)
+    timings = RequestTimings()
+    # Get recommendations with the requested number of results
+    recommendations = predict_charities(query, top_n=top_n, user_id=user_id, randomize=randomize, seed=seed, timings=timings)
+
+    if not recommendations:
+        logger.info("No recommendations found for query: %r", query)
+        # Instead of returning empty list, try to get some random charities as fallback
+        return fallback_recommendations(top_n, ranking_generator(seed)), timings
+
+    logger.debug("Returning %d recommendations for query: %r (stage seconds %s)", len(recommendations), query, timings.stages)
+    return recommendations, timings
+
+# Synchronous body of /predict/batch, executed inside the worker pool as a single job
+def run_batch_prediction(queries):
+    """Recommendations per query, and the stage timings summed over the batch."""
+    timings = RequestTimings()
+    results = predict_charities_batch(
+        [q["query"] for q in queries],
+        [q["top_n"] for q in queries],
+        [q["user_id"] for q in queries],
+        [q["randomize"] for q in queries],
+        [q["seed"] for q in queries],
+        timings=timings
+    )
+
+    for i, (q, recommendations) in enumerate(zip(queries, results)):
+        if not recommendations:
+            logger.info("No recommendations found for query: %r", q["query"])
+            results[i] = fallback_recommendations(q["top_n"], ranking_generator(q["seed"]))
+
+    logger.debug("Returning recommendations for %d batched queries (stage seconds %s)", len(results), timings.stages)
+    return results, timings
+
+# Run a prediction job under cProfile and write its stats to path; module level so process workers can run it
+def run_profiled(path, job, *args):
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        return job(*args)
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
+
+# Submit a prediction job to the pool, under cProfile when a capture is running
+async def run_job(job, *args, timeout=None):
+    profile_path = request_profiler.claim()
+    if profile_path is None:
+        return await predict_pool.run(job, *args, timeout=timeout)
+    try:
+        return await predict_pool.run(run_profiled, profile_path, job, *args, timeout=timeout)
+    finally:
+        request_profiler.release(profile_path)
+
+# Reject admin requests without the configured token; the endpoints do not exist while ADMIN_TOKEN is unset
+def require_admin(x_admin_token: Optional[str] = Header(None)):
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if x_admin_token is None or not secrets.compare_digest(x_admin_token, ADMIN_TOKEN):
+        raise HTTPException(status_code=403, detail="Invalid admin token")
+
+# Whether the request carries the admin token, without rejecting it otherwise
+def is_admin(x_admin_token):
+    return bool(ADMIN_TOKEN) and x_admin_token is not None and secrets.compare_digest(x_admin_token, ADMIN_TOKEN)
 
 # API Endpoint: Predict Charities
 @app.get("/predict", response_model=List[Charity], summary="Get charity recommendations")
 async def predict(
+    response: Response,
     query: str = Query(..., description="The cause or interest"),
     top_n: int = Query(8, description="Number of results to return", ge=1, le=20),
-    randomize: bool = Query(True, description="Whether to add randomization to results")
+    randomize: bool = Query(True, description="Whether to add randomization to results"),
+    user_id: Optional[int] = Query(None, description="Personalize model scores for this user"),
+    seed: Optional[int] = Query(None, ge=0, description="Seed for the randomization, to replay a response from its X-Random-Seed header"),
+    debug: Optional[str] = Query(None, pattern="^timings$", description="Pass 'timings' for a per-stage breakdown in the Server-Timing header"),
+    x_admin_token: Optional[str] = Header(None, description="Admin token; also returns the timing breakdown")
 ):
     if not query:
         raise HTTPException(status_code=400, detail="Query parameter is required")
+    ensure_ready()
 
     try:
-        # Log the incoming request for monitoring
-        print(f"Processing charity recommendation request: '{query}', top_n={top_n}, randomize={randomize}")
+        # Resolved here so the response can report it
+        seed = ranking_seed(randomize, seed)
+        response.headers["X-Random-Seed"] = str(seed)
 
-        # Add a timestamp-based seed for randomization
-        if randomize:
-            # Use millisecond precision for better randomness
-            random.seed(int(time.time() * 1000) % 10000)
-            print(f"Using time-based randomization seed: {int(time.time() * 1000) % 10000}")
+        # Log the incoming request for monitoring
+        logger.debug("Processing charity recommendation request: %r, top_n=%d, randomize=%s, seed=%d", query, top_n, randomize, seed)
 
-        # Get recommendations with the requested number of results
-        recommendations = predict_charities(query, top_n=top_n)
+        # Hand the CPU-bound work to the worker pool so the event loop stays responsive
+        start = time.perf_counter()
+        recommendations, timings = await run_job(run_prediction, query, top_n, randomize, user_id, seed)
+        timings.observe("predict")
 
-        if not recommendations:
-            print(f"No recommendations found for query: '{query}'")
-            # Instead of returning empty list, try to get some random charities as fallback
-            try:
-                print("Attempting to return random charities as fallback")
-                # Get all available charity IDs
-                available_ids = list(charity_lookup.keys())
-
-                # Shuffle to ensure randomness
-                random.shuffle(available_ids)
-
-                # Take the first top_n IDs
-                fallback_ids = available_ids[:min(top_n, len(available_ids))]
-
-                # Create recommendation objects for these IDs
-                fallback_recommendations = []
-                for charity_id in fallback_ids:
-                    charity_info = charity_lookup[charity_id]
-
-                    # Handle potential NaN values in website field
-                    website = charity_info.get("website", None)
-                    if website is not None and (isinstance(website, float) and math.isnan(website)):
-                        website = None
-
-                    # Create a basic recommendation
-                    recommendation = {
-                        "charityId": int(charity_info["charityId"]),
-                        "name": charity_info["name"],
-                        "description": charity_info["description"],
-                        "focus_areas": charity_info["focus_areas_list"],
-                        "relevance_score": 0.5,  # Neutral score
-                        "match_details": {
-                            "match_type": "fallback",
-                            "match_strength": 0.5,
-                            "semantic_score": 0.5,
-                            "focus_score": 0.5,
-                            "model_score": 0.5
-                        },
-                        "website": website
-                    }
-
-                    fallback_recommendations.append(recommendation)
-
-                print(f"Returning {len(fallback_recommendations)} fallback recommendations")
-                return fallback_recommendations
-            except Exception as fallback_error:
-                print(f"Error generating fallback recommendations: {str(fallback_error)}")
-                return []
-
-        print(f"Returning {len(recommendations)} recommendations for query: '{query}'")
+        if debug == "timings" or is_admin(x_admin_token):
+            # Total includes the wait for a worker, which the stages do not
+            response.headers["Server-Timing"] = timings.server_timing(total=time.perf_counter() - start)
+            logger.info("Timing breakdown for query %r: %s", query, json.dumps(timings.breakdown()))
         return recommendations
+    except HTTPException:
+        # Backpressure (429) and timeout (504) responses pass through unchanged
+        raise
     except Exception as e:
         # Log the error for debugging
-        print(f"Error processing query '{query}': {str(e)}")
+        logger.exception("Error processing query %r", query)
         # Return a helpful error message
         raise HTTPException(status_code=500, detail=f"Error processing request: {str(e)}")
 
+# API Endpoint: Predict Charities for many queries at once
+@app.post("/predict/batch", response_model=List[BatchPredictResult], summary="Get charity recommendations for many queries")
+async def predict_batch(request: BatchPredictRequest, response: Response):
+    ensure_ready()
+    queries = [q.model_dump() for q in request.queries]
+    for q in queries:
+        q["seed"] = ranking_seed(q["randomize"], q["seed"])
+    response.headers["X-Random-Seed"] = ",".join(str(q["seed"]) for q in queries)
+
+    try:
+        logger.debug("Processing batch charity recommendation request with %d queries", len(queries))
+
+        # One pool job for the whole batch so parsing and scoring are shared across queries
+        results, timings = await run_job(run_batch_prediction, queries, timeout=PREDICT_BATCH_TIMEOUT)
+        timings.observe("predict_batch")
+
+        # Results come back in input order
+        return [
+            {"query": q["query"], "seed": q["seed"], "recommendations": recommendations}
+            for q, recommendations in zip(queries, results)
+        ]
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.exception("Error processing batch request")
+        raise HTTPException(status_code=500, detail=f"Error processing request: {str(e)}")
+
 # Health check endpoint
+# Origin and age of the rows behind the served catalog
+def catalog_source_status():
+    if catalog_snapshot is None or catalog_snapshot.source is None:
+        return None
+    source = catalog_snapshot.source
+    return dict(source, age_seconds=round(time.time() - source["fetched_at"], 1))
+
 @app.get("/health", summary="Health check endpoint")
 async def health_check():
     """Simple health check endpoint to verify the API is running."""
-    return {"status": "healthy", "loaded_charities": len(df)}
+    return {
+        "status": "healthy" if startup_loader.ready else "loading",
+        "loaded_charities": len(catalog_snapshot.catalog) if catalog_snapshot is not None else 0,
+        "catalog_version": catalog_snapshot.version if catalog_snapshot is not None else 0,
+        "catalog_source": catalog_source_status(),
+        "catalog_refresh": catalog_refresher.status(),
+        "predict_pool": predict_pool.stats()
+    }
+
+# Cache counters, for sizing the caches against real traffic
+@app.get("/metrics/cache", summary="Query cache statistics")
+async def cache_metrics():
+    """Hit, miss, eviction and expiration counts of the processed-query and result caches."""
+    return {"query_cache": query_cache.stats(), "result_cache": result_cache.stats()}
+
+# Cache, pool and catalog state, read when /metrics is scraped
+class ServingStateCollector:
+    """Prometheus collector over the caches' shared counters, the predict pool and the served catalog."""
+
+    def collect(self):
+        cache_entries = GaugeMetricFamily("charity_cache_entries", "Entries held by this process", labels=["cache"])
+        cache_hit_rate = GaugeMetricFamily("charity_cache_hit_rate", "Share of lookups answered from the cache", labels=["cache"])
+        cache_events = CounterMetricFamily("charity_cache_events", "Cache lookups and removals across worker processes",
+                                           labels=["cache", "event"])
+        for name, cache in (("query", query_cache), ("result", result_cache)):
+            stats = cache.stats()
+            cache_entries.add_metric([name], stats["size"])
+            cache_hit_rate.add_metric([name], stats["hit_rate"])
+            for event in LRUCache.COUNTERS:
+                cache_events.add_metric([name, event], stats[event])
+        yield cache_entries
+        yield cache_hit_rate
+        yield cache_events
+
+        pool = predict_pool.stats()
+        yield GaugeMetricFamily("charity_predict_pool_pending", "Jobs running or queued on the predict pool", value=pool["pending"])
+        yield CounterMetricFamily("charity_predict_pool_rejected", "Requests answered 429 by the predict pool", value=pool["rejected"])
+        yield CounterMetricFamily("charity_predict_pool_timed_out", "Requests answered 504 by the predict pool", value=pool["timed_out"])
+
+        snapshot = catalog_snapshot
+        yield GaugeMetricFamily("charity_catalog_charities", "Charities in the served catalog", value=len(snapshot.catalog) if snapshot else 0)
+        yield GaugeMetricFamily("charity_catalog_version", "Version of the served catalog snapshot", value=snapshot.version if snapshot else 0)
+        source = catalog_source_status()
+        if source is not None:
+            yield GaugeMetricFamily("charity_catalog_age_seconds", "Age of the rows behind the served catalog", value=source["age_seconds"])
+
+REGISTRY.register(ServingStateCollector())
+
+# Prometheus scrape endpoint
+@app.get("/metrics", summary="Prometheus metrics")
+async def metrics():
+    """Stage latency and request histograms, candidate counts, and cache, pool and catalog gauges."""
+    # The exposition content type already names its charset, which media_type would append a second time
+    return Response(generate_latest(), headers={"Content-Type": CONTENT_TYPE_LATEST})
+
+# Liveness: the process is up and the event loop is responsive
+@app.get("/health/live", summary="Liveness probe")
+async def health_live():
+    """Answers as soon as the server is running, even while models are still loading; 503 once startup gave up."""
+    if startup_loader.gave_up:
+        return JSONResponse(status_code=503, content={"status": "startup_failed", "attempts": startup_loader.attempts})
+    return {"status": "alive"}
+
+# Readiness: every component is loaded and requests can be served
+@app.get("/health/ready", summary="Readiness probe")
+async def health_ready():
+    """Per-component load status and timings; 503 until everything is loaded."""
+    status = startup_loader.status()
+    return JSONResponse(status_code=200 if status["ready"] else 503, content=status)
+
+# Admin: capture a cProfile of the next N prediction requests, for offline flame graphs (snakeviz, flameprof)
+@app.post("/admin/profile", summary="Profile the next prediction requests", dependencies=[Depends(require_admin)])
+async def start_profile(
+    requests: int = Query(10, ge=1, le=PROFILE_MAX_REQUESTS, description="Number of upcoming /predict and /predict/batch requests to profile")
+):
+    """One .prof file per request under PROFILE_DIR, merged into combined.prof after the last one."""
+    try:
+        return request_profiler.start(requests)
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
+@app.get("/admin/profile", summary="Profile capture status", dependencies=[Depends(require_admin)])
+async def profile_status():
+    return request_profiler.status()
+
+# Prefork serving: one process loads the catalog, matrices, spaCy and the model, and N uvicorn workers share them
+class PreforkMaster:
+    """Loads every component, freezes the heap and forks workers that accept on one inherited socket.
+
+    Workers only read the loaded arrays, so their pages stay shared copy-on-write; gc.freeze keeps the collector
+    from writing to the headers of the loaded objects. The master alone syncs the catalog and replaces the
+    workers with a fresh generation when a new snapshot is installed.
+    """
+
+    def __init__(self, host, port, worker_count):
+        self.host = host
+        self.port = port
+        self.worker_count = max(1, worker_count)
+        # pid -> generation; workers of older generations are draining
+        self.workers = {}
+        self.generation = 0
+        self.stopping = False
+        self.listener = None
+
+    def run(self):
+        startup_loader.run()
+        if not startup_loader.ready:
+            sys.exit(1)
+
+        self.listener = socket.create_server((self.host, self.port))
+        self.listener.set_inheritable(True)
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+
+        self._freeze()
+        for _ in range(self.worker_count):
+            self._spawn()
+        logger.info("Serving on %s:%d with %d preforked workers", self.host, self.port, self.worker_count)
+
+        next_refresh = time.monotonic() + CATALOG_REFRESH_INTERVAL if CATALOG_REFRESH_INTERVAL > 0 else None
+        while not self.stopping:
+            time.sleep(1)
+            self._reap()
+            if next_refresh is not None and time.monotonic() >= next_refresh and not self.stopping:
+                version = catalog_snapshot.version
+                catalog_refresher.refresh()
+                if catalog_snapshot.version != version:
+                    self._replace_workers()
+                next_refresh = time.monotonic() + CATALOG_REFRESH_INTERVAL
+        self._shutdown()
+
+    def _stop(self, signum, frame):
+        self.stopping = True
+
+    def _freeze(self):
+        # Thaw the previous freeze first, so cycles left by the replaced snapshot are collected instead of
+        # staying in the permanent generation; what survives moves there, and the collector never scans it
+        gc.unfreeze()
+        gc.collect()
+        gc.freeze()
+
+    def _spawn(self):
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                self._serve()
+                code = 0
+            except Exception:
+                logger.exception("Worker %d failed", os.getpid())
+            finally:
+                os._exit(code)
+        self.workers[pid] = self.generation
+
+    def _serve(self):
+        global preforked_worker
+        preforked_worker = True
+        # uvicorn installs its own handlers for a graceful shutdown
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        import uvicorn
+        uvicorn.Server(uvicorn.Config(app)).run(sockets=[self.listener])
+
+    def _replace_workers(self):
+        """Fork a generation serving the new snapshot, then let the previous one finish its requests and exit."""
+        previous = list(self.workers)
+        self.generation += 1
+        self._freeze()
+        for _ in range(self.worker_count):
+            self._spawn()
+        for pid in previous:
+            self._signal(pid, signal.SIGTERM)
+        logger.info("Started worker generation %d for catalog version %d", self.generation, catalog_snapshot.version)
+
+    def _reap(self):
+        """Collect exited workers and replace the ones of the current generation."""
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            generation = self.workers.pop(pid, None)
+            if generation == self.generation and not self.stopping:
+                logger.warning("Worker %d exited with code %d, starting a new one", pid, os.waitstatus_to_exitcode(status))
+                self._spawn()
+
+    def _signal(self, pid, signum):
+        try:
+            os.kill(pid, signum)
+        except ProcessLookupError:
+            pass
+
+    def _shutdown(self):
+        logger.info("Stopping %d workers", len(self.workers))
+        for pid in self.workers:
+            self._signal(pid, signal.SIGTERM)
+        for pid in list(self.workers):
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+        self.workers.clear()
+        self.listener.close()
+        shutdown_shard_pool()
+        close_catalog_shards()
 
 if __name__ == "__main__":
-    import uvicorn
-    uvicorn.run("server:app", host="127.0.0.1", port=5000, reload=False)
\ No newline at end of file
+    if "--build-artifact" in sys.argv:
+        # Fetch the rows and build (or validate) the artifact without starting the server
+        context = {}
+        load_catalog_stage(context)
+        load_vectorizer_stage(context)
+        if DENSE_RETRIEVAL:
+            load_nlp_stage(context)
+            logger.info(load_dense_stage(context))
+        logger.info("Search artifact ready at %s", context["artifact_path"])
+    elif "--preload" in sys.argv:
+        # Load once, then fork SERVE_WORKERS workers that share the loaded state
+        PreforkMaster(SERVE_HOST, SERVE_PORT, SERVE_WORKERS).run()
+    else:
+        import uvicorn
+        uvicorn.run("server:app", host="127.0.0.1", port=5000, reload=False)
\ No newline at end of file